@@ -2,21 +2,36 @@
 
 from typing import List, Dict, Optional
 from pydantic import BaseModel, Field
-from langgraph.graph import StateGraph, START, END
+from django.conf import settings
 
-from ai_bot.entity_extraction import extract_entities, store_entities_as_documents
+from ai_bot.entity_extraction import (
+    extract_entities, store_entities_as_documents, aextract_entities, astore_entities_as_documents,
+    extract_answer, aextract_answer, answer_field,
+)
 from ai_bot.prompts import QUESTIONS
-from ai_bot.langchain_integration import get_bot_response, get_bot_response_based_on_entities
-from ai_bot.knowledge_graph import KnowledgeGraph
+from ai_bot.langchain_integration import (
+    get_bot_response, get_bot_response_based_on_entities,
+    aget_bot_response, aget_bot_response_based_on_entities,
+    speculate_bot_response, aspeculate_bot_response, commit_bot_response, acommit_bot_response,
+    single_shot_bot_response, asingle_shot_bot_response,
+)
+from ai_bot.knowledge_graph import get_knowledge_graph
 from ai_bot.models import AppointmentRequest
+from ai_bot.tracing import traced
+from ai_bot.write_behind import WriteBehind
 
 from neo4j.exceptions import ClientError, Neo4jError
 import logging
+import threading
 
 # Adjust logging level for neo4j driver
 logging.getLogger("neo4j").setLevel(logging.ERROR)
 
-kg = KnowledgeGraph()
+logger = logging.getLogger(__name__)
+
+# Graph writes of a turn run in the background (settings.AI_BOT_GRAPH_WRITE_BEHIND)
+# until generate_response needs to read them back
+graph_writes = WriteBehind()
 
 # Define the state
 class AgentState(BaseModel):
@@ -28,65 +43,193 @@ class AgentState(BaseModel):
     patient: Optional[object] = None  # Replace with the patient model
     session_id: Optional[str] = None
     current_question: Optional[str] = None  # Track the current follow-up question
+    store_medication: bool = False  # This turn mentioned medications / an appointment
+    store_appointment: bool = False
+    speculative_response: Optional[str] = None  # General reply generated alongside extraction
+    single_shot: bool = False  # speculative_response came with the entities, from the same call
+    appointment_request: Optional[object] = None  # Unsaved AppointmentRequest of this turn; the caller saves it
 
-# Step 1: Extract entities
-def extract_entities_step(state: AgentState):
-    entities = extract_entities(state.input)
+# Each I/O-bound step has a sync variant (the 'pipeline' app) and an async
+# variant ('async_pipeline', used by the ASGI view); the decisions are shared.
+
+def _apply_entities(state: AgentState, entities: dict):
     # entities[state.current_question] = extracted_value or state.input
     if state.current_question:
-        extracted_value = entities.get(state.current_question)
+        extracted_value = entities.get(answer_field(state.current_question))
         state.entities[state.current_question] = extracted_value or state.input
     else:
         state.entities.update(entities)
 
     state.current_question = None
 
+def _session(state: AgentState):
+    # The chat history of the turn is the one of its conversation
+    return state.session_id or "default"
+
+def _patient_flags(state: AgentState, entities: dict):
+    return {
+        'name': state.patient.get_graph_name(),
+        'store_medication': entities.get("medications") is not None,
+        'store_appointment': entities.get("appointment_time") is not None,
+    }
+
+def _medication_counts(result):
+    if result:
+        record = result[0]
+        return record.get('dosage_count', 0), record.get('frequency_count', 0)
+    return 0, 0
+
+def _required_entities(state: AgentState, dosage_count, frequency_count):
+    required_entities = []
+    if not state.entities.get("dosages") and dosage_count == 0:
+        required_entities.append("dosages")
+    if not state.entities.get("frequencies") and frequency_count == 0:
+        required_entities.append("frequencies")
+    return required_entities
+
+def _medication_summary(state: AgentState, record):
+    state.entities["dosage"] = record.get("dosages", '')
+    state.entities["frequency"] = record.get("frequencies", '')
+    return f'The patient is taking medications: {record.get("medications")} with dosages: {record.get("dosages")} and frequencies: {record.get("frequencies")}'
+
+def _appointment_request(state: AgentState, record):
+    requested_time = record.get("appointment_time")[-1]
+    requested_time = requested_time['time'] if isinstance(requested_time, dict) else requested_time
+    # Saved by the caller, in the same transaction as the turn's messages
+    return AppointmentRequest(
+        patient=state.patient,
+        current_time=state.patient.next_appointment_datetime,
+        requested_time=requested_time,
+    )
+
+def _appointment_reply(state: AgentState):
+    return f"I will convey your request to Dr. {state.patient.doctor_name}."
+
+def _extracted(state: AgentState, flags):
+    # Return every changed field: LangGraph only keeps what a step returns
+    return {
+        "entities": state.entities,
+        "current_question": state.current_question,
+        "store_medication": flags['store_medication'],
+        "store_appointment": flags['store_appointment'],
+    }
+
+def _store_turn(entities, flags):
+    # Use MERGE to avoid duplicates and update properties
+    get_knowledge_graph().run_query('merge_patient', **flags)
+    store_entities_as_documents(entities, flags['name'])
+
+async def _astore_turn(entities, flags):
+    await get_knowledge_graph().arun_query('merge_patient', **flags)
+    await astore_entities_as_documents(entities, flags['name'])
+
+# Step 0 (optional, runs alongside step 1): speculative general reply
+def speculate_response_step(state: AgentState):
+    return {"speculative_response": speculate_bot_response(state.input, state.patient, _session(state))}
+
+async def aspeculate_response_step(state: AgentState):
+    return {"speculative_response": await aspeculate_bot_response(state.input, state.patient, _session(state))}
+
+def _targeted(state: AgentState):
+    # Answers to a follow-up question only need that question's fields extracted
+    return state.current_question is not None and settings.AI_BOT_TARGETED_EXTRACTION
+
+def _record_extraction(state: AgentState, entities: dict):
+    _apply_entities(state, entities)
+    flags = _patient_flags(state, entities)
+
     if entities:
-        patient_properties = {'name': state.patient.get_full_name()}
-        patient_properties['store_medication'] = entities.get("medications") is not None
-        patient_properties['store_appointment'] = entities.get("appointment_time") is not None
-        # Use MERGE to avoid duplicates and update properties
-        query = f"""
-        MERGE (p:Patient {{name: "{state.patient.get_full_name()}"}})
-        SET p.store_medication = {patient_properties['store_medication']}, p.store_appointment = {patient_properties['store_appointment']}
-        """
-        kg.graph.query(query)
-        store_entities_as_documents(entities, state.patient.get_full_name())
-    
-    return {"entities": state.entities}
+        # Earlier turns must be in the graph before check_missing_entities reads it
+        graph_writes.wait(flags['name'])
+        if settings.AI_BOT_GRAPH_WRITE_BEHIND:
+            graph_writes.submit(flags['name'], _store_turn, entities, flags)
+        else:
+            _store_turn(entities, flags)
+
+    return _extracted(state, flags)
+
+async def _arecord_extraction(state: AgentState, entities: dict):
+    _apply_entities(state, entities)
+    flags = _patient_flags(state, entities)
+
+    if entities:
+        await graph_writes.await_key(flags['name'])
+        if settings.AI_BOT_GRAPH_WRITE_BEHIND:
+            graph_writes.asubmit(flags['name'], _astore_turn, entities, flags)
+        else:
+            await _astore_turn(entities, flags)
+
+    return _extracted(state, flags)
+
+# Step 1: Extract entities
+def extract_entities_step(state: AgentState):
+    entities = extract_answer(state.input, state.current_question) if _targeted(state) else extract_entities(state.input)
+    return _record_extraction(state, entities)
+
+async def aextract_entities_step(state: AgentState):
+    if _targeted(state):
+        entities = await aextract_answer(state.input, state.current_question)
+    else:
+        entities = await aextract_entities(state.input)
+    return await _arecord_extraction(state, entities)
+
+# Step 1 in single-shot mode: entities and a draft reply from one LLM call.
+# Answers to a follow-up question, and turns whose call fails, use the
+# extraction step (and generate_response its own LLM call).
+def single_shot_step(state: AgentState):
+    if state.current_question:
+        return extract_entities_step(state)
+    try:
+        entities, reply = single_shot_bot_response(state.input, state.patient, _session(state))
+    except Exception:
+        logger.exception("Single-shot turn failed, falling back to the pipeline")
+        return extract_entities_step(state)
+    return {**_record_extraction(state, entities), "speculative_response": reply, "single_shot": True}
+
+async def asingle_shot_step(state: AgentState):
+    if state.current_question:
+        return await aextract_entities_step(state)
+    try:
+        entities, reply = await asingle_shot_bot_response(state.input, state.patient, _session(state))
+    except Exception:
+        logger.exception("Single-shot turn failed, falling back to the pipeline")
+        return await aextract_entities_step(state)
+    return {**await _arecord_extraction(state, entities), "speculative_response": reply, "single_shot": True}
 
 # Step 2: Check for missing entities
 def check_missing_entities_step(state: AgentState):
     required_entities = []
-    patient_name = state.patient.get_full_name()
+    patient_name = state.patient.get_graph_name()
 
     if state.entities.get("medications"):
         # Query the database to see if dosage and frequency for this medication already exist
         medication_name = state.entities.get("medications").strip()
-        query = f"""
-        MATCH (p:Patient {{name: "{patient_name}"}})-[:TAKES]->(m:Medication {{name: "{medication_name}"}})
-        OPTIONAL MATCH (m)-[:HAS_DOSAGE]->(d:Dosage)
-        OPTIONAL MATCH (m)-[:HAS_FREQUENCY]->(f:Frequency)
-        RETURN 
-            COUNT(d) AS dosage_count,
-            COUNT(f) AS frequency_count
-        """
+        dosage_count, frequency_count = 0, 0
         try:
-            result = kg.graph.query(query)
-            if result:
-                record = result[0]
-                dosage_count = record.get('dosage_count', 0)
-                frequency_count = record.get('frequency_count', 0)
-            else:
-                dosage_count = 0
-                frequency_count = 0
+            result = get_knowledge_graph().run_query('medication_detail_counts', name=patient_name, medication=medication_name)
+            dosage_count, frequency_count = _medication_counts(result)
         except (ClientError, Neo4jError) as e: # UnknownLabelWarning is fine as it's not yet stored
             pass
 
-        if not state.entities.get("dosages") and dosage_count == 0:
-            required_entities.append("dosages")
-        if not state.entities.get("frequencies") and frequency_count == 0:
-            required_entities.append("frequencies")
+        required_entities = _required_entities(state, dosage_count, frequency_count)
+
+    state.missing_entities = required_entities
+    return {"missing_entities": state.missing_entities}
+
+async def acheck_missing_entities_step(state: AgentState):
+    required_entities = []
+    patient_name = state.patient.get_graph_name()
+
+    if state.entities.get("medications"):
+        medication_name = state.entities.get("medications").strip()
+        dosage_count, frequency_count = 0, 0
+        try:
+            result = await get_knowledge_graph().arun_query('medication_detail_counts', name=patient_name, medication=medication_name)
+            dosage_count, frequency_count = _medication_counts(result)
+        except (ClientError, Neo4jError) as e:
+            pass
+
+        required_entities = _required_entities(state, dosage_count, frequency_count)
 
     state.missing_entities = required_entities
     return {"missing_entities": state.missing_entities}
@@ -98,82 +241,71 @@ def ask_follow_up_question_step(state: AgentState):
         question = QUESTIONS[next_entity]["question"]
         state.follow_up_question = question
         state.current_question = next_entity
-        return {"follow_up_question": question}
+        return {"follow_up_question": question, "current_question": next_entity}
     else:
         return {}
 
+def _use_speculative_response(state: AgentState):
+    # Nothing to read back from the graph: the reply is the general one. A
+    # single-shot draft also covers medications; appointments always take the
+    # AppointmentRequest branch.
+    if state.speculative_response is None or state.store_appointment:
+        return False
+    return state.single_shot or not state.store_medication
+
 # Step 3b: Generate response
 def generate_response_step(state: AgentState):
 
-    patient_name = state.patient.get_full_name()
-    query = f"""
-    MATCH (p:Patient {{name: "{patient_name}"}})
-    OPTIONAL MATCH (p)-[:TAKES]->(medication:Medication)
-    OPTIONAL MATCH (medication)-[:HAS_DOSAGE]->(dosage:Dosage)
-    OPTIONAL MATCH (medication)-[:HAS_FREQUENCY]->(frequency:Frequency)
-    OPTIONAL MATCH (p)-[:HAS]->(health_issue:HealthIssue)
-    OPTIONAL MATCH (p)-[:SCHEDULES]->(appointment:Appointment)
-    OPTIONAL MATCH (p)-[:HAS_LAB_TEST]->(lab_test:LabTest)
-    OPTIONAL MATCH (p)-[:HAS_NOTE]->(doctor_note:DoctorNote)
-    OPTIONAL MATCH (p)-[:HAS_VITAL]->(vital:Vital)
-    OPTIONAL MATCH (p)-[:HAS_ALLERGY]->(allergy:Allergy)
-    OPTIONAL MATCH (p)-[:HAS_FAMILY_HISTORY]->(family_history:FamilyHistory)
-    OPTIONAL MATCH (p)-[:HAS_LIFESTYLE_FACTOR]->(lifestyle_factor:LifestyleFactor)
-    OPTIONAL MATCH (p)-[:HAS_IMMUNIZATION]->(immunization:Immunization)
-    RETURN 
-        CASE WHEN count(medication) > 0 THEN collect(DISTINCT medication.name) ELSE null END AS medications,
-        CASE WHEN count(dosage) > 0 THEN collect(DISTINCT dosage.value) ELSE null END AS dosages,
-        CASE WHEN count(frequency) > 0 THEN collect(DISTINCT frequency.value) ELSE null END AS frequencies,
-        CASE WHEN count(health_issue) > 0 THEN collect(DISTINCT health_issue.description) ELSE null END AS health_issues,
-        CASE WHEN count(appointment) > 0 THEN collect(DISTINCT appointment.time) ELSE null END AS appointment_time,
-        CASE WHEN count(lab_test) > 0 THEN collect(DISTINCT lab_test.name) ELSE null END AS lab_tests,
-        CASE WHEN count(doctor_note) > 0 THEN collect(DISTINCT doctor_note.content) ELSE null END AS doctor_notes,
-        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.weight) ELSE null END AS weight,
-        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.height) ELSE null END AS height,
-        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.blood_pressure) ELSE null END AS blood_pressure,
-        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.heart_rate) ELSE null END AS heart_rate,
-        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.temperature) ELSE null END AS temperature,
-        CASE WHEN count(allergy) > 0 THEN collect(DISTINCT allergy.name) ELSE null END AS allergies,
-        CASE WHEN count(family_history) > 0 THEN collect(DISTINCT family_history.condition) ELSE null END AS family_history,
-        CASE WHEN count(lifestyle_factor) > 0 THEN collect(DISTINCT lifestyle_factor.description) ELSE null END AS lifestyle_factors,
-        CASE WHEN count(immunization) > 0 THEN collect(DISTINCT immunization.name) ELSE null END AS immunizations
-    """
+    patient_name = state.patient.get_graph_name()
+    response, appointment_request = None, None
 
+    if _use_speculative_response(state):
+        commit_bot_response(state.input, state.speculative_response, _session(state))
+        state.response = state.speculative_response
+        return {"response": state.response}
 
-    check_query = f"""
-    MATCH (n:Patient {{name: "{patient_name}"}})
-    WHERE n.store_appointment IS NOT NULL OR n.store_medication IS NOT NULL
-    RETURN n.name AS name, n.store_appointment AS store_appointment, n.store_medication AS store_medication
-    """
+    try:
+        graph_writes.wait(patient_name)
+        record = get_knowledge_graph().read_patient_profile(patient_name, mode=settings.AI_BOT_PROFILE_FETCH_MODE)
+        if record:
+            if record['store_medication'] and record.get("medications"):
+                response = get_bot_response_based_on_entities(_medication_summary(state, record), state.patient, _session(state))
+            elif record['store_appointment'] and record.get("appointment_time"):
+                appointment_request = _appointment_request(state, record)
+                response = _appointment_reply(state)
+            else:
+                response = get_bot_response(state.input, state.patient, _session(state))
+    except (ClientError, Neo4jError) as e:
+        pass
+
+    state.response = response
+    return {"response": response, "appointment_request": appointment_request}
+
+async def agenerate_response_step(state: AgentState):
+    patient_name = state.patient.get_graph_name()
+    response, appointment_request = None, None
+
+    if _use_speculative_response(state):
+        await acommit_bot_response(state.input, state.speculative_response, _session(state))
+        state.response = state.speculative_response
+        return {"response": state.response}
 
     try:
-        result = kg.graph.query(query)
-        check_result = kg.graph.query(check_query)
-        if result:
-            record = result[0]
-            check_record = check_result[0]
-            if check_record['store_medication'] and record.get("medications"):
-                state.entities["dosage"] = record.get("dosages", '')
-                state.entities["frequency"] = record.get("frequencies", '')
-                entities_input = f'The patient is taking medications: {record.get("medications")} with dosages: {record.get("dosages")} and frequencies: {record.get("frequencies")}'
-                response = get_bot_response_based_on_entities(entities_input, state.patient)
-            elif check_record['store_appointment'] and record.get("appointment_time"):
-                requested_time = record.get("appointment_time")[-1]
-                requested_time = requested_time['time'] if isinstance(requested_time, dict) else requested_time
-                # Create an AppointmentRequest
-                AppointmentRequest.objects.create(
-                    patient=state.patient,
-                    current_time=state.patient.next_appointment_datetime,
-                    requested_time=requested_time
-                )
-                response = f"I will convey your request to Dr. {state.patient.doctor_name}."
+        await graph_writes.await_key(patient_name)
+        record = await get_knowledge_graph().aread_patient_profile(patient_name, mode=settings.AI_BOT_PROFILE_FETCH_MODE)
+        if record:
+            if record['store_medication'] and record.get("medications"):
+                response = await aget_bot_response_based_on_entities(_medication_summary(state, record), state.patient, _session(state))
+            elif record['store_appointment'] and record.get("appointment_time"):
+                appointment_request = _appointment_request(state, record)
+                response = _appointment_reply(state)
             else:
-                response = get_bot_response(state.input, state.patient)
+                response = await aget_bot_response(state.input, state.patient, _session(state))
     except (ClientError, Neo4jError) as e:
         pass
 
     state.response = response
-    return {"response": response}
+    return {"response": response, "appointment_request": appointment_request}
 
 # Conditional function: Determine next step based on missing_entities
 def should_ask_follow_up(state: AgentState):
@@ -182,25 +314,69 @@ def should_ask_follow_up(state: AgentState):
     else:
         return "generate_response"
 
-# Create the StateGraph
-agent_graph = StateGraph(AgentState)
-
-# Add nodes
-agent_graph.add_node("extract_entities", extract_entities_step)
-agent_graph.add_node("check_missing_entities", check_missing_entities_step)
-agent_graph.add_node("ask_follow_up_question", ask_follow_up_question_step)
-agent_graph.add_node("generate_response", generate_response_step)
-
-# Add edges
-agent_graph.add_edge(START, "extract_entities")
-agent_graph.add_edge("extract_entities", "check_missing_entities")
-agent_graph.add_conditional_edges(
-    "check_missing_entities",
-    should_ask_follow_up,
-    ["ask_follow_up_question", "generate_response"]
-)
-agent_graph.add_edge("ask_follow_up_question", END)
-agent_graph.add_edge("generate_response", END)
+# Fan-out: speculate on a general reply unless the input answers a follow-up question
+def start_steps(state: AgentState):
+    if settings.AI_BOT_SPECULATIVE_RESPONSE and not state.current_question:
+        return ["extract_entities", "speculate_response"]
+    return ["extract_entities"]
+
+def build_agent_app(extract_step, check_step, generate_step, speculate_step=None):
+    from langgraph.graph import StateGraph, START, END
+
+    # Create the StateGraph; every node is traced (ai_bot/tracing.py)
+    agent_graph = StateGraph(AgentState)
 
-# Compile the graph
-agent_app = agent_graph.compile()
+    # Add nodes
+    agent_graph.add_node("extract_entities", traced("extract_entities", extract_step))
+    agent_graph.add_node("check_missing_entities", traced("check_missing_entities", check_step))
+    agent_graph.add_node("ask_follow_up_question", traced("ask_follow_up_question", ask_follow_up_question_step))
+    agent_graph.add_node("generate_response", traced("generate_response", generate_step))
+
+    # Add edges
+    if speculate_step:
+        # The speculative reply runs in the same superstep as extraction;
+        # generate_response (two supersteps later) sees its result
+        agent_graph.add_node("speculate_response", traced("speculate_response", speculate_step))
+        agent_graph.add_conditional_edges(START, start_steps, ["extract_entities", "speculate_response"])
+        agent_graph.add_edge("speculate_response", END)
+    else:
+        agent_graph.add_edge(START, "extract_entities")
+    agent_graph.add_edge("extract_entities", "check_missing_entities")
+    agent_graph.add_conditional_edges(
+        "check_missing_entities",
+        should_ask_follow_up,
+        ["ask_follow_up_question", "generate_response"]
+    )
+    agent_graph.add_edge("ask_follow_up_question", END)
+    agent_graph.add_edge("generate_response", END)
+
+    # Compile the graph
+    return agent_graph.compile()
+
+# The compiled agent graphs by name, with the steps each is built from; they
+# are compiled on first use (get_agent_app) rather than when this module loads
+AGENT_APPS = {
+    'pipeline': (extract_entities_step, check_missing_entities_step, generate_response_step, speculate_response_step),
+    'async_pipeline': (aextract_entities_step, acheck_missing_entities_step, agenerate_response_step, aspeculate_response_step),
+    # Single-shot mode (settings.AI_BOT_SINGLE_SHOT)
+    'single_shot': (single_shot_step, check_missing_entities_step, generate_response_step),
+    'async_single_shot': (asingle_shot_step, acheck_missing_entities_step, agenerate_response_step),
+    # Streamed replies can't be taken back, so the streaming pipelines don't speculate
+    'streaming': (extract_entities_step, check_missing_entities_step, generate_response_step),
+    'async_streaming': (aextract_entities_step, acheck_missing_entities_step, agenerate_response_step),
+}
+
+_agent_apps = {}
+_agent_apps_lock = threading.Lock()
+
+def get_agent_app(name):
+    """
+    Return the compiled agent graph `name` (an AGENT_APPS key), compiling it on first use
+    """
+    app = _agent_apps.get(name)
+    if app is None:
+        with _agent_apps_lock:
+            app = _agent_apps.get(name)
+            if app is None:
+                app = _agent_apps[name] = build_agent_app(*AGENT_APPS[name])
+    return app
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class AiBotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ai_bot'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from ai_bot.instrumentation import install_query_counter
+
+        # Count ORM queries per request (ai_bot/instrumentation.py)
+        connection_created.connect(install_query_counter, dispatch_uid='ai_bot_query_counter')
@@ -0,0 +1,63 @@
+"""
+chat model and graph backend selection
+
+settings.AI_BOT_CHAT_MODEL ('openai' or 'stub') and settings.AI_BOT_GRAPH_BACKEND
+('neo4j' or 'memory') pick what the chat chains and get_knowledge_graph() are
+built with. The 'stub' and 'memory' backends (ai_bot/fakes.py,
+ai_bot/graph_backends.InMemoryGraph) run the whole app offline and
+deterministically, with the latency set by the AI_BOT_FAKE_* settings.
+use_fakes() switches a running process over (benchmarks, tests).
+"""
+
+from django.conf import settings
+
+
+def build_chat_model(**openai_kwargs):
+    """
+    ChatOpenAI(**openai_kwargs), or a StubChatModel answering with fake_reply
+    """
+    if settings.AI_BOT_CHAT_MODEL == 'stub':
+        from ai_bot.fakes import StubChatModel, fake_reply
+        return StubChatModel(
+            respond=fake_reply,
+            latency=settings.AI_BOT_FAKE_LLM_LATENCY_MS / 1000,
+            token_latency=settings.AI_BOT_FAKE_LLM_MS_PER_TOKEN / 1000,
+        )
+
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(**openai_kwargs)
+
+
+def build_graph_backend():
+    """
+    An InMemoryGraph, or None for KnowledgeGraph's default Neo4j backend
+    """
+    if settings.AI_BOT_GRAPH_BACKEND == 'memory':
+        from ai_bot.graph_backends import InMemoryGraph
+        return InMemoryGraph(latency=settings.AI_BOT_FAKE_GRAPH_LATENCY_MS / 1000)
+    return None
+
+
+def use_fakes(llm_latency_ms=None, ms_per_token=None, graph_latency_ms=None):
+    """
+    Swap the chat chains and the shared knowledge graph for the fakes, with
+    the given latencies (defaults: the AI_BOT_FAKE_* settings). Caches that
+    would hide the simulated calls are turned off.
+    """
+    from django.test.utils import override_settings
+
+    from ai_bot import entity_extraction, langchain_integration
+    from ai_bot.knowledge_graph import KnowledgeGraph, set_knowledge_graph
+
+    fakes = {'AI_BOT_CHAT_MODEL': 'stub', 'AI_BOT_GRAPH_BACKEND': 'memory'}
+    for setting, value in (('AI_BOT_FAKE_LLM_LATENCY_MS', llm_latency_ms), ('AI_BOT_FAKE_LLM_MS_PER_TOKEN', ms_per_token),
+                           ('AI_BOT_FAKE_GRAPH_LATENCY_MS', graph_latency_ms)):
+        if value is not None:
+            fakes[setting] = value
+
+    with override_settings(**fakes):
+        entity_extraction.set_chat_model(build_chat_model())
+        langchain_integration.set_chat_model(build_chat_model())
+        set_knowledge_graph(KnowledgeGraph(backend=build_graph_backend()))
+    entity_extraction.set_extraction_cache(None)
+    langchain_integration.set_response_cache(None)
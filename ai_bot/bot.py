@@ -1,32 +1,134 @@
 # ai_bot/bot.py
 
+import random
+from typing import NamedTuple, Optional
+
 from ai_bot.langchain_integration import get_bot_response, get_bot_response_based_on_entities
+from django.conf import settings
 from django.utils import timezone
-from collections import defaultdict
-
-from ai_bot.agent import agent_app, AgentState  # Import the agent and state
 
-# Session state storage (use a more robust storage in production, e.g., Redis)
-session_states = defaultdict(lambda: None)
+from ai_bot.agent import get_agent_app, AgentState  # Import the agent and state
+from ai_bot.session_store import load_agent_state, aload_agent_state, save_agent_state, asave_agent_state
+from ai_bot.tracing import trace_turn
+from ai_bot.instrumentation import measure_turn
+from ai_bot.models import AppointmentRequest
 
-def generate_bot_response(message, patient, session_id="default"):
-    # Retrieve or initialize the state for the session
-    state = session_states.get(session_id)
-    if not state:
-        state = AgentState(
-            input=message,
-            patient=patient,
-            session_id=session_id
-        )
-        session_states[session_id] = state
-    else:
-        state.input = message  # Update the input with the user's message
+# Session state lives in the configured session store (settings.AI_BOT_SESSION_STORE),
+# so a follow-up answer can be handled by any worker
 
-    # Run the agent synchronously
-    result = agent_app.invoke(state)
+class BotTurn(NamedTuple):
+    """
+    The reply of a turn and the AppointmentRequest it made, if any. The
+    request is unsaved: the chat views save it with the turn's messages.
+    """
+    reply: str
+    appointment_request: Optional[AppointmentRequest] = None
 
+def _reply(result):
     if result.get("follow_up_question"):
         return result["follow_up_question"]
     else:
         # del session_states[session_id]
-        return result["response"]
\ No newline at end of file
+        return result["response"]
+
+def _turn(result):
+    return BotTurn(_reply(result), result.get("appointment_request"))
+
+def agent_mode():
+    """
+    'pipeline' or 'single_shot' for this turn (settings.AI_BOT_SINGLE_SHOT:
+    'off', 'on', or 'ab' to split turns evenly between both)
+    """
+    single_shot = settings.AI_BOT_SINGLE_SHOT
+    if single_shot == 'ab':
+        return random.choice(('pipeline', 'single_shot'))
+    return 'single_shot' if single_shot == 'on' else 'pipeline'
+
+def run_turn(message, patient, session_id="default"):
+    """
+    Run the agent on message and return the BotTurn, without saving anything
+    to the database
+    """
+    state = load_agent_state(session_id, message, patient)
+    mode = agent_mode()
+    app = get_agent_app('single_shot' if mode == 'single_shot' else 'pipeline')
+
+    # Run the agent synchronously
+    with trace_turn(), measure_turn(mode):
+        result = app.invoke(state)
+    save_agent_state(session_id, result)
+    return _turn(result)
+
+async def arun_turn(message, patient, session_id="default"):
+    state = await aload_agent_state(session_id, message, patient)
+    mode = agent_mode()
+    app = get_agent_app('async_single_shot' if mode == 'single_shot' else 'async_pipeline')
+
+    # Run the agent on the event loop; LLM and graph calls are awaited
+    with trace_turn(), measure_turn(mode):
+        result = await app.ainvoke(state)
+    await asave_agent_state(session_id, result)
+    return _turn(result)
+
+def generate_bot_response(message, patient, session_id="default"):
+    """
+    The reply to message, saving the appointment request it made (benchmarks, warm-up)
+    """
+    turn = run_turn(message, patient, session_id)
+    if turn.appointment_request is not None:
+        turn.appointment_request.save()
+    return turn.reply
+
+async def agenerate_bot_response(message, patient, session_id="default"):
+    turn = await arun_turn(message, patient, session_id)
+    if turn.appointment_request is not None:
+        await turn.appointment_request.asave()
+    return turn.reply
+
+def _streamed_token(payload):
+    # Only stream the reply LLM; the extraction LLM in extract_entities emits JSON
+    chunk, metadata = payload
+    if metadata.get("langgraph_node") == "generate_response" and chunk.content:
+        return chunk.content
+    return None
+
+def stream_bot_response(message, patient, session_id="default"):
+    """
+    Yield the reply as it is generated: the LLM tokens of generate_response,
+    or the whole reply at once when it is not LLM-generated (follow-up
+    question, appointment confirmation). The last item is the BotTurn.
+    """
+    state = load_agent_state(session_id, message, patient)
+    streamed, result = False, {}
+
+    with trace_turn():
+        for mode, payload in get_agent_app('streaming').stream(state, stream_mode=["messages", "values"]):
+            if mode == "values":
+                result = payload
+            elif (token := _streamed_token(payload)) is not None:
+                streamed = True
+                yield token
+
+    save_agent_state(session_id, result)
+
+    if not streamed:
+        yield _reply(result)
+    yield _turn(result)
+
+async def astream_bot_response(message, patient, session_id="default"):
+    state = await aload_agent_state(session_id, message, patient)
+    streamed, result = False, {}
+
+    with trace_turn():
+        async for mode, payload in get_agent_app('async_streaming').astream(state, stream_mode=["messages", "values"]):
+            if mode == "values":
+                result = payload
+            elif (token := _streamed_token(payload)) is not None:
+                streamed = True
+                yield token
+
+    await asave_agent_state(session_id, result)
+
+    if not streamed:
+        yield _reply(result)
+    yield _turn(result)
@@ -0,0 +1,235 @@
+"""
+named, parameterized Cypher queries used by the agent
+
+Patient and medication names are always passed as $parameters, never
+interpolated: names with quotes need no escaping, and the query text is the
+same for every patient, which is what Neo4j's query cache is keyed on.
+
+QueryCatalog prepares each query once (normalized text plus the parameter
+names it expects) and rejects calls with missing parameters.
+
+PROFILE_EFFECTS declares, for every query, what it does to the patient
+profiles of the read model (profile_store.py): the ProfileStore methods to
+call after it runs, with the query parameters to call them with. Read-only
+queries declare none; a query without a declaration can't be prepared.
+"""
+
+import re
+import threading
+from collections import namedtuple
+
+__all__ = ['QUERIES', 'PROFILE_EFFECTS', 'PreparedQuery', 'QueryCatalog', 'catalog']
+
+
+QUERIES = {
+    # Upsert the patient node and remember what kind of data the last turn stored
+    "merge_patient": """
+    MERGE (p:Patient {name: $name})
+    SET p.store_medication = $store_medication, p.store_appointment = $store_appointment
+    """,
+
+    # Whether dosage and frequency are already known for one of the patient's medications
+    "medication_detail_counts": """
+    MATCH (p:Patient {name: $name})-[:TAKES]->(m:Medication {name: $medication})
+    OPTIONAL MATCH (m)-[:HAS_DOSAGE]->(d:Dosage)
+    OPTIONAL MATCH (m)-[:HAS_FREQUENCY]->(f:Frequency)
+    RETURN
+        COUNT(d) AS dosage_count,
+        COUNT(f) AS frequency_count
+    """,
+
+    "patient_profile": """
+    MATCH (p:Patient {name: $name})
+    OPTIONAL MATCH (p)-[:TAKES]->(medication:Medication)
+    OPTIONAL MATCH (medication)-[:HAS_DOSAGE]->(dosage:Dosage)
+    OPTIONAL MATCH (medication)-[:HAS_FREQUENCY]->(frequency:Frequency)
+    OPTIONAL MATCH (p)-[:HAS]->(health_issue:HealthIssue)
+    OPTIONAL MATCH (p)-[:SCHEDULES]->(appointment:Appointment)
+    OPTIONAL MATCH (p)-[:HAS_LAB_TEST]->(lab_test:LabTest)
+    OPTIONAL MATCH (p)-[:HAS_NOTE]->(doctor_note:DoctorNote)
+    OPTIONAL MATCH (p)-[:HAS_VITAL]->(vital:Vital)
+    OPTIONAL MATCH (p)-[:HAS_ALLERGY]->(allergy:Allergy)
+    OPTIONAL MATCH (p)-[:HAS_FAMILY_HISTORY]->(family_history:FamilyHistory)
+    OPTIONAL MATCH (p)-[:HAS_LIFESTYLE_FACTOR]->(lifestyle_factor:LifestyleFactor)
+    OPTIONAL MATCH (p)-[:HAS_IMMUNIZATION]->(immunization:Immunization)
+    RETURN
+        CASE WHEN count(medication) > 0 THEN collect(DISTINCT medication.name) ELSE null END AS medications,
+        CASE WHEN count(dosage) > 0 THEN collect(DISTINCT dosage.value) ELSE null END AS dosages,
+        CASE WHEN count(frequency) > 0 THEN collect(DISTINCT frequency.value) ELSE null END AS frequencies,
+        CASE WHEN count(health_issue) > 0 THEN collect(DISTINCT health_issue.description) ELSE null END AS health_issues,
+        CASE WHEN count(appointment) > 0 THEN collect(DISTINCT appointment.time) ELSE null END AS appointment_time,
+        CASE WHEN count(lab_test) > 0 THEN collect(DISTINCT lab_test.name) ELSE null END AS lab_tests,
+        CASE WHEN count(doctor_note) > 0 THEN collect(DISTINCT doctor_note.content) ELSE null END AS doctor_notes,
+        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.weight) ELSE null END AS weight,
+        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.height) ELSE null END AS height,
+        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.blood_pressure) ELSE null END AS blood_pressure,
+        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.heart_rate) ELSE null END AS heart_rate,
+        CASE WHEN count(vital) > 0 THEN collect(DISTINCT vital.temperature) ELSE null END AS temperature,
+        CASE WHEN count(allergy) > 0 THEN collect(DISTINCT allergy.name) ELSE null END AS allergies,
+        CASE WHEN count(family_history) > 0 THEN collect(DISTINCT family_history.description) ELSE null END AS family_history,
+        CASE WHEN count(lifestyle_factor) > 0 THEN collect(DISTINCT lifestyle_factor.description) ELSE null END AS lifestyle_factors,
+        CASE WHEN count(immunization) > 0 THEN collect(DISTINCT immunization.name) ELSE null END AS immunizations
+    """,
+
+    # Same fields as patient_profile plus the store flags, in one round trip. Each
+    # relationship type is aggregated in its own subquery, so the rows grow with the
+    # sum of the patient's history instead of the product of every OPTIONAL MATCH.
+    "patient_profile_aggregated": """
+    MATCH (p:Patient {name: $name})
+    CALL { WITH p MATCH (p)-[:TAKES]->(medication:Medication) RETURN collect(DISTINCT medication.name) AS medications }
+    CALL { WITH p MATCH (p)-[:TAKES]->(:Medication)-[:HAS_DOSAGE]->(dosage:Dosage) RETURN collect(DISTINCT dosage.value) AS dosages }
+    CALL { WITH p MATCH (p)-[:TAKES]->(:Medication)-[:HAS_FREQUENCY]->(frequency:Frequency) RETURN collect(DISTINCT frequency.value) AS frequencies }
+    CALL { WITH p MATCH (p)-[:HAS]->(health_issue:HealthIssue) RETURN collect(DISTINCT health_issue.description) AS health_issues }
+    CALL { WITH p MATCH (p)-[:SCHEDULES]->(appointment:Appointment) RETURN collect(DISTINCT appointment.time) AS appointment_time }
+    CALL { WITH p MATCH (p)-[:HAS_LAB_TEST]->(lab_test:LabTest) RETURN collect(DISTINCT lab_test.name) AS lab_tests }
+    CALL { WITH p MATCH (p)-[:HAS_NOTE]->(doctor_note:DoctorNote) RETURN collect(DISTINCT doctor_note.content) AS doctor_notes }
+    CALL { WITH p MATCH (p)-[:HAS_VITAL]->(vital:Vital)
+           RETURN collect(DISTINCT vital.weight) AS weight, collect(DISTINCT vital.height) AS height,
+                  collect(DISTINCT vital.blood_pressure) AS blood_pressure, collect(DISTINCT vital.heart_rate) AS heart_rate,
+                  collect(DISTINCT vital.temperature) AS temperature }
+    CALL { WITH p MATCH (p)-[:HAS_ALLERGY]->(allergy:Allergy) RETURN collect(DISTINCT allergy.name) AS allergies }
+    CALL { WITH p MATCH (p)-[:HAS_FAMILY_HISTORY]->(family_history:FamilyHistory) RETURN collect(DISTINCT family_history.description) AS family_history }
+    CALL { WITH p MATCH (p)-[:HAS_LIFESTYLE_FACTOR]->(lifestyle_factor:LifestyleFactor) RETURN collect(DISTINCT lifestyle_factor.description) AS lifestyle_factors }
+    CALL { WITH p MATCH (p)-[:HAS_IMMUNIZATION]->(immunization:Immunization) RETURN collect(DISTINCT immunization.name) AS immunizations }
+    RETURN
+        CASE WHEN size(medications) > 0 THEN medications ELSE null END AS medications,
+        CASE WHEN size(dosages) > 0 THEN dosages ELSE null END AS dosages,
+        CASE WHEN size(frequencies) > 0 THEN frequencies ELSE null END AS frequencies,
+        CASE WHEN size(health_issues) > 0 THEN health_issues ELSE null END AS health_issues,
+        CASE WHEN size(appointment_time) > 0 THEN appointment_time ELSE null END AS appointment_time,
+        CASE WHEN size(lab_tests) > 0 THEN lab_tests ELSE null END AS lab_tests,
+        CASE WHEN size(doctor_notes) > 0 THEN doctor_notes ELSE null END AS doctor_notes,
+        CASE WHEN size(weight) > 0 THEN weight ELSE null END AS weight,
+        CASE WHEN size(height) > 0 THEN height ELSE null END AS height,
+        CASE WHEN size(blood_pressure) > 0 THEN blood_pressure ELSE null END AS blood_pressure,
+        CASE WHEN size(heart_rate) > 0 THEN heart_rate ELSE null END AS heart_rate,
+        CASE WHEN size(temperature) > 0 THEN temperature ELSE null END AS temperature,
+        CASE WHEN size(allergies) > 0 THEN allergies ELSE null END AS allergies,
+        CASE WHEN size(family_history) > 0 THEN family_history ELSE null END AS family_history,
+        CASE WHEN size(lifestyle_factors) > 0 THEN lifestyle_factors ELSE null END AS lifestyle_factors,
+        CASE WHEN size(immunizations) > 0 THEN immunizations ELSE null END AS immunizations,
+        p.store_medication AS store_medication,
+        p.store_appointment AS store_appointment
+    """,
+
+    # Dosages and frequencies of each medication, which every patient taking it
+    # shares (seeds the medication entries of ai_bot.profile_store)
+    "medication_details": """
+    UNWIND $names AS name
+    MATCH (m:Medication {name: name})
+    CALL { WITH m OPTIONAL MATCH (m)-[:HAS_DOSAGE]->(dosage:Dosage) RETURN collect(DISTINCT dosage.value) AS dosages }
+    CALL { WITH m OPTIONAL MATCH (m)-[:HAS_FREQUENCY]->(frequency:Frequency) RETURN collect(DISTINCT frequency.value) AS frequencies }
+    RETURN m.name AS name, dosages, frequencies
+    """,
+
+    "patient_store_flags": """
+    MATCH (n:Patient {name: $name})
+    WHERE n.store_appointment IS NOT NULL OR n.store_medication IS NOT NULL
+    RETURN n.name AS name, n.store_appointment AS store_appointment, n.store_medication AS store_medication
+    """,
+
+    # Patient-scoped reset (KnowledgeGraph.reset_patient), in three statements that
+    # each delete in transactions of $batch_size rows (auto-commit transactions only).
+    # Nodes are MERGEd by value and shared between patients, so their incoming
+    # relationships are their reference count: a node goes when every reference
+    # comes from the patient, and a dosage or frequency when every reference comes
+    # from a medication that goes with it.
+    "reset_patient_nodes": """
+    OPTIONAL MATCH (p:Patient {name: $name})-->(n)
+    WHERE all(source IN [(s)-->(n) | s] WHERE source = p)
+    WITH collect(DISTINCT n) AS owned
+    CALL { WITH owned UNWIND owned AS m MATCH (m)-->(v) RETURN collect(DISTINCT v) AS candidates }
+    UNWIND owned + [v IN candidates WHERE all(source IN [(s)-->(v) | s] WHERE source IN owned)] AS node
+    CALL { WITH node DETACH DELETE node } IN TRANSACTIONS OF $batch_size ROWS
+    RETURN count(*) AS deleted
+    """,
+
+    # What is left of the patient: references to nodes other patients share
+    "reset_patient_relationships": """
+    MATCH (:Patient {name: $name})-[r]->()
+    CALL { WITH r DELETE r } IN TRANSACTIONS OF $batch_size ROWS
+    RETURN count(*) AS deleted
+    """,
+
+    # Move a patient node to a new name (rename_graph_patients): renamed in place,
+    # or merged into the node of that name if the patient already has one
+    "rename_patient": """
+    MATCH (old:Patient {name: $old_name})
+    MERGE (new:Patient {name: $new_name})
+    ON CREATE SET new.store_medication = old.store_medication, new.store_appointment = old.store_appointment
+    WITH old, new
+    CALL { WITH old, new MATCH (old)-[:TAKES]->(n) MERGE (new)-[:TAKES]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS]->(n) MERGE (new)-[:HAS]->(n) }
+    CALL { WITH old, new MATCH (old)-[:SCHEDULES]->(n) MERGE (new)-[:SCHEDULES]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_LAB_TEST]->(n) MERGE (new)-[:HAS_LAB_TEST]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_NOTE]->(n) MERGE (new)-[:HAS_NOTE]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_VITAL]->(n) MERGE (new)-[:HAS_VITAL]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_ALLERGY]->(n) MERGE (new)-[:HAS_ALLERGY]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_FAMILY_HISTORY]->(n) MERGE (new)-[:HAS_FAMILY_HISTORY]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_LIFESTYLE_FACTOR]->(n) MERGE (new)-[:HAS_LIFESTYLE_FACTOR]->(n) }
+    CALL { WITH old, new MATCH (old)-[:HAS_IMMUNIZATION]->(n) MERGE (new)-[:HAS_IMMUNIZATION]->(n) }
+    DETACH DELETE old
+    RETURN count(*) AS renamed
+    """,
+
+    "delete_patient": """
+    MATCH (p:Patient {name: $name})
+    DETACH DELETE p
+    RETURN count(*) AS deleted
+    """,
+}
+
+
+# query name -> [(ProfileStore method, (query parameters passed to it))]
+PROFILE_EFFECTS = {
+    "merge_patient": [('set_flags', ('name', 'store_medication', 'store_appointment'))],
+    "medication_detail_counts": [],
+    "patient_profile": [],
+    "patient_profile_aggregated": [],
+    "medication_details": [],
+    "patient_store_flags": [],
+    # Deletes the medications only this patient took, with their dosages
+    "reset_patient_nodes": [('forget_patient', ('name',))],
+    # Only the patient's own relationships go: shared medication entries stay valid
+    "reset_patient_relationships": [('forget_profile', ('name',))],
+    "rename_patient": [('forget_profile', ('old_name',)), ('forget_profile', ('new_name',))],
+    "delete_patient": [('forget_profile', ('name',))],
+}
+
+
+PreparedQuery = namedtuple('PreparedQuery', ['name', 'text', 'parameters', 'profile_effects'])
+
+_PARAMETER = re.compile(r'\$(\w+)')
+
+
+class QueryCatalog:
+    def __init__(self, queries, profile_effects):
+        self.queries = queries
+        self.profile_effects = profile_effects
+        self._prepared = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, name):
+        text = ' '.join(self.queries[name].split())
+        return PreparedQuery(name, text, frozenset(_PARAMETER.findall(text)), self.profile_effects[name])
+
+    def prepare(self, name):
+        """
+        Return the prepared statement for `name`, compiling it on first use
+        """
+        prepared = self._prepared.get(name)
+        if prepared is None:
+            prepared = self._compile(name)
+            with self._lock:
+                self._prepared[name] = prepared
+        return prepared
+
+    def bind(self, name, params):
+        prepared = self.prepare(name)
+        missing = prepared.parameters - params.keys()
+        if missing:
+            raise ValueError(f"Cypher query '{name}' is missing parameters: {', '.join(sorted(missing))}")
+        return prepared
+
+
+catalog = QueryCatalog(QUERIES, PROFILE_EFFECTS)
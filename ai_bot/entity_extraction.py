@@ -10,20 +10,25 @@ Health Assistant Bot: {'medication': 'lisinopril', 'dosage': 'twice a day', 'fre
 """
 
 import os
-from langchain_openai import ChatOpenAI
+import logging
+import threading
+from collections import namedtuple
+from ai_bot.backends import build_chat_model
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
-from ai_bot.knowledge_graph import KnowledgeGraph
-from ai_bot.prompts import entity_extraction_prompt
+from ai_bot.knowledge_graph import KnowledgeGraph, get_knowledge_graph, owned_node_key
+from ai_bot.graph_writer import GraphBatch
+from ai_bot.prompts import entity_extraction_prompt, targeted_extraction_prompt, QUESTIONS
+from ai_bot.extraction_cache import build_extraction_cache, cache_version
+from ai_bot import instrumentation, llm_usage, rule_extractor  # llm_usage counts the LLM calls per request
+
+logger = logging.getLogger(__name__)
 
 # Load OpenAI API key from environment variable
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# Initialize the LLM
-llm = ChatOpenAI(model="gpt-4o-mini", api_key=OPENAI_API_KEY)
-
 # Define a Pydantic model for the output
 class HealthEntity(BaseModel):
     medications: Optional[str] = Field(None, description="Names of medications, separated by commas if multiple")
@@ -47,50 +52,226 @@ class HealthEntity(BaseModel):
 # Create a JSON output parser with the Pydantic model
 json_parser = JsonOutputParser(pydantic_object=HealthEntity)
 
-
 # Create a chat prompt template
 prompt = ChatPromptTemplate.from_messages([
     ("system", entity_extraction_prompt),
     ("human", "{input}")
 ])
 
-# Create the chain
-chain = prompt | llm | json_parser
+# Answers to a follow-up question: a few fields instead of the whole schema
+targeted_prompt = ChatPromptTemplate.from_messages([
+    ("system", targeted_extraction_prompt),
+    ("human", "{input}")
+])
+
+# The chat model and the chains built on it (plus the cache version they imply)
+# are built on first use, so importing this module does not create an OpenAI client
+ExtractionChains = namedtuple('ExtractionChains', ['llm', 'chain', 'targeted_chain', 'cache_version'])
+
+_chains = None
+_chains_lock = threading.Lock()
+
+def _build_chains(llm):
+    # Anything that changes what the chain extracts invalidates cached extractions;
+    # unnamed models (stubs) only share entries with themselves
+    version = cache_version(entity_extraction_prompt, HealthEntity.model_json_schema(), llm.__class__.__name__,
+                            getattr(llm, 'model_name', None) or id(llm))
+    return ExtractionChains(llm, prompt | llm | json_parser, targeted_prompt | llm | JsonOutputParser(), version)
+
+def get_chains():
+    """
+    Return the shared ExtractionChains, building the chat model on first use
+    """
+    global _chains
+    if _chains is None:
+        with _chains_lock:
+            if _chains is None:
+                _chains = _build_chains(build_chat_model(model="gpt-4o-mini", api_key=OPENAI_API_KEY))
+    return _chains
+
+def set_chat_model(chat_model):
+    """
+    Swap the chat model behind the extraction chains (e.g. for a StubChatModel);
+    None goes back to the configured model, built on next use
+    """
+    global _chains
+    with _chains_lock:
+        _chains = _build_chains(chat_model) if chat_model is not None else None
+
+_extraction_cache = None
+_extraction_cache_lock = threading.Lock()
+_extraction_cache_built = False
+
+def _cache_metric_lines():
+    cache = _extraction_cache
+    return cache.metric_lines() if cache is not None else []
+
+instrumentation.collectors.append(_cache_metric_lines)
+
+def get_extraction_cache():
+    """
+    Return the shared ExtractionCache (None when settings.AI_BOT_EXTRACTION_CACHE is 'off')
+    """
+    global _extraction_cache, _extraction_cache_built
+    if not _extraction_cache_built:
+        with _extraction_cache_lock:
+            if not _extraction_cache_built:
+                _extraction_cache = build_extraction_cache()
+                _extraction_cache_built = True
+    return _extraction_cache
+
+def set_extraction_cache(cache):
+    """
+    Replace the shared ExtractionCache; None disables caching
+    """
+    global _extraction_cache, _extraction_cache_built
+    with _extraction_cache_lock:
+        _extraction_cache, _extraction_cache_built = cache, True
+
+def _to_entities(response: dict) -> dict:
+    # Initialize all fields with None
+    result = {
+        "medications": None,
+        "dosage": None,
+        "frequency": None,
+        "family_history": None,
+        "health_issues": None,
+        "appointment_time": None,
+        "lab_tests": None,
+        "doctor_notes": None,
+        "weight": None,
+        "height": None,
+        "blood_pressure": None,
+        "heart_rate": None,
+        "temperature": None,
+        "allergies": None,
+        "lifestyle_factors": None,
+        "immunizations": None
+    }
+    # Update only the fields that are present in the response
+    for key, value in response.items():
+        if value is not None and value != "":
+            result[key] = value
+    return result
+
+# Extractions answered by rule_extractor vs. handed on to the cache / LLM
+rule_extraction_counts = {'rules': 0, 'fallback': 0}
+
+def _rule_metric_lines():
+    return [
+        "# HELP ai_bot_rule_extractions_total Entity extractions by the rule-based fast path, by result",
+        "# TYPE ai_bot_rule_extractions_total counter",
+    ] + [f'ai_bot_rule_extractions_total{{result="{result}"}} {count}' for result, count in rule_extraction_counts.items()]
+
+instrumentation.collectors.append(_rule_metric_lines)
+
+def rule_entities(user_input: str) -> Optional[dict]:
+    """
+    Entities from the rule-based extractor, or None when it is disabled or
+    not confident enough (settings.AI_BOT_RULE_EXTRACTOR_CONFIDENCE)
+    """
+    from django.conf import settings
+
+    if not settings.AI_BOT_RULE_EXTRACTOR:
+        return None
+    result = rule_extractor.extract(user_input)
+    if not result.confident(settings.AI_BOT_RULE_EXTRACTOR_CONFIDENCE):
+        rule_extraction_counts['fallback'] += 1
+        return None
+    rule_extraction_counts['rules'] += 1
+    return _to_entities(result.entities)
+
+def _cached_extraction(user_input: str, version: str, invoke) -> dict:
+    # Cache lookup, then invoke() (the LLM chain); failed extractions are not cached
+    cache = get_extraction_cache()
+    if cache is not None and (entities := cache.get(user_input, version)) is not None:
+        return entities
 
-def extract_entities(user_input: str) -> dict:
     try:
-        response = chain.invoke({"input": user_input})
-        # Initialize all fields with None
-        result = {
-            "medications": None,
-            "dosage": None,
-            "frequency": None,
-            "family_history": None,
-            "health_issues": None,
-            "appointment_time": None,
-            "lab_tests": None,
-            "doctor_notes": None,
-            "weight": None,
-            "height": None,
-            "blood_pressure": None,
-            "heart_rate": None,
-            "temperature": None,
-            "allergies": None,
-            "lifestyle_factors": None,
-            "immunizations": None
-        }
-        # Update only the fields that are present in the response
-        for key, value in response.items():
-            if value is not None and value != "":
-                result[key] = value
-        return result
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
+        entities = _to_entities(invoke())
+    except Exception:
+        logger.exception("Entity extraction failed")
         return {}
 
-def store_entities_as_documents(entities: Dict[str, Any], patient_name: str):
-    kg = KnowledgeGraph()
+    if cache is not None:
+        cache.set(user_input, version, entities)
+    return entities
+
+async def _acached_extraction(user_input: str, version: str, ainvoke) -> dict:
+    cache = get_extraction_cache()
+    if cache is not None and (entities := await cache.aget(user_input, version)) is not None:
+        return entities
+
+    try:
+        entities = _to_entities(await ainvoke())
+    except Exception:
+        logger.exception("Entity extraction failed")
+        return {}
+
+    if cache is not None:
+        await cache.aset(user_input, version, entities)
+    return entities
+
+def extract_entities(user_input: str) -> dict:
+    if (entities := rule_entities(user_input)) is not None:
+        return entities
+    chains = get_chains()
+    return _cached_extraction(user_input, chains.cache_version, lambda: chains.chain.invoke({"input": user_input}))
+
+async def aextract_entities(user_input: str) -> dict:
+    if (entities := rule_entities(user_input)) is not None:
+        return entities
+    chains = get_chains()
+    return await _acached_extraction(user_input, chains.cache_version, lambda: chains.chain.ainvoke({"input": user_input}))
+
+def answer_field(question: str) -> str:
+    """
+    The HealthEntity field holding the answer to QUESTIONS[question]
+    """
+    return QUESTIONS.get(question, {}).get("fields", [question])[0]
 
+def _targeted(question: str, user_input: str):
+    # (version, chain input, fields) of the targeted extraction for `question`
+    fields = QUESTIONS[question]["fields"]
+    version = cache_version(get_chains().cache_version, targeted_extraction_prompt, question, fields)
+    chain_input = {"question": QUESTIONS[question]["question"], "fields": ", ".join(fields), "input": user_input}
+    return version, chain_input, fields
+
+def extract_answer(user_input: str, question: str) -> dict:
+    """
+    Extract the answer to the follow-up question `question` (a QUESTIONS key):
+    the rule-based parse when it is confident, otherwise an LLM call that
+    only asks for QUESTIONS[question]["fields"]
+    """
+    if "fields" not in QUESTIONS.get(question, {}):
+        return extract_entities(user_input)
+    if (entities := rule_entities(user_input)) is not None:
+        return entities
+
+    version, chain_input, fields = _targeted(question, user_input)
+    return _cached_extraction(user_input, version, lambda: {
+        key: value for key, value in get_chains().targeted_chain.invoke(chain_input).items() if key in fields
+    })
+
+async def aextract_answer(user_input: str, question: str) -> dict:
+    if "fields" not in QUESTIONS.get(question, {}):
+        return await aextract_entities(user_input)
+    if (entities := rule_entities(user_input)) is not None:
+        return entities
+
+    version, chain_input, fields = _targeted(question, user_input)
+
+    async def ainvoke():
+        response = await get_chains().targeted_chain.ainvoke(chain_input)
+        return {key: value for key, value in response.items() if key in fields}
+
+    return await _acached_extraction(user_input, version, ainvoke)
+
+def add_entities_to_graph(kg, entities: Dict[str, Any], patient_name: str):
+    """
+    Map extracted entities onto add_entity / add_relationship calls of `kg`,
+    which is either a KnowledgeGraph or a GraphBatch.
+    """
     # Add patient node
     kg.add_entity('Patient', {'name': patient_name})
 
@@ -135,8 +316,9 @@ def store_entities_as_documents(entities: Dict[str, Any], patient_name: str):
                     kg.add_relationship('Patient', {'name': patient_name}, 'HAS_LAB_TEST', 'LabTest', {'name': test})
             
             elif entity_type == 'doctor_notes':
-                kg.add_entity('DoctorNote', {'content': value})
-                kg.add_relationship('Patient', {'name': patient_name}, 'HAS_NOTE', 'DoctorNote', {'content': value})
+                note = {'key': owned_node_key(patient_name, value), 'content': value}
+                kg.add_entity('DoctorNote', note)
+                kg.add_relationship('Patient', {'name': patient_name}, 'HAS_NOTE', 'DoctorNote', note)
             
             elif entity_type in ['weight', 'height', 'blood_pressure', 'heart_rate', 'temperature']:
                 vital_data = {
@@ -146,6 +328,7 @@ def store_entities_as_documents(entities: Dict[str, Any], patient_name: str):
                     'heart_rate': entities.get('heart_rate') if entities.get('heart_rate') is not None else '',
                     'temperature': entities.get('temperature') if entities.get('temperature') is not None else ''
                 }
+                vital_data = {'key': owned_node_key(patient_name, *vital_data.values()), **vital_data}
                 kg.add_entity('Vital', vital_data)
                 kg.add_relationship('Patient', {'name': patient_name}, 'HAS_VITAL', 'Vital', vital_data)
             
@@ -167,8 +350,33 @@ def store_entities_as_documents(entities: Dict[str, Any], patient_name: str):
                     kg.add_entity('Immunization', {'name': immunization, 'date': ''})  # Date is left empty as it's not provided in the current schema
                     kg.add_relationship('Patient', {'name': patient_name}, 'HAS_IMMUNIZATION', 'Immunization', {'name': immunization})
 
-    # Refresh the schema after adding new entities and relationships
-    kg.refresh_schema()
+def store_entities_as_documents(entities: Dict[str, Any], patient_name: str, kg: Optional[KnowledgeGraph] = None, batched: bool = True):
+    """
+    Store the extracted entities of one turn in the knowledge graph.
+    By default everything is collected into a GraphBatch and written in a single
+    round trip; batched=False issues one query per entity and relationship.
+    """
+    kg = kg or get_knowledge_graph()
+
+    if batched:
+        batch = GraphBatch()
+        add_entities_to_graph(batch, entities, patient_name)
+        kg.write_batch(batch)
+    else:
+        add_entities_to_graph(kg, entities, patient_name)
+
+    # The schema is refreshed lazily before the next kg.ask()
+    kg.mark_schema_stale()
+
+async def astore_entities_as_documents(entities: Dict[str, Any], patient_name: str, kg: Optional[KnowledgeGraph] = None):
+    """
+    Async variant of store_entities_as_documents (always batched)
+    """
+    kg = kg or get_knowledge_graph()
+    batch = GraphBatch()
+    add_entities_to_graph(batch, entities, patient_name)
+    await kg.awrite_batch(batch)
+    kg.mark_schema_stale()
 
 
 
@@ -176,7 +384,7 @@ def store_entities_as_documents(entities: Dict[str, Any], patient_name: str):
 if __name__ == "__main__":
     print("Health Assistant Bot: Hello! How can I assist you with your health-related questions today?")
 
-    kg = KnowledgeGraph()
+    kg = get_knowledge_graph()
     patient_name = "Michael Davidson"  # This should be set dynamically based on the current patient
 
     while True:
@@ -187,6 +395,9 @@ if __name__ == "__main__":
         if user_input.lower().startswith('query:'):
             # If the input starts with 'query:', use it as a direct question for the graph
             question = user_input[6:].strip()
+            if not kg.supports_cypher:
+                print("Health Assistant Bot: Questions about the graph need the Neo4j backend (AI_BOT_GRAPH_BACKEND).")
+                continue
             response = kg.ask(question)
             print(f"Health Assistant Bot: {response['result']}")
         else:
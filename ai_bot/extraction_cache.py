@@ -0,0 +1,317 @@
+"""
+cache for entity-extraction LLM calls
+
+python ai_bot/extraction_cache.py
+
+Extraction only looks at the message itself, so the same normalized message
+always yields the same entities. Lookups go through up to three tiers:
+    1. exact, in-process LRU with a TTL (MemorySessionStore)
+    2. exact, ExtractionCacheEntry rows shared by all workers (optional)
+    3. semantic: the cached message with the most similar embedding, above a
+       cosine-similarity threshold, whose numbers, units and negations are
+       the same (optional, in-process)
+Every entry is keyed on a version hash of the extraction prompt, the
+HealthEntity schema and the model, so changing any of them invalidates the
+cache. Stale rows are removed with `python manage.py clear_extraction_cache`.
+"""
+
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+
+from ai_bot.session_store import MemorySessionStore
+
+TIERS = ('memory', 'db', 'semantic')
+
+# Tokens an embedding barely weighs but the extraction depends on: "200mg" is
+# not "400mg", "twice a day" is not "once a day", "I take" is not "I don't take"
+UNITS = {
+    'mg', 'mcg', 'g', 'kg', 'lb', 'lbs', 'ml', 'l', 'cc', 'iu', 'unit', 'units', 'mmhg', 'bpm', 'cm', 'm', 'ft',
+    '%', 'c', 'f', 'hour', 'hours', 'day', 'days', 'week', 'weeks', 'month', 'months', 'year', 'years',
+}
+COUNTS = {
+    'once', 'twice', 'thrice', 'half', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine',
+    'ten', 'eleven', 'twelve',
+}
+NEGATIONS = {'no', 'not', 'never', 'none', 'nothing', 'without', 'stopped', 'quit', "n't"}
+
+
+def normalize(text):
+    # "Twice a day. " and "twice  a day" are the same answer
+    return re.sub(r'\s+', ' ', text).strip().strip('.!?').strip().lower()
+
+
+def cache_version(*parts):
+    """
+    Short hash of everything that determines the extraction output
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def exact_tokens(normalized):
+    """
+    The numbers, units, counts and negations of a normalized message, in
+    order; a semantic hit must have the same ones
+    """
+    tokens = []
+    for token in re.findall(r"\d+(?:[.,/]\d+)*|[a-z%']+", normalized):
+        if token.endswith("n't"):
+            token = "n't"
+        if token[0].isdigit() or token in UNITS or token in COUNTS or token in NEGATIONS:
+            tokens.append(token)
+    return tuple(tokens)
+
+
+def entry_key(version, normalized):
+    return hashlib.sha256(f'{version}:{normalized}'.encode()).hexdigest()
+
+
+class SemanticIndex:
+    """
+    Embeddings of the last `max_entries` cached messages of one version.
+    Only messages with the same exact_tokens() can match, however similar.
+    """
+
+    def __init__(self, embeddings, threshold=0.97, max_entries=2000):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (version, exact tokens, unit vector, entities)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector):
+        import numpy as np
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _best(self, version, normalized, vector):
+        import numpy as np
+        tokens = exact_tokens(normalized)
+        with self._lock:
+            candidates = [(vec, entities) for v, t, vec, entities in self._entries.values() if v == version and t == tokens]
+        if not candidates:
+            return None
+        scores = np.stack([vec for vec, _ in candidates]) @ vector
+        best = int(scores.argmax())
+        return dict(candidates[best][1]) if scores[best] >= self.threshold else None
+
+    def _add(self, key, version, normalized, vector, entities):
+        with self._lock:
+            self._entries[key] = (version, exact_tokens(normalized), vector, entities)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def lookup(self, version, normalized):
+        """
+        Returns (entities or None, vector); the vector is reused by add()
+        """
+        vector = self._unit(self.embeddings.embed_query(normalized))
+        return self._best(version, normalized, vector), vector
+
+    async def alookup(self, version, normalized):
+        vector = self._unit(await self.embeddings.aembed_query(normalized))
+        return self._best(version, normalized, vector), vector
+
+    def add(self, key, version, normalized, entities, vector=None):
+        if vector is None:
+            vector = self._unit(self.embeddings.embed_query(normalized))
+        self._add(key, version, normalized, vector, entities)
+
+
+class ExtractionCache:
+    """
+    Tiered cache of extract_entities results; `persistent` enables the
+    ExtractionCacheEntry table, `semantic` a SemanticIndex
+    """
+
+    def __init__(self, max_entries=10000, ttl=None, persistent=False, semantic=None):
+        self.memory = MemorySessionStore(max_entries=max_entries, ttl=ttl)
+        self.ttl = ttl
+        self.persistent = persistent
+        self.semantic = semantic
+        self.hits = dict.fromkeys(TIERS, 0)
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._miss_vectors = OrderedDict()  # key -> embedding computed by a missed semantic lookup
+
+    def _remember_vector(self, key, vector):
+        # set() follows a miss almost immediately: don't embed the message twice
+        with self._lock:
+            self._miss_vectors[key] = vector
+            while len(self._miss_vectors) > 1000:
+                self._miss_vectors.popitem(last=False)
+
+    def _miss_vector(self, key):
+        with self._lock:
+            return self._miss_vectors.pop(key, None)
+
+    def _hit(self, tier):
+        with self._lock:
+            if tier is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+
+    # Persistent tier
+
+    @property
+    def model(self):
+        from ai_bot.models import ExtractionCacheEntry
+        return ExtractionCacheEntry
+
+    def _expires_at(self):
+        from django.utils import timezone
+        return timezone.now() + timezone.timedelta(seconds=self.ttl) if self.ttl else None
+
+    def _live(self, key):
+        from django.db.models import Q
+        from django.utils import timezone
+        return self.model.objects.filter(key=key).filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+
+    def _db_get(self, key):
+        return self._live(key).values_list('entities', flat=True).first()
+
+    def _db_set(self, key, version, normalized, entities):
+        self.model.objects.update_or_create(key=key, defaults={
+            'version': version, 'normalized_input': normalized, 'entities': entities, 'expires_at': self._expires_at(),
+        })
+
+    # Lookups
+
+    def get(self, text, version):
+        normalized = normalize(text)
+        key = entry_key(version, normalized)
+
+        entities = self.memory.get(key)
+        if entities is not None:
+            self._hit('memory')
+            return entities
+        if self.persistent:
+            entities = self._db_get(key)
+            if entities is not None:
+                self.memory.set(key, entities)
+                self._hit('db')
+                return entities
+        if self.semantic is not None:
+            entities, vector = self.semantic.lookup(version, normalized)
+            if entities is not None:
+                self._hit('semantic')
+                return entities
+            self._remember_vector(key, vector)
+        self._hit(None)
+        return None
+
+    async def aget(self, text, version):
+        normalized = normalize(text)
+        key = entry_key(version, normalized)
+
+        entities = self.memory.get(key)
+        if entities is not None:
+            self._hit('memory')
+            return entities
+        if self.persistent:
+            entities = await sync_to_async(self._db_get)(key)
+            if entities is not None:
+                self.memory.set(key, entities)
+                self._hit('db')
+                return entities
+        if self.semantic is not None:
+            entities, vector = await self.semantic.alookup(version, normalized)
+            if entities is not None:
+                self._hit('semantic')
+                return entities
+            self._remember_vector(key, vector)
+        self._hit(None)
+        return None
+
+    def set(self, text, version, entities):
+        normalized = normalize(text)
+        key = entry_key(version, normalized)
+        self.memory.set(key, entities)
+        if self.persistent:
+            self._db_set(key, version, normalized, entities)
+        if self.semantic is not None:
+            self.semantic.add(key, version, normalized, entities, self._miss_vector(key))
+
+    async def aset(self, text, version, entities):
+        normalized = normalize(text)
+        key = entry_key(version, normalized)
+        self.memory.set(key, entities)
+        if self.persistent:
+            await sync_to_async(self._db_set)(key, version, normalized, entities)
+        if self.semantic is not None:
+            vector = self._miss_vector(key)
+            if vector is None:
+                vector = self.semantic._unit(await self.semantic.embeddings.aembed_query(normalized))
+            self.semantic.add(key, version, normalized, entities, vector)
+
+    def purge_stale(self, version):
+        """
+        Delete persisted entries of other versions and expired ones
+        """
+        from django.db.models import Q
+        from django.utils import timezone
+        return self.model.objects.filter(~Q(version=version) | Q(expires_at__lte=timezone.now())).delete()[0]
+
+    def stats(self):
+        with self._lock:
+            hits, misses = dict(self.hits), self.misses
+        lookups = sum(hits.values()) + misses
+        memory = self.memory.stats()
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': sum(hits.values()) / lookups if lookups else 0.0,
+            'entries': memory['entries'],
+            'bytes': memory['bytes'],
+            'evictions': memory['evictions'],
+        }
+
+    def metric_lines(self):
+        # Prometheus counters for /metrics (ai_bot.instrumentation.collectors)
+        stats = self.stats()
+        lines = [
+            "# HELP ai_bot_extraction_cache_lookups_total Entity extraction cache lookups by result",
+            "# TYPE ai_bot_extraction_cache_lookups_total counter",
+        ]
+        lines += [f'ai_bot_extraction_cache_lookups_total{{result="{tier}"}} {count}' for tier, count in stats['hits'].items()]
+        lines.append(f'ai_bot_extraction_cache_lookups_total{{result="miss"}} {stats["misses"]}')
+        return lines
+
+
+def build_extraction_cache():
+    """
+    Create the cache configured in settings (AI_BOT_EXTRACTION_CACHE and friends),
+    or None when it is off
+    """
+    from django.conf import settings
+
+    if settings.AI_BOT_EXTRACTION_CACHE == 'off':
+        return None
+    semantic = None
+    if settings.AI_BOT_EXTRACTION_CACHE_SEMANTIC:
+        from langchain_openai import OpenAIEmbeddings
+        semantic = SemanticIndex(OpenAIEmbeddings(), threshold=settings.AI_BOT_EXTRACTION_CACHE_SIMILARITY)
+    return ExtractionCache(
+        max_entries=settings.AI_BOT_EXTRACTION_CACHE_MAX_ENTRIES,
+        ttl=settings.AI_BOT_EXTRACTION_CACHE_TTL or None,
+        persistent=settings.AI_BOT_EXTRACTION_CACHE == 'db',
+        semantic=semantic,
+    )
+
+
+if __name__ == "__main__":
+    cache = ExtractionCache(max_entries=100)
+    version = cache_version("prompt", {"schema": 1})
+    cache.set("Twice a day.", version, {"frequency": "twice a day"})
+    print(cache.get("twice  a day", version), cache.get("twice a day", cache_version("prompt v2")))
+    print(cache.stats())
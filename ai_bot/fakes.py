@@ -0,0 +1,216 @@
+"""
+deterministic stand-ins for the OpenAI chat models and Redis
+
+StubChatModel replies with canned responses after a configurable delay, so
+the agent pipeline can be load tested and benchmarked offline. It also
+streams its reply word by word, for testing the streaming endpoint, and
+reports token usage like the OpenAI models do. With respond=fake_reply it
+answers every prompt of the app plausibly (JSON for the extraction prompts,
+entities found by ai_bot.rule_extractor).
+FakeRedis is an in-process stand-in for the redis-py client used by
+RedisSessionStore.
+"""
+
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+
+FAKE_REPLY = ("Rest the injured area, apply ice for 20 minutes a few times a day, keep it compressed and "
+              "elevated, and see your doctor if the pain or swelling gets worse.")
+
+
+def _fake_entities(text, fields=None):
+    from ai_bot.rule_extractor import extract
+
+    entities = extract(text).entities
+    return {field: entities.get(field) for field in fields} if fields else entities
+
+
+def fake_reply(messages: List[BaseMessage]) -> str:
+    """
+    Deterministic answer to any prompt of the app, for StubChatModel(respond=fake_reply)
+    """
+    system = messages[0].content if messages and messages[0].type == "system" else ""
+    text = messages[-1].content
+    if '"reply":' in system:  # single-shot turn
+        return json.dumps({"reply": FAKE_REPLY, "entities": _fake_entities(text)})
+    if targeted := re.search(r"Extract only these fields from their answer: (.+)\.", system):
+        return json.dumps(_fake_entities(text, targeted.group(1).split(", ")))
+    if "Extract health-related entities" in system:
+        return json.dumps(_fake_entities(text))
+    if "running summary" in text:
+        return "The patient asked about their health and medications."
+    return FAKE_REPLY
+
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model that cycles through `responses` (or calls `respond(messages)`)
+    and waits `latency` seconds per call, like a remote LLM round trip, plus
+    `token_latency` seconds per word after the first one. When streamed,
+    the words arrive `token_latency` seconds apart.
+    """
+
+    responses: List[str] = ["This is a stub response."]
+    respond: Optional[Callable[[List[BaseMessage]], str]] = None
+    latency: float = 0.0
+    token_latency: float = 0.0
+    report_usage: bool = True  # attach usage_metadata (tiktoken counts) to replies
+
+    _cycle: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat-model"
+
+    def _text(self, messages: List[BaseMessage]) -> str:
+        if self.respond is not None:
+            return self.respond(messages)
+        with self._lock:
+            if self._cycle is None:
+                self._cycle = itertools.cycle(self.responses)
+            return next(self._cycle)
+
+    def _message(self, messages: List[BaseMessage], text: str) -> AIMessage:
+        if not self.report_usage:
+            return AIMessage(content=text)
+        from ai_bot.history import count_message_tokens, count_tokens
+
+        usage = {'input_tokens': count_message_tokens(messages), 'output_tokens': count_tokens(text)}
+        return AIMessage(content=text, usage_metadata={**usage, 'total_tokens': sum(usage.values())})
+
+    def _generation_time(self, text: str) -> float:
+        return self.latency + self.token_latency * (len(self._tokens(text)) - 1)
+
+    @staticmethod
+    def _tokens(text: str):
+        words = text.split(" ")
+        return [word if i == len(words) - 1 else word + " " for i, word in enumerate(words)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._text(messages)
+        if delay := self._generation_time(text):
+            time.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, text))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = self._text(messages)
+        if delay := self._generation_time(text):
+            await asyncio.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages, text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        for i, token in enumerate(self._tokens(self._text(messages))):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for i, token in enumerate(self._tokens(self._text(messages))):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+class FakeRedis:
+    """
+    The subset of redis-py used by RedisSessionStore: get, set(ex=, nx=),
+    delete, expire, rpush, lrange, ltrim, dbsize and info('memory'). Values
+    are bytes (or lists of bytes), as with a real server.
+    """
+
+    def __init__(self):
+        self._data = {}  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._data.items() if expires_at is not None and expires_at < now]:
+            del self._data[key]
+
+    @staticmethod
+    def _bytes(value):
+        return value.encode() if isinstance(value, str) else value
+
+    def get(self, name):
+        with self._lock:
+            self._expire()
+            entry = self._data.get(name)
+            return entry[1] if entry else None
+
+    def set(self, name, value, ex=None, nx=False):
+        with self._lock:
+            self._expire()
+            if nx and name in self._data:
+                return None
+            self._data[name] = (time.monotonic() + ex if ex else None, self._bytes(value))
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def expire(self, name, seconds):
+        with self._lock:
+            self._expire()
+            if name not in self._data:
+                return False
+            self._data[name] = (time.monotonic() + seconds, self._data[name][1])
+            return True
+
+    def rpush(self, name, *values):
+        with self._lock:
+            self._expire()
+            expires_at, items = self._data.get(name, (None, []))
+            items = items + [self._bytes(value) for value in values]
+            self._data[name] = (expires_at, items)
+            return len(items)
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            self._expire()
+            items = self._data.get(name, (None, []))[1]
+            return list(items[start:len(items) if end == -1 else end + 1])
+
+    def ltrim(self, name, start, end):
+        with self._lock:
+            self._expire()
+            if name in self._data:
+                expires_at, items = self._data[name]
+                items = items[start:len(items) if end == -1 else end + 1]
+                if items:
+                    self._data[name] = (expires_at, items)
+                else:
+                    del self._data[name]
+            return True
+
+    def dbsize(self):
+        with self._lock:
+            self._expire()
+            return len(self._data)
+
+    def info(self, section=None):
+        with self._lock:
+            return {'used_memory': sum(len(k) + (sum(map(len, v)) if isinstance(v, list) else len(v))
+                                       for k, (_, v) in self._data.items())}
@@ -0,0 +1,605 @@
+"""
+graph backends used by KnowledgeGraph
+
+Neo4jBackend runs Cypher against Neo4j with its own sync and async drivers;
+langchain's Neo4jGraph is only built for the schema and the QA chain of ask().
+InMemoryGraph keeps nodes and relationships in dictionaries so the write path
+can be exercised and benchmarked without a live database.
+
+Only Neo4jBackend executes arbitrary Cypher (query / aquery); callers check
+`executes_cypher` first, and KnowledgeGraph raises CypherNotSupported when
+asked to run Cypher on a backend without it.
+
+Both backends count round trips so the per-entity and batched write paths
+can be compared, and both have async variants (aquery / arun / awrite_batch)
+for the ASGI pipeline.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+import weakref
+
+from ai_bot.instrumentation import collectors, count_round_trip
+
+# (relation, label, [(profile field, node property)]) of the patient-level profile clauses
+PROFILE_CLAUSES = [
+    ('HAS', 'HealthIssue', [('health_issues', 'description')]),
+    ('SCHEDULES', 'Appointment', [('appointment_time', 'time')]),
+    ('HAS_LAB_TEST', 'LabTest', [('lab_tests', 'name')]),
+    ('HAS_NOTE', 'DoctorNote', [('doctor_notes', 'content')]),
+    ('HAS_VITAL', 'Vital', [('weight', 'weight'), ('height', 'height'), ('blood_pressure', 'blood_pressure'), ('heart_rate', 'heart_rate'), ('temperature', 'temperature')]),
+    ('HAS_ALLERGY', 'Allergy', [('allergies', 'name')]),
+    ('HAS_FAMILY_HISTORY', 'FamilyHistory', [('family_history', 'description')]),
+    ('HAS_LIFESTYLE_FACTOR', 'LifestyleFactor', [('lifestyle_factors', 'description')]),
+    ('HAS_IMMUNIZATION', 'Immunization', [('immunizations', 'name')]),
+]
+
+PROFILE_FIELDS = ['medications', 'dosages', 'frequencies'] + [field for _, _, fields in PROFILE_CLAUSES for field, _ in fields]
+
+
+class QueryTextStats:
+    """
+    Distinct Cypher texts sent to Neo4j. Its query cache is keyed on the text,
+    so with $parameters the count levels off at the named queries plus the
+    shapes of the write batches; a count that keeps growing means values are
+    being interpolated into queries. At most `max_texts` are remembered.
+    """
+
+    def __init__(self, max_texts=10000):
+        self.max_texts = max_texts
+        self.executions = 0
+        self._texts = set()  # hashes of the texts seen
+        self._lock = threading.Lock()
+
+    def record(self, text):
+        digest = hash(text)
+        with self._lock:
+            self.executions += 1
+            if len(self._texts) < self.max_texts:
+                self._texts.add(digest)
+
+    def distinct(self):
+        with self._lock:
+            return len(self._texts)
+
+    def metric_lines(self):
+        # Prometheus lines for /metrics (ai_bot.instrumentation.collectors)
+        return [
+            "# HELP ai_bot_cypher_query_texts Distinct Cypher query texts sent to Neo4j by this process",
+            "# TYPE ai_bot_cypher_query_texts gauge",
+            f"ai_bot_cypher_query_texts {self.distinct()}",
+            "# HELP ai_bot_cypher_queries_total Cypher queries sent to Neo4j by this process",
+            "# TYPE ai_bot_cypher_queries_total counter",
+            f"ai_bot_cypher_queries_total {self.executions}",
+        ]
+
+
+query_texts = QueryTextStats()
+collectors.append(query_texts.metric_lines)
+
+
+class CypherNotSupported(Exception):
+    """
+    The graph backend does not execute arbitrary Cypher (InMemoryGraph)
+    """
+
+
+class Neo4jBackend:
+    executes_cypher = True
+    # Every process sees the same graph
+    shared = True
+
+    def __init__(self, uri, auth=None, database='neo4j', driver_config=None):
+        import neo4j
+
+        self.round_trips = 0
+        self.uri = uri
+        self.auth = auth
+        self.database = database
+        self.driver_config = driver_config or {}
+        self.driver = neo4j.GraphDatabase.driver(uri, auth=auth, **self.driver_config)
+        # Async drivers are bound to the event loop that created them
+        self._async_drivers = weakref.WeakKeyDictionary()
+        self._graph = None
+        self._graph_lock = threading.Lock()
+
+    @property
+    def graph(self):
+        """
+        langchain's Neo4jGraph, built on first use: only the schema and the QA chain need it
+        """
+        if self._graph is None:
+            with self._graph_lock:
+                if self._graph is None:
+                    from langchain_community.graphs import Neo4jGraph
+
+                    username, password = self.auth or ('', '')
+                    self._graph = Neo4jGraph(url=self.uri, username=username, password=password, database=self.database,
+                                             refresh_schema=False, driver_config=self.driver_config)
+        return self._graph
+
+    def query(self, query, params=None):
+        self.round_trips += 1
+        count_round_trip()
+        query_texts.record(query)
+        # An auto-commit transaction, as CALL { ... } IN TRANSACTIONS requires
+        with self.driver.session(database=self.database) as session:
+            return [record.data() for record in session.run(query, params or {})]
+
+    def _async_driver(self):
+        loop = asyncio.get_running_loop()
+        driver = self._async_drivers.get(loop)
+        if driver is None:
+            import neo4j
+
+            driver = neo4j.AsyncGraphDatabase.driver(self.uri, auth=self.auth, **self.driver_config)
+            self._async_drivers[loop] = driver
+        return driver
+
+    async def aquery(self, query, params=None):
+        self.round_trips += 1
+        count_round_trip()
+        query_texts.record(query)
+        async with self._async_driver().session(database=self.database) as session:
+            result = await session.run(query, params or {})
+            return [record.data() async for record in result]
+
+    def merge_node(self, label, properties):
+        query = f"""
+        MERGE (e:{label} {{{', '.join(f'{k}: ${k}' for k in properties.keys())}}})
+        """
+        self.query(query, properties)
+
+    def merge_relationship(self, start_label, start_props, relation, end_label, end_props):
+        query = f"""
+        MATCH (a:{start_label} {{{', '.join(f'{k}: ${k}1' for k in start_props.keys())}}})
+        MATCH (b:{end_label} {{{', '.join(f'{k}: ${k}2' for k in end_props.keys())}}})
+        MERGE (a)-[:{relation}]->(b)
+        """
+        params = {f"{k}1": v for k, v in start_props.items()}
+        params.update({f"{k}2": v for k, v in end_props.items()})
+        self.query(query, params)
+
+    def write_batch(self, batch):
+        """
+        Write a whole GraphBatch as a single parameterized statement
+        """
+        if batch:
+            self.query(batch.to_cypher(), batch.parameters())
+
+    async def awrite_batch(self, batch):
+        if batch:
+            await self.aquery(batch.to_cypher(), batch.parameters())
+
+    def run(self, prepared, params):
+        """
+        Run a prepared statement from ai_bot.cypher_queries
+        """
+        return self.query(prepared.text, params)
+
+    @staticmethod
+    def _index_name(label, keys, kind):
+        name = '_'.join([label.lower(), *keys])
+        return f'{name}_{kind}' if kind != 'range' else name
+
+    def create_index(self, label, keys, kind='range'):
+        """
+        Create a uniqueness constraint, range index or text index (one key) on
+        label(keys) unless it exists
+        """
+        name = self._index_name(label, keys, kind)
+        properties = ', '.join(f'n.{key}' for key in keys)
+        if kind == 'unique':
+            self.query(f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE ({properties}) IS UNIQUE")
+        elif kind == 'text':
+            self.query(f"CREATE TEXT INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({properties})")
+        else:
+            self.query(f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({properties})")
+
+    def drop_index(self, label, keys, kind='range'):
+        name = self._index_name(label, keys, kind)
+        self.query(f"DROP {'CONSTRAINT' if kind == 'unique' else 'INDEX'} {name} IF EXISTS")
+
+    def create_nodes(self, label, rows):
+        """
+        CREATE a node per row without matching first (bulk loads)
+        """
+        self.query(f"UNWIND $rows AS row CREATE (n:{label}) SET n = row", {'rows': rows})
+
+    async def arun(self, prepared, params):
+        return await self.aquery(prepared.text, params)
+
+    def clear(self):
+        self.query("MATCH (n) DETACH DELETE n")
+
+    def refresh_schema(self):
+        self.graph.refresh_schema()
+
+    def verify_connectivity(self):
+        # Opens a pooled connection and fails fast when Neo4j is unreachable
+        self.driver.verify_connectivity()
+
+    def close(self):
+        # Neo4jGraph has no close(): its driver is released with it
+        self.driver.close()
+        for loop, driver in list(self._async_drivers.items()):
+            self._close_async_driver(loop, driver)
+        self._async_drivers.clear()
+
+    @staticmethod
+    def _close_async_driver(loop, driver):
+        # On the driver's own loop; a closed loop has already dropped its connections
+        if loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            loop.create_task(driver.close())
+        elif loop.is_running():
+            asyncio.run_coroutine_threadsafe(driver.close(), loop).result()
+        else:
+            loop.run_until_complete(driver.close())
+
+    @property
+    def schema(self):
+        return self.graph.schema
+
+
+class InMemoryGraph:
+    """
+    Dictionary-backed stand-in for Neo4j.
+
+    Supports the structured write methods and the named queries of
+    ai_bot.cypher_queries; arbitrary Cypher is not interpreted.
+    `latency` is the simulated network cost (in seconds) of one round trip.
+    """
+
+    graph = None
+    shared = False  # per process
+    executes_cypher = False  # no query(): only the structured methods and named queries
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.nodes = {}  # label -> {node_id: props}
+        self.relationships = set()  # (start_id, relation, end_id)
+        self._outgoing = {}  # start_id -> {(relation, end_id)}
+        self._incoming = {}  # end_id -> {(relation, start_id)}
+        self._indexes = {}  # label -> {keys: {values: {node_id: None}}}
+        self._next_id = 0
+        self.last_row_count = 0  # intermediate rows produced by the last profile query
+        self._lock = threading.RLock()
+
+    def _round_trip(self):
+        self.round_trips += 1
+        count_round_trip()
+        if self.latency:
+            time.sleep(self.latency)
+
+    async def _around_trip(self):
+        self.round_trips += 1
+        count_round_trip()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _match(self, label, properties):
+        nodes = self.nodes.get(label, {})
+        # Like Neo4j, look the node up in an index on some of the properties, or scan the label
+        for keys, index in self._indexes.get(label, {}).items():
+            if all(key in properties for key in keys):
+                candidates = index.get(tuple(properties[key] for key in keys), ())
+                break
+        else:
+            candidates = nodes
+        return [
+            node_id for node_id in candidates
+            if all(nodes[node_id].get(k) == v for k, v in properties.items())
+        ]
+
+    def _index_node(self, label, node_id):
+        props = self.nodes[label][node_id]
+        for keys, index in self._indexes.get(label, {}).items():
+            index.setdefault(tuple(props.get(key) for key in keys), {})[node_id] = None
+
+    def _create_node(self, label, properties):
+        node_id = self._next_id
+        self._next_id += 1
+        self.nodes.setdefault(label, {})[node_id] = dict(properties)
+        self._index_node(label, node_id)
+        return node_id
+
+    def _merge_node(self, label, properties):
+        matches = self._match(label, properties)
+        if matches:
+            return matches[0]
+        return self._create_node(label, properties)
+
+    def _merge_relationship(self, start_label, start_props, relation, end_label, end_props):
+        for start in self._match(start_label, start_props):
+            for end in self._match(end_label, end_props):
+                self.relationships.add((start, relation, end))
+                self._outgoing.setdefault(start, set()).add((relation, end))
+                self._incoming.setdefault(end, set()).add((relation, start))
+
+    def _related_ids(self, node_id, relation, label):
+        targets = self.nodes.get(label, {})
+        return [end for rel, end in self._outgoing.get(node_id, ()) if rel == relation and end in targets]
+
+    def _related(self, node_id, relation, label):
+        return [self.nodes[label][end] for end in self._related_ids(node_id, relation, label)]
+
+    def _sources(self, node_id):
+        return {start for _, start in self._incoming.get(node_id, ())}
+
+    def _delete_relationship(self, start, relation, end):
+        self.relationships.discard((start, relation, end))
+        self._outgoing.get(start, set()).discard((relation, end))
+        self._incoming.get(end, set()).discard((relation, start))
+
+    def _delete_node(self, node_id):
+        # DETACH DELETE
+        for relation, end in list(self._outgoing.pop(node_id, ())):
+            self._delete_relationship(node_id, relation, end)
+        for relation, start in list(self._incoming.pop(node_id, ())):
+            self._delete_relationship(start, relation, node_id)
+        for label, nodes in self.nodes.items():
+            props = nodes.pop(node_id, None)
+            if props is not None:
+                for keys, index in self._indexes.get(label, {}).items():
+                    index.get(tuple(props.get(key) for key in keys), {}).pop(node_id, None)
+
+    def merge_node(self, label, properties):
+        self._round_trip()
+        with self._lock:
+            self._merge_node(label, properties)
+
+    def merge_relationship(self, start_label, start_props, relation, end_label, end_props):
+        self._round_trip()
+        with self._lock:
+            self._merge_relationship(start_label, start_props, relation, end_label, end_props)
+
+    def _write_batch(self, batch):
+        with self._lock:
+            for label, properties in batch.iter_nodes():
+                self._merge_node(label, properties)
+            for relationship in batch.iter_relationships():
+                self._merge_relationship(*relationship)
+
+    def write_batch(self, batch):
+        if batch:
+            self._round_trip()
+            self._write_batch(batch)
+
+    async def awrite_batch(self, batch):
+        if batch:
+            await self._around_trip()
+            self._write_batch(batch)
+
+    def create_index(self, label, keys, kind='range'):
+        """
+        Index label(keys) for _match (every kind is an equality index here); a
+        unique index refuses to build over duplicates, like a constraint
+        """
+        self._round_trip()
+        with self._lock:
+            if tuple(keys) in self._indexes.get(label, {}):
+                return
+            index = {}
+            for node_id, props in self.nodes.get(label, {}).items():
+                index.setdefault(tuple(props.get(key) for key in keys), {})[node_id] = None
+            if kind == 'unique' and any(len(node_ids) > 1 for node_ids in index.values()):
+                raise ValueError(f"{label} nodes are not unique on {', '.join(keys)}")
+            self._indexes.setdefault(label, {})[tuple(keys)] = index
+
+    def drop_index(self, label, keys, kind='range'):
+        self._round_trip()
+        with self._lock:
+            self._indexes.get(label, {}).pop(tuple(keys), None)
+
+    def create_nodes(self, label, rows):
+        self._round_trip()
+        with self._lock:
+            for properties in rows:
+                self._create_node(label, properties)
+
+    def _run(self, prepared, params):
+        with self._lock:
+            return getattr(self, f"_query_{prepared.name}")(**params)
+
+    def run(self, prepared, params):
+        """
+        Answer a named query from ai_bot.cypher_queries natively
+        """
+        self._round_trip()
+        return self._run(prepared, params)
+
+    async def arun(self, prepared, params):
+        await self._around_trip()
+        return self._run(prepared, params)
+
+    def _query_merge_patient(self, name, store_medication, store_appointment):
+        node_id = self._merge_node('Patient', {'name': name})
+        self.nodes['Patient'][node_id].update(store_medication=store_medication, store_appointment=store_appointment)
+        return []
+
+    def _query_medication_detail_counts(self, name, medication):
+        rows = []
+        for patient in self._match('Patient', {'name': name}):
+            for med in self._related_ids(patient, 'TAKES', 'Medication'):
+                if self.nodes['Medication'][med].get('name') == medication:
+                    dosages = len(self._related(med, 'HAS_DOSAGE', 'Dosage'))
+                    frequencies = len(self._related(med, 'HAS_FREQUENCY', 'Frequency'))
+                    # OPTIONAL MATCH rows multiply, and COUNT() ignores the null side
+                    rows.append((dosages * max(frequencies, 1), frequencies * max(dosages, 1)))
+        return [{
+            'dosage_count': sum(d for d, _ in rows),
+            'frequency_count': sum(f for _, f in rows),
+        }]
+
+    def _profile_clauses(self, patient):
+        """
+        Matched node ids for each OPTIONAL MATCH of the profile query, in query order
+        """
+        medications = self._related_ids(patient, 'TAKES', 'Medication')
+        per_medication = [
+            (m, d, f)
+            for m in medications or [None]
+            for d in (self._related_ids(m, 'HAS_DOSAGE', 'Dosage') if m is not None else []) or [None]
+            for f in (self._related_ids(m, 'HAS_FREQUENCY', 'Frequency') if m is not None else []) or [None]
+        ]
+        others = [self._related_ids(patient, relation, label) for relation, label, _ in PROFILE_CLAUSES]
+        return per_medication, others
+
+    def _collect(self, values, label, fields, node_id):
+        if node_id is not None:
+            props = self.nodes[label][node_id]
+            for field, prop in fields:
+                values[field].setdefault(props.get(prop))
+
+    def _profile_record(self, values):
+        """
+        An empty collection becomes None, like the CASE expressions of the profile query
+        """
+        return {field: [v for v in collected if v is not None] or None for field, collected in values.items()}
+
+    def _collect_medication(self, values, row):
+        m, d, f = row
+        self._collect(values, 'Medication', [('medications', 'name')], m)
+        self._collect(values, 'Dosage', [('dosages', 'value')], d)
+        self._collect(values, 'Frequency', [('frequencies', 'value')], f)
+
+    def _query_patient_profile(self, name):
+        patients = self._match('Patient', {'name': name})
+        if not patients:
+            return []
+        per_medication, others = self._profile_clauses(patients[0])
+        values = {field: {} for field in PROFILE_FIELDS}
+        # The chained OPTIONAL MATCHes produce the cartesian product of every clause
+        self.last_row_count = 0
+        for medication_row, *other_ids in itertools.product(per_medication, *(ids or [None] for ids in others)):
+            self.last_row_count += 1
+            self._collect_medication(values, medication_row)
+            for node_id, (_, label, fields) in zip(other_ids, PROFILE_CLAUSES):
+                self._collect(values, label, fields, node_id)
+        return [self._profile_record(values)]
+
+    def _query_patient_profile_aggregated(self, name):
+        patients = self._match('Patient', {'name': name})
+        if not patients:
+            return []
+        per_medication, others = self._profile_clauses(patients[0])
+        values = {field: {} for field in PROFILE_FIELDS}
+        # Each CALL {} subquery only sees the rows of its own relationship
+        self.last_row_count = len(per_medication) + sum(len(ids) for ids in others)
+        for medication_row in per_medication:
+            self._collect_medication(values, medication_row)
+        for ids, (_, label, fields) in zip(others, PROFILE_CLAUSES):
+            for node_id in ids:
+                self._collect(values, label, fields, node_id)
+        record = self._profile_record(values)
+        props = self.nodes['Patient'][patients[0]]
+        record.update(store_medication=props.get('store_medication'), store_appointment=props.get('store_appointment'))
+        return [record]
+
+    def _query_medication_details(self, names):
+        rows = []
+        for name in names:
+            for med in self._match('Medication', {'name': name}):
+                rows.append({
+                    'name': name,
+                    'dosages': list(dict.fromkeys(d['value'] for d in self._related(med, 'HAS_DOSAGE', 'Dosage'))),
+                    'frequencies': list(dict.fromkeys(f['value'] for f in self._related(med, 'HAS_FREQUENCY', 'Frequency'))),
+                })
+        return rows
+
+    def _query_rename_patient(self, old_name, new_name):
+        renamed = 0
+        for old in self._match('Patient', {'name': old_name}):
+            existing = self._match('Patient', {'name': new_name})
+            new = existing[0] if existing else self._create_node('Patient', {**self.nodes['Patient'][old], 'name': new_name})
+            for relation, end in list(self._outgoing.get(old, ())):
+                self.relationships.add((new, relation, end))
+                self._outgoing.setdefault(new, set()).add((relation, end))
+                self._incoming.setdefault(end, set()).add((relation, new))
+            self._delete_node(old)
+            renamed += 1
+        return [{'renamed': renamed}]
+
+    def _query_patient_store_flags(self, name):
+        return [
+            {'name': props['name'], 'store_appointment': props.get('store_appointment'), 'store_medication': props.get('store_medication')}
+            for props in (self.nodes['Patient'][node_id] for node_id in self._match('Patient', {'name': name}))
+            if props.get('store_appointment') is not None or props.get('store_medication') is not None
+        ]
+
+    # Patient-scoped reset; batch_size only matters to Neo4j, whose transactions it bounds
+
+    def _query_reset_patient_nodes(self, name, batch_size):
+        deleted = 0
+        for patient in self._match('Patient', {'name': name}):
+            owned = {end for _, end in self._outgoing.get(patient, ()) if self._sources(end) == {patient}}
+            values = {value for node_id in owned for _, value in self._outgoing.get(node_id, ())
+                      if self._sources(value) <= owned}
+            for node_id in owned | values:
+                self._delete_node(node_id)
+            deleted += len(owned | values)
+        return [{'deleted': deleted}]
+
+    def _query_reset_patient_relationships(self, name, batch_size):
+        deleted = 0
+        for patient in self._match('Patient', {'name': name}):
+            for relation, end in list(self._outgoing.get(patient, ())):
+                self._delete_relationship(patient, relation, end)
+                deleted += 1
+        return [{'deleted': deleted}]
+
+    def _query_delete_patient(self, name, batch_size=None):
+        patients = self._match('Patient', {'name': name})
+        for patient in patients:
+            self._delete_node(patient)
+        return [{'deleted': len(patients)}]
+
+    def clear(self):
+        self._round_trip()
+        with self._lock:
+            self.nodes.clear()
+            self.relationships.clear()
+            self._outgoing.clear()
+            self._incoming.clear()
+            # Indexes outlive the nodes, as in Neo4j
+            for indexes in self._indexes.values():
+                for index in indexes.values():
+                    index.clear()
+
+    def node_count(self):
+        return sum(len(nodes) for nodes in self.nodes.values())
+
+    def snapshot(self):
+        """
+        Id-independent view of the graph, for comparing two graphs
+        """
+        def node(node_id):
+            for label, nodes in self.nodes.items():
+                if node_id in nodes:
+                    return (label, frozenset(nodes[node_id].items()))
+
+        nodes = {(label, frozenset(props.items())) for label, group in self.nodes.items() for props in group.values()}
+        relationships = {(node(start), relation, node(end)) for start, relation, end in self.relationships}
+        return nodes, relationships
+
+    def refresh_schema(self):
+        pass
+
+    def verify_connectivity(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def schema(self):
+        return ""
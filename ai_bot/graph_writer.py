@@ -0,0 +1,71 @@
+"""
+batched knowledge graph writes
+
+GraphBatch collects the add_entity / add_relationship calls of one turn
+(it exposes the same two methods as KnowledgeGraph) and renders them as a
+single UNWIND-based Cypher statement, so a turn costs one round trip instead
+of one per entity and relationship.
+"""
+
+
+class GraphBatch:
+    def __init__(self):
+        # (label, keys) -> {frozenset(props.items()): props}
+        self.nodes = {}
+        # (start_label, start_keys, relation, end_label, end_keys) -> {(start, end): row}
+        self.relationships = {}
+
+    def __bool__(self):
+        return bool(self.nodes or self.relationships)
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.nodes.values()) + sum(len(rows) for rows in self.relationships.values())
+
+    def add_entity(self, label, properties):
+        group = self.nodes.setdefault((label, tuple(properties.keys())), {})
+        group.setdefault(frozenset(properties.items()), dict(properties))
+
+    def add_relationship(self, start_label, start_props, relation, end_label, end_props):
+        group_key = (start_label, tuple(start_props.keys()), relation, end_label, tuple(end_props.keys()))
+        group = self.relationships.setdefault(group_key, {})
+        row_key = (frozenset(start_props.items()), frozenset(end_props.items()))
+        group.setdefault(row_key, {"start": dict(start_props), "end": dict(end_props)})
+
+    def iter_nodes(self):
+        for (label, _), rows in self.nodes.items():
+            for properties in rows.values():
+                yield label, properties
+
+    def iter_relationships(self):
+        for (start_label, _, relation, end_label, _), rows in self.relationships.items():
+            for row in rows.values():
+                yield start_label, row["start"], relation, end_label, row["end"]
+
+    def parameters(self):
+        params = {}
+        for i, rows in enumerate(self.nodes.values()):
+            params[f"nodes_{i}"] = list(rows.values())
+        for i, rows in enumerate(self.relationships.values()):
+            params[f"rels_{i}"] = list(rows.values())
+        return params
+
+    def to_cypher(self):
+        """
+        Render the batch as one statement of unit CALL {} subqueries.
+        Labels and relationship types cannot be parameterized, so there is one
+        subquery per (label, property keys) group; the values are all parameters.
+        """
+        clauses = []
+        for i, (label, keys) in enumerate(self.nodes):
+            props = ', '.join(f'{k}: row.{k}' for k in keys)
+            clauses.append(f"CALL {{ UNWIND $nodes_{i} AS row MERGE (:{label} {{{props}}}) }}")
+        for i, (start_label, start_keys, relation, end_label, end_keys) in enumerate(self.relationships):
+            start = ', '.join(f'{k}: row.start.{k}' for k in start_keys)
+            end = ', '.join(f'{k}: row.end.{k}' for k in end_keys)
+            clauses.append(
+                f"CALL {{ UNWIND $rels_{i} AS row "
+                f"MATCH (a:{start_label} {{{start}}}) "
+                f"MATCH (b:{end_label} {{{end}}}) "
+                f"MERGE (a)-[:{relation}]->(b) }}"
+            )
+        return "\n".join(clauses)
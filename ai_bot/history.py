@@ -0,0 +1,248 @@
+"""
+token-budgeted chat history
+
+python ai_bot/history.py
+
+WindowedChatMessageHistory keeps the most recent turns of a session within a
+token budget (counted with tiktoken) and folds the turns that fall out of the
+window into a rolling summary, which is sent ahead of the window as a system
+message. Prompt tokens stop growing with the length of the conversation;
+prompt_token_stats records the size of every chat prompt so that shows up,
+and history_tokens the size of the window and summary kept after each turn
+(both served at /metrics).
+"""
+
+import logging
+import threading
+from collections import deque
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, SystemMessage, messages_from_dict, messages_to_dict
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+
+from ai_bot import instrumentation
+from ai_bot.prompts import history_summary_prompt
+from ai_bot.session_store import StoredChatMessageHistory, history_key
+
+logger = logging.getLogger(__name__)
+
+ENCODING_MODEL = 'gpt-4o-mini'
+MESSAGE_OVERHEAD = 4  # tokens per chat message for role and separators
+SUMMARY_PREFIX = 'Summary of the earlier conversation: '
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _encode(text):
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                import tiktoken
+                try:
+                    _encoding = tiktoken.encoding_for_model(ENCODING_MODEL)
+                except Exception:  # the BPE file is downloaded on first use
+                    logger.warning("tiktoken encoding for %s unavailable, estimating 4 characters per token", ENCODING_MODEL)
+                    _encoding = False
+    if _encoding is False:
+        return range((len(text) + 3) // 4)
+    return _encoding.encode(text)
+
+
+def count_tokens(text):
+    return len(_encode(text))
+
+
+def count_message_tokens(messages):
+    return sum(MESSAGE_OVERHEAD + count_tokens(message.content if isinstance(message.content, str) else str(message.content))
+               for message in messages)
+
+
+class PromptTokenStats:
+    """
+    Prompt size of every chat call: totals plus the most recent `window` calls
+    """
+
+    def __init__(self, window=1000):
+        self.calls = 0
+        self.total = 0
+        self.max = 0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, tokens):
+        with self._lock:
+            self.calls += 1
+            self.total += tokens
+            self.max = max(self.max, tokens)
+            self.recent.append(tokens)
+
+    def reset(self):
+        with self._lock:
+            self.calls = self.total = self.max = 0
+            self.recent.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'total': self.total,
+                'mean': self.total / self.calls if self.calls else 0.0,
+                'max': self.max,
+                'last': self.recent[-1] if self.recent else 0,
+            }
+
+    def metric_lines(self):
+        # Prometheus summary and gauge for /metrics (ai_bot.instrumentation.collectors)
+        stats = self.snapshot()
+        return [
+            "# HELP ai_bot_prompt_tokens Tokens of each chat prompt",
+            "# TYPE ai_bot_prompt_tokens summary",
+            f"ai_bot_prompt_tokens_sum {stats['total']}",
+            f"ai_bot_prompt_tokens_count {stats['calls']}",
+            "# HELP ai_bot_prompt_tokens_max Tokens of the largest chat prompt",
+            "# TYPE ai_bot_prompt_tokens_max gauge",
+            f"ai_bot_prompt_tokens_max {stats['max']}",
+        ]
+
+
+prompt_token_stats = PromptTokenStats()
+
+# Tokens of the history kept after each turn, by part ('window' or 'summary')
+history_tokens = instrumentation.Histogram('ai_bot_history_tokens', 'Tokens of the chat history kept after a turn',
+                                           instrumentation.TOKEN_BUCKETS, ['part'])
+
+
+def _history_metric_lines():
+    return prompt_token_stats.metric_lines() + history_tokens.render()
+
+
+instrumentation.collectors.append(_history_metric_lines)
+
+
+class PromptTokenCounter(BaseCallbackHandler):
+    """
+    Callback that records the token count of each chat prompt in `stats`
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats or prompt_token_stats
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        for prompt in messages:
+            self.stats.record(count_message_tokens(prompt))
+
+
+prompt_token_counter = PromptTokenCounter()
+
+
+def _transcript(messages):
+    return "\n".join(f"{'patient' if isinstance(m, HumanMessage) else 'assistant'}: {m.content}" for m in messages)
+
+
+def _summary_chain():
+    # Resolved on each call so langchain_integration.set_chat_model applies here too
+    from ai_bot import langchain_integration
+    return PromptTemplate.from_template(history_summary_prompt) | langchain_integration.get_chains().llm | StrOutputParser()
+
+
+# Detached from the caller's callbacks: the summary must not be streamed to the
+# patient or counted as a chat prompt
+SUMMARY_CONFIG = {'callbacks': [], 'run_name': 'history_summary'}
+
+
+def summarize(summary, messages):
+    variables = {'summary': summary or '(none)', 'messages': _transcript(messages)}
+    return _summary_chain().invoke(variables, config=SUMMARY_CONFIG).strip()
+
+
+async def asummarize(summary, messages):
+    variables = {'summary': summary or '(none)', 'messages': _transcript(messages)}
+    return (await _summary_chain().ainvoke(variables, config=SUMMARY_CONFIG)).strip()
+
+
+class WindowedChatMessageHistory(StoredChatMessageHistory):
+    """
+    Chat history holding at most `max_tokens` of recent messages. When a new
+    turn overflows the budget, the oldest turns are evicted down to
+    `low_water` of it (so the summary is updated every few turns, not every
+    turn) and, if `keep_summary` is set, folded into the rolling summary.
+    """
+
+    def __init__(self, session_id, store=None, max_tokens=None, keep_summary=None, low_water=0.75):
+        from django.conf import settings
+
+        super().__init__(session_id, store)
+        self.max_tokens = max_tokens or settings.AI_BOT_HISTORY_MAX_TOKENS
+        self.keep_summary = settings.AI_BOT_HISTORY_SUMMARY if keep_summary is None else keep_summary
+        self.low_water = low_water
+
+    def _messages(self, history):
+        messages = messages_from_dict(history['messages'])
+        if history['summary']:
+            messages.insert(0, SystemMessage(content=SUMMARY_PREFIX + history['summary']))
+        return messages
+
+    def _evicted(self, history):
+        """
+        The oldest messages to drop while over budget, and the tokens of the window left
+        """
+        window = messages_from_dict(history['messages'])
+        counts = [count_message_tokens([message]) for message in window]
+        if sum(counts) <= self.max_tokens:
+            return [], sum(counts)
+
+        target, total, cut = self.max_tokens * self.low_water, sum(counts), 0
+        while cut < len(window) - 1 and total > target:
+            total -= counts[cut]
+            cut += 1
+        # Keep whole turns: the window starts at a patient message
+        while cut < len(window) - 1 and not isinstance(window[cut], HumanMessage):
+            cut += 1
+        return history['messages'][:cut], sum(counts[cut:])
+
+    def _observe(self, window_tokens, summary):
+        history_tokens.observe(window_tokens, part='window')
+        history_tokens.observe(count_tokens(summary) if summary else 0, part='summary')
+
+    @property
+    def messages(self):
+        return self._messages(self.store.get_history(history_key(self.session_id)))
+
+    async def aget_messages(self):
+        return self._messages(await self.store.aget_history(history_key(self.session_id)))
+
+    def add_messages(self, messages):
+        history = self.store.append_messages(history_key(self.session_id), messages_to_dict(messages))
+        evicted, window_tokens = self._evicted(history)
+        summary = history['summary']
+        if evicted:
+            if self.keep_summary:
+                try:
+                    summary = summarize(summary, messages_from_dict(evicted))
+                except Exception:
+                    logger.exception("Could not update the history summary of %s", self.session_id)
+            # False when a concurrent turn folded first: these messages are evicted on the next turn
+            self.store.fold_messages(history_key(self.session_id), evicted, history['summary'], summary)
+        self._observe(window_tokens, summary)
+
+    async def aadd_messages(self, messages):
+        history = await self.store.aappend_messages(history_key(self.session_id), messages_to_dict(messages))
+        evicted, window_tokens = self._evicted(history)
+        summary = history['summary']
+        if evicted:
+            if self.keep_summary:
+                try:
+                    summary = await asummarize(summary, messages_from_dict(evicted))
+                except Exception:
+                    logger.exception("Could not update the history summary of %s", self.session_id)
+            await self.store.afold_messages(history_key(self.session_id), evicted, history['summary'], summary)
+        self._observe(window_tokens, summary)
+
+
+if __name__ == "__main__":
+    from langchain_core.messages import AIMessage
+
+    print(count_message_tokens([HumanMessage(content="I take 10mg of lisinopril twice a day."), AIMessage(content="Thanks, noted.")]))
@@ -0,0 +1,333 @@
+"""
+per-request instrumentation: wall time, LLM tokens, Cypher round trips and
+ORM queries, broken down by agent graph node
+
+python ai_bot/instrumentation.py
+
+InstrumentationMiddleware opens a RequestMetrics for every request. While it
+is current, the counters are fed by:
+    - ai_bot.tracing.traced: wall time of each graph node
+    - ai_bot.llm_usage (a LangChain configure hook): calls and tokens of every LLM call
+    - the graph backends: count_round_trip() on every Cypher round trip
+    - a database execute wrapper: every ORM query
+At the end of the request they go to the Server-Timing and X-AI-Bot-Metrics
+headers, a JSON log line on the 'ai_bot.metrics' logger and the histograms
+served at /metrics (Prometheus text format).
+"""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from ai_bot import tracing
+
+logger = logging.getLogger('ai_bot.metrics')
+
+COUNTERS = ('llm_calls', 'prompt_tokens', 'completion_tokens', 'cypher_round_trips', 'db_queries')
+OUTSIDE_GRAPH = 'request'  # node name for work done outside the agent graph
+
+_current_metrics = contextvars.ContextVar('ai_bot_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """
+    Counters of one request, per graph node
+    """
+
+    def __init__(self, view=None):
+        self.view = view
+        self.start = time.perf_counter()
+        self.wall_ms = None
+        self.nodes = {}  # node -> {'wall_ms', *COUNTERS}
+        self._lock = threading.Lock()
+
+    def add(self, counter, value=1, node=None):
+        node = node or tracing.current_node() or OUTSIDE_GRAPH
+        with self._lock:
+            counters = self.nodes.setdefault(node, dict.fromkeys(('wall_ms',) + COUNTERS, 0))
+            counters[counter] += value
+
+    def finish(self):
+        if self.wall_ms is None:
+            self.wall_ms = (time.perf_counter() - self.start) * 1000
+
+    def totals(self):
+        with self._lock:
+            return {counter: sum(node[counter] for node in self.nodes.values()) for counter in COUNTERS}
+
+    def as_dict(self):
+        with self._lock:
+            nodes = {node: dict(counters) for node, counters in self.nodes.items()}
+        return {'view': self.view, 'wall_ms': round(self.wall_ms or 0, 1), **self.totals(), 'nodes': nodes}
+
+    def server_timing(self):
+        with self._lock:
+            entries = [f"{node};dur={c['wall_ms']:.1f}" for node, c in self.nodes.items() if node != OUTSIDE_GRAPH]
+        return ", ".join([f"total;dur={self.wall_ms or 0:.1f}"] + entries)
+
+    def summary_header(self):
+        return "; ".join(f"{counter}={value}" for counter, value in self.totals().items())
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+def count(counter, value=1):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add(counter, value)
+
+
+def count_round_trip():
+    count('cypher_round_trips')
+
+
+def _record_span(node, ms):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add('wall_ms', ms, node=node)
+
+
+tracing.span_hooks.append(_record_span)
+
+
+def begin(view=None):
+    """
+    Make a new RequestMetrics current (for this context and the tasks and
+    threads it starts); returns it with the token end() needs
+    """
+    metrics = RequestMetrics(view)
+    return metrics, _current_metrics.set(metrics)
+
+
+def end(token):
+    _current_metrics.reset(token)
+
+
+def _activate(metrics):
+    # For streamed responses, whose content is produced after the view returned
+    _current_metrics.set(metrics)
+
+
+def count_queries(execute, sql, params, many, context):
+    count('db_queries')
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender=None, connection=None, **kwargs):
+    """
+    connection_created receiver: count every query run on the connection
+    """
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+# Histograms
+
+class Histogram:
+    """
+    Cumulative-bucket histogram with labels, rendered in Prometheus text format
+    """
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-1]}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+MS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+TOKEN_BUCKETS = (0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+request_duration = Histogram('ai_bot_request_duration_ms', 'Wall time of a request', MS_BUCKETS, ['view'])
+node_duration = Histogram('ai_bot_node_duration_ms', 'Wall time of an agent graph node', MS_BUCKETS, ['node'])
+llm_calls = Histogram('ai_bot_llm_calls', 'LLM calls per request', COUNT_BUCKETS, ['view'])
+llm_tokens = Histogram('ai_bot_llm_tokens', 'LLM tokens per request', TOKEN_BUCKETS, ['view', 'kind'])
+cypher_round_trips = Histogram('ai_bot_cypher_round_trips', 'Cypher round trips per request', COUNT_BUCKETS, ['view'])
+db_queries = Histogram('ai_bot_db_queries', 'ORM queries per request', COUNT_BUCKETS, ['view'])
+
+# Per agent turn, by agent mode ('pipeline' or 'single_shot'), for A/B comparisons
+turn_duration = Histogram('ai_bot_turn_duration_ms', 'Wall time of an agent turn', MS_BUCKETS, ['mode'])
+turn_llm_calls = Histogram('ai_bot_turn_llm_calls', 'LLM calls per agent turn', COUNT_BUCKETS, ['mode'])
+turn_llm_tokens = Histogram('ai_bot_turn_llm_tokens', 'LLM tokens per agent turn', TOKEN_BUCKETS, ['mode', 'kind'])
+
+HISTOGRAMS = [request_duration, node_duration, llm_calls, llm_tokens, cypher_round_trips, db_queries,
+              turn_duration, turn_llm_calls, turn_llm_tokens]
+
+
+def observe(metrics):
+    view = metrics.view or 'unresolved'
+    totals = metrics.totals()
+    request_duration.observe(metrics.wall_ms, view=view)
+    for node, counters in metrics.as_dict()['nodes'].items():
+        if node != OUTSIDE_GRAPH:
+            node_duration.observe(counters['wall_ms'], node=node)
+    llm_calls.observe(totals['llm_calls'], view=view)
+    llm_tokens.observe(totals['prompt_tokens'], view=view, kind='prompt')
+    llm_tokens.observe(totals['completion_tokens'], view=view, kind='completion')
+    cypher_round_trips.observe(totals['cypher_round_trips'], view=view)
+    db_queries.observe(totals['db_queries'], view=view)
+
+
+@contextmanager
+def measure_turn(mode):
+    """
+    Observe the wall time, LLM calls and tokens of the agent turn run inside
+    the block under `mode`; counts into the current RequestMetrics, or a
+    private one outside of requests (management commands)
+    """
+    metrics, token = _current_metrics.get(), None
+    if metrics is None:
+        metrics, token = begin()
+    before, start = metrics.totals(), time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_ms = (time.perf_counter() - start) * 1000
+        after = metrics.totals()
+        if token is not None:
+            end(token)
+        turn_duration.observe(wall_ms, mode=mode)
+        turn_llm_calls.observe(after['llm_calls'] - before['llm_calls'], mode=mode)
+        for kind in ('prompt', 'completion'):
+            turn_llm_tokens.observe(after[f'{kind}_tokens'] - before[f'{kind}_tokens'], mode=mode, kind=kind)
+
+
+# Callables returning extra Prometheus lines (e.g. cache counters)
+collectors = []
+
+
+def render_metrics():
+    lines = [line for histogram in HISTOGRAMS for line in histogram.render()]
+    for collector in collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+
+# Middleware
+
+class InstrumentationMiddleware:
+    """
+    Records RequestMetrics for every request (except /metrics itself)
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token = begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            end(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = begin()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        match = getattr(request, 'resolver_match', None)
+        metrics.view = match.url_name if match else None
+        if metrics.view == 'metrics':
+            return response
+
+        if response.streaming:
+            # The agent runs while the content is streamed: report once it's done
+            response.streaming_content = (
+                self._astream(response.streaming_content, metrics) if response.is_async
+                else self._stream(response.streaming_content, metrics)
+            )
+            return response
+
+        self.report(metrics)
+        response['Server-Timing'] = metrics.server_timing()
+        response['X-AI-Bot-Metrics'] = metrics.summary_header()
+        return response
+
+    def _stream(self, content, metrics):
+        context = contextvars.copy_context()
+        context.run(_activate, metrics)
+        iterator = iter(content)
+        try:
+            while True:
+                try:
+                    chunk = context.run(next, iterator)
+                except StopIteration:
+                    break
+                yield chunk
+        finally:
+            self.report(metrics)
+
+    async def _astream(self, content, metrics):
+        _activate(metrics)
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            self.report(metrics)
+
+    @staticmethod
+    def report(metrics):
+        metrics.finish()
+        observe(metrics)
+        logger.info(json.dumps(metrics.as_dict()))
+
+
+if __name__ == "__main__":
+    metrics, token = begin('example')
+    count('db_queries', 2)
+    count_round_trip()
+    end(token)
+    metrics.finish()
+    observe(metrics)
+    print(json.dumps(metrics.as_dict()))
+    print(render_metrics()[:400])
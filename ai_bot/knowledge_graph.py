@@ -5,16 +5,22 @@ and to query the graph using Cypher queries and LLMs from Langchain
 python ai_bot/knowledge_graph.py
 """
 
-import os
-from dotenv import load_dotenv
-from langchain_community.vectorstores import Neo4jVector
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.docstore.document import Document
-from langchain_community.graphs import Neo4jGraph
-from langchain.chains import GraphCypherQAChain
-from langchain_core.prompts import FewShotPromptTemplate, PromptTemplate
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
 
 from ai_bot.prompts import cypher_query_examples
+from ai_bot.graph_backends import CypherNotSupported, Neo4jBackend
+from ai_bot.backends import build_graph_backend
+from ai_bot.cypher_queries import catalog
+from ai_bot.graph_writer import GraphBatch
+from ai_bot.profile_store import build_profile_store
+
+logger = logging.getLogger(__name__)
 
 SCHEMA = """
         (:Patient)
@@ -22,8 +28,9 @@ SCHEMA = """
             -[:HAS]->(:HealthIssue {description: String})  // Combines Symptoms and Conditions
             -[:SCHEDULES]->(:Appointment {time: String})
             -[:HAS_LAB_TEST]->(:LabTest {name: String})
-            -[:HAS_NOTE]->(:DoctorNote {content: String})
+            -[:HAS_NOTE]->(:DoctorNote {key: String, content: String})
             -[:HAS_VITAL]->(:Vital {
+                key: String,
                 weight: String, 
                 height: String, 
                 blood_pressure: String, 
@@ -39,40 +46,143 @@ SCHEMA = """
         (:Medication)-[:HAS_FREQUENCY]->(:Frequency {value: String})
         """.strip()
 
+# (label, key properties, kind) for every label of SCHEMA: the properties
+# add_entity MERGEs on and add_relationship and the named queries MATCH on.
+# 'unique' keys become uniqueness constraints (which are backed by an index),
+# 'range' ones plain range indexes, 'text' ones text indexes (no key size
+# limit). Immunizations are MERGEd on name and date but related by name
+# alone, so they get both. Doctor notes and vitals belong to one patient and
+# are keyed on owned_node_key(), not on their (unbounded) content.
+SCHEMA_INDEXES = [
+    ('Patient', ('name',), 'unique'),
+    ('Medication', ('name',), 'unique'),
+    ('Dosage', ('value',), 'unique'),
+    ('Frequency', ('value',), 'unique'),
+    ('HealthIssue', ('description',), 'unique'),
+    ('Appointment', ('time',), 'unique'),
+    ('LabTest', ('name',), 'unique'),
+    ('DoctorNote', ('key',), 'unique'),
+    ('DoctorNote', ('content',), 'text'),
+    ('Vital', ('key',), 'unique'),
+    ('Allergy', ('name',), 'unique'),
+    ('FamilyHistory', ('description',), 'unique'),
+    ('LifestyleFactor', ('description',), 'unique'),
+    ('Immunization', ('name', 'date'), 'unique'),
+    ('Immunization', ('name',), 'range'),
+]
+
+# Constraints of earlier schemas that ensure_schema() drops: unique raw note
+# content overflows the index key size, and both merged patients' notes and vitals
+OBSOLETE_INDEXES = [
+    ('DoctorNote', ('content',), 'unique'),
+    ('Vital', ('weight', 'height', 'blood_pressure', 'heart_rate', 'temperature'), 'unique'),
+]
+
+
+def owned_node_key(patient_name, *values):
+    """
+    Bounded key of a node only `patient_name` links to (DoctorNote, Vital): a
+    hash of the patient and the node's values
+    """
+    return hashlib.sha256(json.dumps([patient_name, *values]).encode()).hexdigest()[:32]
+
+
 class KnowledgeGraph:
-    def __init__(self):
-        load_dotenv()
-        self.uri = os.getenv('NEO4J_URI')
-        self.user = os.getenv('NEO4J_USER')
-        self.password = os.getenv('NEO4J_PASSWORD')
-
-        # self.embeddings = OpenAIEmbeddings(api_key=os.getenv('OPENAI_API_KEY'))
-        # self.vector_store = Neo4jVector(
-        #     url=self.uri,
-        #     username=self.user,
-        #     password=self.password,
-        #     embedding=self.embeddings
-        # )
-
-        self.graph = Neo4jGraph(url=self.uri, username=self.user, password=self.password)
-        
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-
-        # Create the example prompt template
-        example_prompt = PromptTemplate.from_template(
-            "User input: {question}\nCypher query: {query}"
-        )
-        
-        # Create the few-shot prompt template
-        self.prompt = FewShotPromptTemplate(
-            examples=cypher_query_examples[:5],
-            example_prompt=example_prompt,
-            prefix="You are a Neo4j expert. Given an input question, create a syntactically correct Cypher query to run.\n\nHere is the schema information\n{schema}.\n\nBelow are a number of examples of questions and their corresponding Cypher queries.",
-            suffix="User input: {question}\nCypher query: ",
-            input_variables=["question", "schema"]
-        )
+    def __init__(self, backend=None, max_connection_pool_size=None):
+        self.timings = {}
+        self._timings_lock = threading.Lock()
+
+        with self.timed('init'):
+            self.uri = settings.NEO4J_URI
+            self.user = settings.NEO4J_USERNAME
+            self.password = settings.NEO4J_PASSWORD
+            self.max_connection_pool_size = max_connection_pool_size or settings.NEO4J_MAX_CONNECTION_POOL_SIZE
+
+            # from langchain_community.vectorstores import Neo4jVector
+            # from langchain_openai import OpenAIEmbeddings
+            # self.embeddings = OpenAIEmbeddings(api_key=os.getenv('OPENAI_API_KEY'))
+            # self.vector_store = Neo4jVector(
+            #     url=self.uri,
+            #     username=self.user,
+            #     password=self.password,
+            #     embedding=self.embeddings
+            # )
+
+            if backend is None:
+                # The Neo4j driver (and LangChain, for ask()) are only imported for a Neo4j backend
+                backend = Neo4jBackend(
+                    self.uri,
+                    auth=(self.user, self.password),
+                    database=settings.NEO4J_DATABASE,
+                    driver_config={'max_connection_pool_size': self.max_connection_pool_size},
+                )
+            self.backend = backend
+            # Materialized patient profiles, kept up to date by the writes below (None when off)
+            self.profiles = build_profile_store(shared_graph=backend.shared)
+
+        # The LLM and QA chain are built on the first ask()
+        self.llm = None
+        self.qa_chain = None
+        self._qa_lock = threading.Lock()
+        self._schema_stale = True
+
+    @property
+    def graph(self):
+        """
+        langchain's Neo4jGraph for the QA chain (None on InMemoryGraph)
+        """
+        return self.backend.graph
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Accumulate wall time (ms) of a graph operation into self.timings
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            # Requests on every worker thread share the graph
+            with self._timings_lock:
+                timing = self.timings.setdefault(name, {'count': 0, 'total_ms': 0.0, 'last_ms': 0.0})
+                timing['count'] += 1
+                timing['total_ms'] += elapsed
+                timing['last_ms'] = elapsed
+
+    def timings_snapshot(self):
+        """
+        A consistent copy of self.timings
+        """
+        with self._timings_lock:
+            return {name: dict(timing) for name, timing in self.timings.items()}
+
+    def _init_qa_chain(self):
+        from langchain.chains import GraphCypherQAChain
+        from langchain_core.prompts import FewShotPromptTemplate, PromptTemplate
+        from langchain_openai import ChatOpenAI
 
-        # Initialize the QA chain with the new prompt
+        from ai_bot import llm_usage  # counts the QA chain's LLM calls per request
+
+        if self.llm is None:
+            self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+            # Create the example prompt template
+            example_prompt = PromptTemplate.from_template(
+                "User input: {question}\nCypher query: {query}"
+            )
+
+            # Create the few-shot prompt template
+            self.prompt = FewShotPromptTemplate(
+                examples=cypher_query_examples[:5],
+                example_prompt=example_prompt,
+                prefix="You are a Neo4j expert. Given an input question, create a syntactically correct Cypher query to run.\n\nHere is the schema information\n{schema}.\n\nBelow are a number of examples of questions and their corresponding Cypher queries.",
+                suffix="User input: {question}\nCypher query: ",
+                input_variables=["question", "schema"]
+            )
+
+        # The chain captures the schema when it is built, so it is rebuilt after writes
+        self.refresh_schema()
         self.qa_chain = GraphCypherQAChain.from_llm(
             graph=self.graph,
             llm=self.llm,
@@ -81,8 +191,11 @@ class KnowledgeGraph:
             cypher_prompt=self.prompt,
             allow_dangerous_requests=True
         )
+        self._schema_stale = False
 
     def add_document(self, doc_id, text, metadata=None):
+        from langchain.docstore.document import Document
+
         # Create a document and add it to the vector store
         document = Document(page_content=text, metadata=metadata or {"id": doc_id})
         self.vector_store.add_documents([document])
@@ -98,61 +211,320 @@ class KnowledgeGraph:
         return results
 
     def add_entity(self, label, properties):
-        query = f"""
-        MERGE (e:{label} {{{', '.join(f'{k}: ${k}' for k in properties.keys())}}})
-        """
-        self.graph.query(query, properties)
+        self.backend.merge_node(label, properties)
+        batch = GraphBatch()
+        batch.add_entity(label, properties)
+        self._apply_to_profiles(batch)
 
     def add_relationship(self, start_label, start_props, relation, end_label, end_props):
-        query = f"""
-        MATCH (a:{start_label} {{{', '.join(f'{k}: ${k}1' for k in start_props.keys())}}})
-        MATCH (b:{end_label} {{{', '.join(f'{k}: ${k}2' for k in end_props.keys())}}})
-        MERGE (a)-[:{relation}]->(b)
+        self.backend.merge_relationship(start_label, start_props, relation, end_label, end_props)
+        batch = GraphBatch()
+        batch.add_relationship(start_label, start_props, relation, end_label, end_props)
+        self._apply_to_profiles(batch)
+
+    def write_batch(self, batch):
+        """
+        Write a GraphBatch of entities and relationships in one round trip
+        """
+        with self.timed('write_batch'):
+            self.backend.write_batch(batch)
+        self._schema_stale = True
+        self._apply_to_profiles(batch)
+
+    async def awrite_batch(self, batch):
+        with self.timed('write_batch'):
+            await self.backend.awrite_batch(batch)
+        self._schema_stale = True
+        await self._aapply_to_profiles(batch)
+
+    def _apply_to_profiles(self, batch):
+        """
+        Apply a structured write (add_entity, add_relationship, write_batch) to the profile store
+        """
+        if self.profiles is not None:
+            with self.timed('profile_store_write'):
+                self.profiles.apply_batch(batch)
+
+    async def _aapply_to_profiles(self, batch):
+        if self.profiles is not None:
+            with self.timed('profile_store_write'):
+                await self.profiles.aapply_batch(batch)
+
+    def ensure_schema(self):
+        """
+        Create the constraints and indexes of SCHEMA_INDEXES that do not exist
+        yet (idempotent), so MERGE and MATCH look nodes up by key instead of
+        scanning every node of the label
+        """
+        with self.timed('ensure_schema'):
+            for label, keys, kind in OBSOLETE_INDEXES:
+                self.backend.drop_index(label, keys, kind=kind)
+            for label, keys, kind in SCHEMA_INDEXES:
+                self.backend.create_index(label, keys, kind=kind)
+        self._schema_stale = True
+
+    @property
+    def supports_cypher(self):
+        """
+        Whether execute_query(), get_entity_info() and ask() can run on this backend
         """
-        params = {f"{k}1": v for k, v in start_props.items()}
-        params.update({f"{k}2": v for k, v in end_props.items()})
-        self.graph.query(query, params)
+        return self.backend.executes_cypher
+
+    def _require_cypher(self, operation):
+        if not self.supports_cypher:
+            raise CypherNotSupported(f"{operation} runs arbitrary Cypher, which {type(self.backend).__name__} does not execute; "
+                                     "use the named queries of ai_bot.cypher_queries")
 
     def get_entity_info(self, label, properties):
+        self._require_cypher('get_entity_info()')
         query = f"""
         MATCH (e:{label} {{{', '.join(f'{k}: ${k}' for k in properties.keys())}}})
         RETURN e
         """
-        result = self.graph.query(query, properties)
+        result = self.backend.query(query, properties)
         return result[0]['e'] if result else None
 
     def refresh_schema(self):
-        self.graph.refresh_schema()
+        with self.timed('refresh_schema'):
+            self.backend.refresh_schema()
+
+    def mark_schema_stale(self):
+        """
+        Defer the schema refresh to the next ask() instead of paying for it on every write
+        """
+        self._schema_stale = True
 
     def get_schema(self):
-        return self.graph.schema
+        return self.backend.schema
 
     def ask(self, question):
         """
         Ask a question and get a response if we don't already have the query
         """
-        return self.qa_chain.invoke({"query": question})
+        self._require_cypher('ask()')
+        with self._qa_lock:
+            if self.qa_chain is None or self._schema_stale:
+                with self.timed('build_qa_chain'):
+                    self._init_qa_chain()
+        with self.timed('ask'):
+            return self.qa_chain.invoke({"query": question})
     
     def execute_query(self, query, params=None):
         """
         Execute a cypher query if we already have the query
         """
-        result = self.graph.query(query, params)
+        self._require_cypher('execute_query()')
+        result = self.backend.query(query, params)
+        if self.profiles is not None:
+            # What arbitrary Cypher wrote is unknown: reseed every profile from the graph
+            self.profiles.clear()
         return result
 
+    def run_query(self, query_name, **params):
+        """
+        Execute a named, parameterized query from ai_bot.cypher_queries and
+        apply the profile effects the catalog declares for it
+        """
+        prepared = catalog.bind(query_name, params)
+        with self.timed(query_name):
+            result = self.backend.run(prepared, params)
+        if self.profiles is not None:
+            self.profiles.apply_query(prepared, params)
+        return result
+
+    async def arun_query(self, query_name, **params):
+        prepared = catalog.bind(query_name, params)
+        with self.timed(query_name):
+            result = await self.backend.arun(prepared, params)
+        if self.profiles is not None:
+            await self.profiles.aapply_query(prepared, params)
+        return result
+
+    def get_patient_profile(self, name, mode='aggregated'):
+        """
+        Fetch the patient's profile together with the store_medication /
+        store_appointment flags. 'aggregated' does it in one round trip with
+        per-relationship subqueries; 'cartesian' runs the original OPTIONAL MATCH
+        chain followed by the separate flags query.
+        """
+        if mode == 'aggregated':
+            return self._profile_record(self.run_query('patient_profile_aggregated', name=name))
+
+        result = self.run_query('patient_profile', name=name)
+        if not result:
+            return None
+        return self._profile_record(result, self.run_query('patient_store_flags', name=name))
+
+    async def aget_patient_profile(self, name, mode='aggregated'):
+        if mode == 'aggregated':
+            return self._profile_record(await self.arun_query('patient_profile_aggregated', name=name))
+
+        result = await self.arun_query('patient_profile', name=name)
+        if not result:
+            return None
+        return self._profile_record(result, await self.arun_query('patient_store_flags', name=name))
+
+    def read_patient_profile(self, name, mode='aggregated'):
+        """
+        The patient's profile from the profile store, like get_patient_profile();
+        the graph is only queried on a miss, and the record read is stored
+        """
+        if self.profiles is None:
+            return self.get_patient_profile(name, mode)
+        with self.timed('profile_store_read'):
+            record = self.profiles.get_profile(name)
+        if record is not None:
+            return record
+        record = self.get_patient_profile(name, mode)
+        if record is not None:
+            details = self.run_query('medication_details', names=record['medications']) if record['medications'] else []
+            self.profiles.seed(name, record, details)
+        return record
+
+    async def aread_patient_profile(self, name, mode='aggregated'):
+        if self.profiles is None:
+            return await self.aget_patient_profile(name, mode)
+        with self.timed('profile_store_read'):
+            record = await self.profiles.aget_profile(name)
+        if record is not None:
+            return record
+        record = await self.aget_patient_profile(name, mode)
+        if record is not None:
+            details = await self.arun_query('medication_details', names=record['medications']) if record['medications'] else []
+            await self.profiles.aseed(name, record, details)
+        return record
+
+    @staticmethod
+    def _profile_record(result, check_result=None):
+        if not result:
+            return None
+        record = dict(result[0])
+        if check_result is not None:
+            flags = check_result[0] if check_result else {}
+            record.update(store_medication=flags.get('store_medication'), store_appointment=flags.get('store_appointment'))
+        return record
+
     def clear_graph(self):
         """
-        Clear all nodes and relationships from the graph.
+        Clear all nodes and relationships from the graph (every patient's; see
+        reset_patient to forget a single patient).
         """
-        query = """
-        MATCH (n)
-        DETACH DELETE n
+        self.backend.clear()
+        self._schema_stale = True
+        if self.profiles is not None:
+            self.profiles.clear()
+
+    RESET_QUERIES = ('reset_patient_nodes', 'reset_patient_relationships', 'delete_patient')
+
+    def reset_patient(self, name, batch_size=1000):
+        """
+        Delete the patient node and the nodes only that patient references,
+        keeping nodes shared with other patients, in transactions of at most
+        batch_size rows. Returns the number deleted by each reset query.
+        """
+        with self.timed('reset_patient'):
+            deleted = {
+                query_name: self.run_query(query_name, name=name, batch_size=batch_size)[0]['deleted']
+                for query_name in self.RESET_QUERIES
+            }
+        self._schema_stale = True
+        return deleted
+
+    async def areset_patient(self, name, batch_size=1000):
+        with self.timed('reset_patient'):
+            deleted = {}
+            for query_name in self.RESET_QUERIES:
+                result = await self.arun_query(query_name, name=name, batch_size=batch_size)
+                deleted[query_name] = result[0]['deleted']
+        self._schema_stale = True
+        return deleted
+
+    def warm_up(self):
+        """
+        Connect to the graph and build the QA chain ahead of the first request
         """
-        self.graph.query(query)
-        
+        with self.timed('warm_up'):
+            self.backend.verify_connectivity()
+            if not self.supports_cypher:
+                return
+            try:
+                with self._qa_lock:
+                    self._init_qa_chain()
+            except Exception:
+                # ask() builds it again; a missing APOC plugin should not keep the worker out of rotation
+                logger.exception("Could not build the QA chain during warm-up")
+
+    def close(self):
+        self.backend.close()
+
+
+# Process-wide KnowledgeGraph shared by requests so the driver and its
+# connection pool are created once per worker instead of once per call
+_shared_graph = None
+_shared_graph_lock = threading.Lock()
+_shared_graph_timings = {}
+
+
+def get_knowledge_graph():
+    """
+    Return the shared KnowledgeGraph, creating it on first use (thread-safe)
+    """
+    global _shared_graph
+    if _shared_graph is None:
+        with _shared_graph_lock:
+            if _shared_graph is None:
+                start = time.perf_counter()
+                _shared_graph = KnowledgeGraph(backend=build_graph_backend())
+                _shared_graph_timings['startup_ms'] = (time.perf_counter() - start) * 1000
+                if settings.AI_BOT_GRAPH_ENSURE_SCHEMA:
+                    ensure_schema(_shared_graph)
+    return _shared_graph
+
+
+def ensure_schema(kg):
+    """
+    Startup hook of get_knowledge_graph(): a graph that cannot take the schema
+    (unreachable, or duplicates left by writes that ran without the
+    constraints) still serves requests, only with label scans
+    """
+    try:
+        kg.ensure_schema()
+    except Exception:
+        logger.exception("Could not create the knowledge graph constraints and indexes; run `manage.py ensure_graph_schema`")
+
+
+def set_knowledge_graph(kg):
+    """
+    Replace the shared KnowledgeGraph (e.g. with an in-memory backend); None resets it
+    """
+    global _shared_graph
+    with _shared_graph_lock:
+        previous, _shared_graph = _shared_graph, kg
+        _shared_graph_timings.clear()
+    if previous is not None and previous is not kg:
+        previous.close()
+
+
+def get_knowledge_graph_timings():
+    """
+    Startup cost of the shared graph plus the accumulated per-operation timings
+    """
+    timings = dict(_shared_graph_timings)
+    if _shared_graph is not None:
+        timings.update(_shared_graph.timings_snapshot())
+    return timings
+
 
 if __name__ == "__main__":
-    kg = KnowledgeGraph()
+    import os
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_chat_app.settings')
+    django.setup()
+
+    kg = KnowledgeGraph(backend=build_graph_backend())
     kg.refresh_schema()
     print("Graph Schema:", kg.get_schema())
+    kg.close()
     
@@ -5,22 +5,26 @@ python ai_bot/langchain_integration.py
 """
 
 import os
+import threading
+from collections import namedtuple
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_openai import ChatOpenAI
+from ai_bot.backends import build_chat_model
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+from ai_bot.history import WindowedChatMessageHistory, prompt_token_counter
+from ai_bot.prompts import single_shot_instructions
+from ai_bot.response_cache import build_response_cache, depends_on_history, patient_context, refers_to_patient
+from ai_bot.extraction_cache import cache_version
+from ai_bot import instrumentation, llm_usage  # llm_usage counts the LLM calls per request
 
 
 # Load OpenAI API key from environment variable
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# Initialize the LLM
-llm = ChatOpenAI(model="gpt-4o-mini", api_key=OPENAI_API_KEY) # change your chat llm from https://python.langchain.com/docs/integrations/llms/
-
-# Create a chat prompt template
-prompt = ChatPromptTemplate.from_messages([
-    ("system", """You are a helpful AI health assistant bot. You are assisting {patient_name}, who is {patient_age} years old. 
+system_prompt = """You are a helpful AI health assistant bot. You are assisting {patient_name}, who is {patient_age} years old. 
     Their last appointment was on: {last_appointment}
     Their next appointment is scheduled for: {next_appointment}
     Their doctor's name is: {doctor_name}
@@ -37,13 +41,37 @@ prompt = ChatPromptTemplate.from_messages([
     
     If the query is not directly related to the patient's health or the bot's core functionalities, politely redirect the conversation by saying something like: "I understand you're interested in [topic], but I'm designed to assist with your health-related concerns. Is there anything about your health, medications, appointments, or medical condition that you'd like to discuss?"
 
-    Always steer the conversation back to the bot's main purposes: discussing the patient's health, medications, appointments, and medical conditions."""),
+    Always steer the conversation back to the bot's main purposes: discussing the patient's health, medications, appointments, and medical conditions."""
+
+# Create a chat prompt template
+prompt = ChatPromptTemplate.from_messages([
+    ("system", system_prompt),
     MessagesPlaceholder(variable_name="history"),
     ("human", "{input}")
 ])
 
-# Create the chain
-chain = prompt | llm
+# Cacheable replies to general questions: shared by every patient with the same
+# age band and condition (ai_bot.response_cache), so the prompt holds nothing
+# else about the patient and no conversation history
+cacheable_system_prompt = """You are a helpful AI health assistant bot. You are assisting a patient in their {age_band}.
+    Their medical condition: {condition}
+
+    Answer the patient's general health question with informative and helpful general advice. Do not assume anything
+    about the patient beyond their age band and medical condition, and suggest they check with their doctor when relevant.
+
+    If the query is not related to health, politely redirect the conversation by saying something like: "I understand you're interested in [topic], but I'm designed to assist with your health-related concerns. Is there anything about your health, medications, appointments, or medical condition that you'd like to discuss?\""""
+
+cacheable_prompt = ChatPromptTemplate.from_messages([
+    ("system", cacheable_system_prompt),
+    ("human", "{input}")
+])
+
+# Single-shot mode: the reply and the extracted entities from one call
+single_shot_prompt = ChatPromptTemplate.from_messages([
+    ("system", system_prompt + "\n\n" + single_shot_instructions),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "{input}")
+])
 
 # Create a simple in-memory chat message history
 class InMemoryChatMessageHistory(BaseChatMessageHistory):
@@ -56,65 +84,268 @@ class InMemoryChatMessageHistory(BaseChatMessageHistory):
     def clear(self) -> None:
         self.messages = []
 
-# Create a function to get session history
+# Create a function to get session history (kept in the shared session store,
+# trimmed to settings.AI_BOT_HISTORY_MAX_TOKENS plus a summary of older turns)
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in get_session_history.sessions:
-        get_session_history.sessions[session_id] = InMemoryChatMessageHistory()
-    return get_session_history.sessions[session_id]
+    return WindowedChatMessageHistory(session_id)
 
-# Initialize the sessions dictionary
-get_session_history.sessions = {}
+def build_runnable_chain(chain):
+    return RunnableWithMessageHistory(
+        chain,
+        get_session_history=get_session_history,
+        input_messages_key="input",
+        history_messages_key="history"
+    )
 
-# Create a RunnableWithMessageHistory
-runnable_chain = RunnableWithMessageHistory(
-    chain,
-    get_session_history=get_session_history,
-    input_messages_key="input",
-    history_messages_key="history"
-)
+# The chat model and the chains built on it (plus the cache version they imply)
+# are built on first use, so importing this module does not create an OpenAI client
+ResponseChains = namedtuple('ResponseChains', ['llm', 'chain', 'runnable_chain', 'single_shot_chain', 'cacheable_chain', 'cache_version'])
 
-def get_bot_response(user_input: str, patient, session_id: str = "default") -> str:
-    prompt_variables = {
+_chains = None
+_chains_lock = threading.Lock()
+
+def _build_chains(llm):
+    chain = prompt | llm
+    # Cached replies are only reused with the same prompt and model
+    version = cache_version(cacheable_system_prompt, llm.__class__.__name__, getattr(llm, 'model_name', None) or id(llm))
+    return ResponseChains(llm, chain, build_runnable_chain(chain), single_shot_prompt | llm | JsonOutputParser(),
+                          cacheable_prompt | llm, version)
+
+def get_chains():
+    """
+    Return the shared ResponseChains, building the chat model on first use
+    """
+    global _chains
+    if _chains is None:
+        with _chains_lock:
+            if _chains is None:
+                # change your chat llm from https://python.langchain.com/docs/integrations/llms/
+                _chains = _build_chains(build_chat_model(model="gpt-4o-mini", api_key=OPENAI_API_KEY))
+    return _chains
+
+def set_chat_model(chat_model):
+    """
+    Swap the chat model behind the reply chains (e.g. for a StubChatModel);
+    None goes back to the configured model, built on next use
+    """
+    global _chains
+    with _chains_lock:
+        _chains = _build_chains(chat_model) if chat_model is not None else None
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+_response_cache_built = False
+
+def _response_cache_metric_lines():
+    cache = _response_cache
+    return cache.metric_lines() if cache is not None else []
+
+instrumentation.collectors.append(_response_cache_metric_lines)
+
+def get_response_cache():
+    """
+    Return the shared ResponseCache (None when settings.AI_BOT_RESPONSE_CACHE is 'off')
+    """
+    global _response_cache, _response_cache_built
+    if not _response_cache_built:
+        with _response_cache_lock:
+            if not _response_cache_built:
+                _response_cache = build_response_cache()
+                _response_cache_built = True
+    return _response_cache
+
+def set_response_cache(cache):
+    """
+    Replace the shared ResponseCache; None disables caching
+    """
+    global _response_cache, _response_cache_built
+    with _response_cache_lock:
+        _response_cache, _response_cache_built = cache, True
+
+def _usable_response_cache(user_input, history):
+    # The cache, unless it is off or the answer needs the patient's record or the earlier turns
+    cache = get_response_cache()
+    if cache is not None and (refers_to_patient(user_input) or depends_on_history(user_input, history)):
+        cache.bypass()
+        return None
+    return cache
+
+def _patient_variables(patient, user_input):
+    return {
         "patient_name": patient.get_full_name(),
         "patient_age": patient.get_age(),
-        "medical_condition": patient.medical_condition,
-        "medication_regimen": patient.medication_regimen,
         "last_appointment": patient.get_last_appointment_readable(),
         "next_appointment": patient.get_next_appointment_readable(),
         "doctor_name": patient.doctor_name,
         "input": user_input,
     }
-    response = runnable_chain.invoke(
-        prompt_variables,
-        config={"configurable": {"session_id": session_id}}
+
+def _general_variables(user_input, patient):
+    prompt_variables = _patient_variables(patient, user_input)
+    prompt_variables.update({
+        "medical_condition": patient.medical_condition,
+        "medication_regimen": patient.medication_regimen,
+    })
+    return prompt_variables
+
+def _cacheable_variables(user_input, context):
+    return {
+        "age_band": context['age_band'] or "unknown age group",
+        "condition": context['condition'] or "not given",
+        "input": user_input,
+    }
+
+def _cacheable_response(chains, cache, user_input, context):
+    # Generated from the cache key alone, so the reply can be shared
+    response = chains.cacheable_chain.invoke(
+        _cacheable_variables(user_input, context),
+        config={"callbacks": [prompt_token_counter]}
     )
+    cache.set(chains.cache_version, user_input, context, response.content)
     return response.content
 
-def get_bot_response_based_on_entities(entities_input, patient, session_id: str = "default"):
+async def _acacheable_response(chains, cache, user_input, context):
+    response = await chains.cacheable_chain.ainvoke(
+        _cacheable_variables(user_input, context),
+        config={"callbacks": [prompt_token_counter]}
+    )
+    await cache.aset(chains.cache_version, user_input, context, response.content)
+    return response.content
+
+def _entities_input(entities_input):
     # Prepare the information obtained from entities
     entity_info = "The patient has provided the following information: " + entities_input
     
     # Prepare the prompt for the AI
-    user_input = f"{entity_info}\nPlease reply in under few lines regarding the specific information. It could be an analysis of the usage/frequency of a medication, or about the patient's health condition."
-    
-    # Prepare the prompt variables
-    prompt_variables = {
-        "patient_name": patient.get_full_name(),
-        "patient_age": patient.get_age(),
-        "last_appointment": patient.get_last_appointment_readable(),
-        "next_appointment": patient.get_next_appointment_readable(),
-        "doctor_name": patient.doctor_name,
-        "input": user_input
-    }
-    
-    # Use runnable_chain to get the AI response
-    response = runnable_chain.invoke(
-        prompt_variables,
-        config={"configurable": {"session_id": session_id}}
+    return f"{entity_info}\nPlease reply in under few lines regarding the specific information. It could be an analysis of the usage/frequency of a medication, or about the patient's health condition."
+
+def _session_config(session_id):
+    # prompt_token_counter records the prompt size of every call (ai_bot.history.prompt_token_stats)
+    return {"configurable": {"session_id": session_id}, "callbacks": [prompt_token_counter]}
+
+def get_bot_response(user_input: str, patient, session_id: str = "default") -> str:
+    chains = get_chains()
+    cache = get_response_cache() and _usable_response_cache(user_input, get_session_history(session_id).messages)
+    if cache is not None:
+        context = patient_context(patient)
+        reply = cache.get(chains.cache_version, user_input, context)
+        if reply is None:
+            reply = _cacheable_response(chains, cache, user_input, context)
+        commit_bot_response(user_input, reply, session_id)
+        return reply
+
+    response = chains.runnable_chain.invoke(
+        _general_variables(user_input, patient),
+        config=_session_config(session_id)
+    )
+    return response.content
+
+async def aget_bot_response(user_input: str, patient, session_id: str = "default") -> str:
+    chains = get_chains()
+    cache = get_response_cache() and _usable_response_cache(user_input, await get_session_history(session_id).aget_messages())
+    if cache is not None:
+        context = patient_context(patient)
+        reply = await cache.aget(chains.cache_version, user_input, context)
+        if reply is None:
+            reply = await _acacheable_response(chains, cache, user_input, context)
+        await acommit_bot_response(user_input, reply, session_id)
+        return reply
+
+    response = await chains.runnable_chain.ainvoke(
+        _general_variables(user_input, patient),
+        config=_session_config(session_id)
+    )
+    return response.content
+
+# Speculative replies: generated from the current history without recording
+# the turn, which commit_bot_response does once the reply is actually used
+
+def _speculative_variables(user_input, patient, history):
+    return {**_general_variables(user_input, patient), "history": history}
+
+def speculate_bot_response(user_input: str, patient, session_id: str = "default") -> str:
+    chains = get_chains()
+    history = get_session_history(session_id).messages
+    cache = _usable_response_cache(user_input, history)
+    if cache is not None:
+        context = patient_context(patient)
+        if (cached := cache.get(chains.cache_version, user_input, context)) is not None:
+            return cached
+        return _cacheable_response(chains, cache, user_input, context)
+
+    response = chains.chain.invoke(
+        _speculative_variables(user_input, patient, history),
+        config={"callbacks": [prompt_token_counter]}
+    )
+    return response.content
+
+async def aspeculate_bot_response(user_input: str, patient, session_id: str = "default") -> str:
+    chains = get_chains()
+    history = await get_session_history(session_id).aget_messages()
+    cache = _usable_response_cache(user_input, history)
+    if cache is not None:
+        context = patient_context(patient)
+        if (cached := await cache.aget(chains.cache_version, user_input, context)) is not None:
+            return cached
+        return await _acacheable_response(chains, cache, user_input, context)
+
+    response = await chains.chain.ainvoke(
+        _speculative_variables(user_input, patient, history),
+        config={"callbacks": [prompt_token_counter]}
+    )
+    return response.content
+
+# Single-shot turns: one call returns both the entities and the reply; like a
+# speculative reply, the turn is only recorded once the reply is used
+
+def _single_shot_result(response):
+    from ai_bot.entity_extraction import _to_entities
+
+    if not isinstance(response, dict) or not isinstance(response.get("reply"), str):
+        raise ValueError(f"Unexpected single-shot response: {response!r}")
+    return _to_entities(response.get("entities") or {}), response["reply"]
+
+def single_shot_bot_response(user_input: str, patient, session_id: str = "default"):
+    """
+    Return (entities, reply) for `user_input` from a single LLM call
+    """
+    history = get_session_history(session_id).messages
+    response = get_chains().single_shot_chain.invoke(
+        _speculative_variables(user_input, patient, history),
+        config={"callbacks": [prompt_token_counter]}
+    )
+    return _single_shot_result(response)
+
+async def asingle_shot_bot_response(user_input: str, patient, session_id: str = "default"):
+    history = await get_session_history(session_id).aget_messages()
+    response = await get_chains().single_shot_chain.ainvoke(
+        _speculative_variables(user_input, patient, history),
+        config={"callbacks": [prompt_token_counter]}
+    )
+    return _single_shot_result(response)
+
+def commit_bot_response(user_input: str, response: str, session_id: str = "default"):
+    get_session_history(session_id).add_messages([HumanMessage(content=user_input), AIMessage(content=response)])
+
+async def acommit_bot_response(user_input: str, response: str, session_id: str = "default"):
+    await get_session_history(session_id).aadd_messages([HumanMessage(content=user_input), AIMessage(content=response)])
+
+def get_bot_response_based_on_entities(entities_input, patient, session_id: str = "default"):
+    # Use the runnable chain to get the AI response
+    response = get_chains().runnable_chain.invoke(
+        _patient_variables(patient, _entities_input(entities_input)),
+        config=_session_config(session_id)
     )
     
     return response.content
 
+async def aget_bot_response_based_on_entities(entities_input, patient, session_id: str = "default"):
+    response = await get_chains().runnable_chain.ainvoke(
+        _patient_variables(patient, _entities_input(entities_input)),
+        config=_session_config(session_id)
+    )
+    return response.content
+
 if __name__ == "__main__":
     print("Welcome to the AI Bot. Type 'exit' to stop.")
     session_id = "michael_session_1"  # generate unique session IDs for each user
@@ -0,0 +1,76 @@
+"""
+LLM calls and tokens of the current request
+
+LLMUsageHandler is registered as a LangChain configure hook, so it sees every
+LLM call, and counts into the RequestMetrics current where the call runs
+(ai_bot.instrumentation). It is kept apart from ai_bot.instrumentation,
+which every process loads to count ORM queries, so only the modules that
+call an LLM import LangChain.
+"""
+
+import contextvars
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from ai_bot.instrumentation import current_metrics
+
+
+class LLMUsageHandler(BaseCallbackHandler):
+    """
+    Counts LLM calls and tokens into the current RequestMetrics. Uses the
+    provider's token usage when it reports one, and tiktoken estimates
+    otherwise (stubs, streaming).
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self._prompt_tokens = {}  # run_id -> estimated prompt tokens
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        from ai_bot.history import count_message_tokens
+        if current_metrics() is not None:
+            self._prompt_tokens[run_id] = sum(count_message_tokens(prompt) for prompt in messages)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        from ai_bot.history import count_tokens
+        if current_metrics() is not None:
+            self._prompt_tokens[run_id] = sum(count_tokens(prompt) for prompt in prompts)
+
+    @staticmethod
+    def _usage(response):
+        usage = (response.llm_output or {}).get('token_usage')
+        if usage:
+            return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        for generations in response.generations:
+            for generation in generations:
+                metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if metadata:
+                    return metadata.get('input_tokens', 0), metadata.get('output_tokens', 0)
+        return None
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        from ai_bot.history import count_tokens
+
+        estimated_prompt = self._prompt_tokens.pop(run_id, 0)
+        metrics = current_metrics()
+        if metrics is None:
+            return
+        usage = self._usage(response)
+        if usage is None:
+            usage = estimated_prompt, sum(count_tokens(g.text) for gs in response.generations for g in gs)
+        metrics.add('llm_calls')
+        metrics.add('prompt_tokens', usage[0])
+        metrics.add('completion_tokens', usage[1])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompt_tokens.pop(run_id, None)
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.add('llm_calls')
+
+
+# One handler for every context: it looks the request up when it is called
+_llm_handler = contextvars.ContextVar('ai_bot_llm_usage_handler', default=LLMUsageHandler())
+register_configure_hook(_llm_handler, inheritable=True)
@@ -0,0 +1,81 @@
+"""
+trace the agent graph with and without concurrent steps
+
+python manage.py bench_agent_pipeline --turns 20 --llm-latency-ms 800 --graph-latency-ms 20
+
+Runs the same conversation through the sequential pipeline (no speculative
+reply, synchronous graph writes) and the concurrent one, with StubChatModel
+and InMemoryGraph standing in for OpenAI and Neo4j, and prints the mean time
+per node, the mean sum of node times and the mean wall time of a turn.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from ai_bot.management.commands.bench_concurrency import make_patient
+
+MESSAGES = [
+    "I twisted my ankle yesterday, what should I do?",
+    "I take lisinopril 10mg once a day",
+    "Is it fine to go for a walk?",
+    "Should I drink more water?",
+]
+MEDICATION = {"medications": "lisinopril", "dosages": "10mg", "frequencies": "once a day"}
+
+
+class Command(BaseCommand):
+    help = "Compare per-node and per-turn latency of the sequential and concurrent agent pipelines"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=20)
+        parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+        parser.add_argument("--graph-latency-ms", type=float, default=20.0)
+
+    def install_stubs(self, llm_latency, graph_latency):
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.fakes import StubChatModel
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph, set_knowledge_graph
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        set_knowledge_graph(KnowledgeGraph(backend=InMemoryGraph(latency=graph_latency)))
+        set_session_store(MemorySessionStore())
+        entity_extraction.set_chat_model(StubChatModel(
+            respond=lambda messages: json.dumps(MEDICATION if "mg" in messages[-1].content else {}),
+            latency=llm_latency,
+        ))
+        langchain_integration.set_response_cache(None)  # every turn should reach the model
+        langchain_integration.set_chat_model(StubChatModel(
+            responses=["Rest, ice, compress and elevate the ankle."], latency=llm_latency,
+        ))
+
+    def run(self, turns, label):
+        from ai_bot import agent
+        from ai_bot.bot import generate_bot_response
+        from ai_bot.tracing import node_timings
+
+        patient = make_patient(label)
+        node_timings.reset()
+        for turn in range(turns):
+            generate_bot_response(MESSAGES[turn % len(MESSAGES)], patient, session_id=f"pipeline-{label}")
+        agent.graph_writes.flush()
+        return node_timings.snapshot()
+
+    def handle(self, *args, **options):
+        self.install_stubs(options["llm_latency_ms"] / 1000, options["graph_latency_ms"] / 1000)
+        turns = options["turns"]
+
+        with override_settings(AI_BOT_SPECULATIVE_RESPONSE=False, AI_BOT_GRAPH_WRITE_BEHIND=False):
+            sequential = self.run(turns, "sequential")
+        with override_settings(AI_BOT_SPECULATIVE_RESPONSE=True, AI_BOT_GRAPH_WRITE_BEHIND=True):
+            concurrent = self.run(turns, "concurrent")
+
+        self.stdout.write(f"{'mean ms':<24}  {'sequential':>10}  {'concurrent':>10}")
+        for node in dict.fromkeys([*sequential["nodes"], *concurrent["nodes"]]):
+            row = [run["nodes"].get(node, {}).get("mean_ms") for run in (sequential, concurrent)]
+            self.stdout.write(f"{node:<24}  " + "  ".join(f"{ms:>10.1f}" if ms is not None else f"{'-':>10}" for ms in row))
+        self.stdout.write(f"{'sum of nodes per turn':<24}  {sequential['mean_serial_ms']:>10.1f}  {concurrent['mean_serial_ms']:>10.1f}")
+        self.stdout.write(f"{'wall time per turn':<24}  {sequential['mean_wall_ms']:>10.1f}  {concurrent['mean_wall_ms']:>10.1f}")
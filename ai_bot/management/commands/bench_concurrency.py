@@ -0,0 +1,106 @@
+"""
+load test the agent pipeline under the WSGI and ASGI concurrency models
+
+python manage.py bench_concurrency --conversations 200 --workers 8 --llm-latency-ms 800
+
+Replaces the OpenAI models with StubChatModel and Neo4j with InMemoryGraph
+(each with a simulated latency), then runs the same conversations through
+generate_bot_response on a fixed pool of worker threads (WSGI) and through
+agenerate_bot_response as tasks on one event loop (ASGI).
+"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from patients.models import Patient
+
+GENERAL_INQUIRY = ["I twisted my ankle, what should I do?", "Should I keep walking on it?"]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_patient(i):
+    # Unsaved: the general-inquiry flow never writes the patient to Postgres
+    return Patient(
+        first_name="Load", last_name=f"Test {i}", date_of_birth=date(1980, 1, 1),
+        medical_condition="Hypertension", medication_regimen="Lisinopril 10mg once daily",
+        doctor_name="Dr. John Smith",
+    )
+
+
+class Command(BaseCommand):
+    help = "Compare WSGI (thread pool) and ASGI (event loop) throughput of the agent with stubbed LLM/graph latency"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=200)
+        parser.add_argument("--workers", type=int, default=8, help="WSGI worker threads")
+        parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+        parser.add_argument("--graph-latency-ms", type=float, default=20.0)
+
+    def install_stubs(self, llm_latency, graph_latency):
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.fakes import StubChatModel
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph, set_knowledge_graph
+
+        set_knowledge_graph(KnowledgeGraph(backend=InMemoryGraph(latency=graph_latency)))
+        entity_extraction.set_chat_model(StubChatModel(responses=[json.dumps({})], latency=llm_latency))
+        langchain_integration.set_response_cache(None)  # every turn should reach the model
+        langchain_integration.set_chat_model(StubChatModel(
+            responses=["Rest, ice, compress and elevate the ankle."], latency=llm_latency,
+        ))
+
+    def report(self, name, elapsed, latencies):
+        self.stdout.write(
+            f"{name:>5}: {len(latencies) / elapsed:8.1f} turns/s  "
+            f"p50 {1000 * percentile(latencies, 0.5):8.1f} ms  "
+            f"p95 {1000 * percentile(latencies, 0.95):8.1f} ms  "
+            f"({len(latencies)} turns in {elapsed:.1f} s)"
+        )
+
+    def run_wsgi(self, conversations, workers):
+        from ai_bot.bot import generate_bot_response
+
+        def conversation(i):
+            patient, latencies = make_patient(i), []
+            for message in GENERAL_INQUIRY:
+                start = time.perf_counter()
+                generate_bot_response(message, patient, session_id=f"wsgi-{i}")
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            latencies = [latency for result in pool.map(conversation, range(conversations)) for latency in result]
+        return time.perf_counter() - start, latencies
+
+    async def run_asgi(self, conversations):
+        from ai_bot.bot import agenerate_bot_response
+
+        async def conversation(i):
+            patient, latencies = make_patient(i), []
+            for message in GENERAL_INQUIRY:
+                start = time.perf_counter()
+                await agenerate_bot_response(message, patient, session_id=f"asgi-{i}")
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(conversation(i) for i in range(conversations)))
+        return time.perf_counter() - start, [latency for result in results for latency in result]
+
+    def handle(self, *args, **options):
+        self.install_stubs(options["llm_latency_ms"] / 1000, options["graph_latency_ms"] / 1000)
+        conversations = options["conversations"]
+
+        self.report("wsgi", *self.run_wsgi(conversations, options["workers"]))
+        self.report("asgi", *asyncio.run(self.run_asgi(conversations)))
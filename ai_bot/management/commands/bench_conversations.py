@@ -0,0 +1,183 @@
+"""
+replay scripted conversations end to end, offline
+
+python manage.py bench_conversations --rounds 5 --llm-latency-ms 300 [--output results.json] [--baseline results.json]
+
+Posts the README conversations (medication follow-ups, appointment change,
+general question) to chat_view through the Django test client, against a
+throwaway test database, with the fake chat model and in-memory graph of
+ai_bot.backends.use_fakes() standing in for OpenAI and Neo4j. Prints turns
+per second, p50/p95/p99 turn latency and the LLM calls, Cypher round trips
+and ORM queries per turn (read from the X-AI-Bot-Metrics header), overall
+and per conversation.
+
+--output writes the summary as JSON; --baseline compares against such a
+file and fails when latency, round trips or queries per turn grew by more
+than --tolerance.
+"""
+
+import json
+import logging
+import statistics
+import time
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+# The flows of the README's "Use Cases"
+CONVERSATIONS = {
+    "medication": [
+        "I'm taking ibuprofen for my fever.",
+        "ibuprofen, 200mg",
+        "ibuprofen, every 6 hours.",
+    ],
+    "appointment": [
+        "I want to change the appointment to next Monday",
+    ],
+    "general": [
+        "I twisted my ankle, what should I do?",
+        "Is it fine to go for a walk?",
+    ],
+}
+PER_TURN = ("llm_calls", "cypher_round_trips", "db_queries")
+# Summary values that fail --baseline when they grow
+GUARDED = ("p50_ms", "p95_ms", "cypher_round_trips", "db_queries")
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+def parse_metrics(header):
+    # "llm_calls=2; prompt_tokens=812; ..." (RequestMetrics.summary_header)
+    pairs = (item.split("=", 1) for item in header.split("; ") if "=" in item)
+    return {counter: float(value) for counter, value in pairs}
+
+
+def summarize(turns, seconds):
+    latencies = [turn["ms"] for turn in turns]
+    return {
+        "turns": len(turns),
+        "turns_per_second": round(len(turns) / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        **{counter: round(statistics.mean(turn[counter] for turn in turns), 2) for counter in PER_TURN},
+    }
+
+
+def make_patient():
+    # Signed in as patient.user (anonymous requests are refused)
+    from uuid import uuid4
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+    from patients.models import Patient
+
+    return Patient.objects.create(
+        user=get_user_model().objects.create_user(f"patient-{uuid4().hex[:12]}"),
+        first_name="John", last_name="Doe", date_of_birth=date(1980, 1, 1),
+        phone_number="123-456-7890", email="john.doe@example.com",
+        medical_condition="Hypertension", medication_regimen="Lisinopril 10mg daily",
+        last_appointment_datetime=timezone.make_aware(datetime(2024, 9, 15, 10, 0)),
+        next_appointment_datetime=timezone.make_aware(datetime(2024, 10, 15, 10, 0)),
+        doctor_name="Dr. Smith",
+    )
+
+
+class Command(BaseCommand):
+    help = "Replay scripted conversations through chat_view with fake OpenAI and Neo4j and report latency and round trips"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=5, help="Times every conversation is replayed")
+        parser.add_argument("--llm-latency-ms", type=float, default=None,
+                            help="Fake LLM latency per call (default: settings.AI_BOT_FAKE_LLM_LATENCY_MS)")
+        parser.add_argument("--ms-per-token", type=float, default=None,
+                            help="Fake generation time per completion token (default: settings.AI_BOT_FAKE_LLM_MS_PER_TOKEN)")
+        parser.add_argument("--graph-latency-ms", type=float, default=None,
+                            help="Fake Cypher round trip time (default: settings.AI_BOT_FAKE_GRAPH_LATENCY_MS)")
+        parser.add_argument("--output", help="Write the summary to this JSON file")
+        parser.add_argument("--baseline", help="Summary JSON of an earlier run to compare against")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="Allowed relative growth over --baseline (default: 0.2)")
+
+    def handle(self, *args, **options):
+        from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+            teardown_test_environment
+
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(options["llm_latency_ms"], options["ms_per_token"], options["graph_latency_ms"])
+        set_session_store(MemorySessionStore())
+        logging.getLogger("ai_bot.metrics").disabled = True  # one line per request; the summary is below
+
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self.replay(make_patient(), options["rounds"])
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+        self.report(results)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def replay(self, patient, rounds):
+        from django.test import Client
+        from django.urls import reverse
+
+        from ai_bot import agent
+
+        client = Client()
+        client.force_login(patient.user)
+        client.get(reverse("chat"))  # starts the conversation
+        turns = {name: [] for name in CONVERSATIONS}
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for name, messages in CONVERSATIONS.items():
+                client.post(reverse("restart_conversation"))
+                for message in messages:
+                    began = time.perf_counter()
+                    response = client.post(reverse("chat"), {"message": message})
+                    ms = (time.perf_counter() - began) * 1000
+                    if response.status_code != 200:
+                        raise CommandError(f"{name}: {message!r} returned {response.status_code}")
+                    turns[name].append({"ms": ms, **parse_metrics(response.get("X-AI-Bot-Metrics", ""))})
+        seconds = time.perf_counter() - start
+        agent.graph_writes.flush()
+
+        every = [turn for conversation in turns.values() for turn in conversation]
+        return {
+            "overall": summarize(every, seconds),
+            "conversations": {
+                # Throughput is only meaningful overall
+                name: {key: value for key, value in summarize(conversation, 0).items() if key != "turns_per_second"}
+                for name, conversation in turns.items()
+            },
+        }
+
+    def report(self, results):
+        columns = ("turns", "p50_ms", "p95_ms", "p99_ms") + PER_TURN
+        self.stdout.write(f"{'':<12}  " + "  ".join(f"{column:>18}" for column in columns))
+        rows = [("overall", results["overall"])] + list(results["conversations"].items())
+        for name, summary in rows:
+            self.stdout.write(f"{name:<12}  " + "  ".join(f"{summary[column]:>18}" for column in columns))
+        self.stdout.write(f"throughput    {results['overall']['turns_per_second']} turns/s")
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)["overall"]
+        regressions = [
+            f"{key}: {baseline[key]} -> {results['overall'][key]}"
+            for key in GUARDED
+            if key in baseline and results["overall"][key] > baseline[key] * (1 + tolerance) + 1e-9
+        ]
+        if regressions:
+            raise CommandError("Regressed beyond the baseline: " + ", ".join(regressions))
+        self.stdout.write(f"within {tolerance:.0%} of {baseline_path}")
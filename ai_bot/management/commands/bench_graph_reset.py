@@ -0,0 +1,100 @@
+"""
+measure the patient-scoped knowledge graph reset as the graph grows
+
+python manage.py bench_graph_reset --patients 10,100,1000 --resets 5 --latency-ms 5 [--neo4j]
+
+For each graph size, writes the sample turns of bench_graph_writes for that
+many patients (shared medications, dosages and health issues, plus a few
+nodes of their own), then resets --resets of them with
+KnowledgeGraph.reset_patient and prints the graph size, reset latency,
+round trips and nodes deleted per reset. It also checks that the other
+patients' profiles are untouched and compares with clearing the whole graph
+(in-memory graph only). With --neo4j it runs against the Neo4j instance
+from .env and deletes the sample patients it wrote afterwards.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS, SAMPLE_TURNS
+
+PREFIX = "Reset Bench"
+
+
+def patient_turns(i):
+    # Every sample turn (values shared by all patients) and two turns only this patient has
+    own = [{"doctor_notes": f"note for patient {i}"}, {"health_issues": f"condition {i}", "lab_tests": f"panel {i}"}]
+    for turn in SAMPLE_TURNS + own:
+        entities = dict.fromkeys(ENTITY_FIELDS)
+        entities.update(turn)
+        yield entities
+
+
+class Command(BaseCommand):
+    help = "Report latency of the patient-scoped knowledge graph reset for growing graphs"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--patients", default="10,100,1000", help="Comma-separated graph sizes, in patients")
+        parser.add_argument("--resets", type=int, default=5, help="Patients reset per graph size")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated round-trip latency of the in-memory graph")
+        parser.add_argument("--neo4j", action="store_true", help="Run against the Neo4j instance from .env (writes sample data)")
+
+    def make_graph(self, latency):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        if self.use_neo4j:
+            return KnowledgeGraph()
+        return KnowledgeGraph(backend=InMemoryGraph(latency=latency))
+
+    def populate(self, kg, patients):
+        from ai_bot.entity_extraction import store_entities_as_documents
+
+        for i in range(patients):
+            name = f"{PREFIX} {i}"
+            kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+            for entities in patient_turns(i):
+                store_entities_as_documents(entities, name, kg=kg)
+
+    def handle(self, *args, **options):
+        self.use_neo4j = options["neo4j"]
+        latency = options["latency_ms"] / 1000
+
+        for patients in [int(size) for size in options["patients"].split(",")]:
+            kg = self.make_graph(latency)
+            self.populate(kg, patients)
+            size = self.graph_size(kg)
+
+            # The last patient is never reset: its profile must survive the others' resets
+            survivor = f"{PREFIX} {patients - 1}"
+            before = kg.get_patient_profile(survivor)
+            resets = min(options["resets"], patients - 1)
+            elapsed, round_trips, deleted = 0.0, 0, 0
+            for i in range(resets):
+                trips, start = kg.backend.round_trips, time.perf_counter()
+                counts = kg.reset_patient(f"{PREFIX} {i}", batch_size=options["batch_size"])
+                elapsed += time.perf_counter() - start
+                round_trips += kg.backend.round_trips - trips
+                deleted += counts['reset_patient_nodes'] + counts['delete_patient']
+            intact = kg.get_patient_profile(survivor) == before
+
+            line = (f"{patients:>6} patients {size:>18}  reset {1000 * elapsed / max(resets, 1):8.2f} ms  "
+                    f"{round_trips / max(resets, 1):.0f} round trips  {deleted / max(resets, 1):5.1f} nodes deleted  "
+                    f"others intact: {intact}")
+            if self.use_neo4j:
+                for i in range(resets, patients):
+                    kg.reset_patient(f"{PREFIX} {i}", batch_size=options["batch_size"])
+            else:
+                start = time.perf_counter()
+                kg.clear_graph()
+                line += f"  (clear_graph {1000 * (time.perf_counter() - start):.2f} ms)"
+            self.stdout.write(line)
+
+    def graph_size(self, kg):
+        if self.use_neo4j:
+            return ""
+        backend = kg.backend
+        return f"({backend.node_count()} nodes, {len(backend.relationships)} rels)"
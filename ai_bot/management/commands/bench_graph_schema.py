@@ -0,0 +1,94 @@
+"""
+measure MERGE latency with and without the knowledge graph constraints and indexes
+
+python manage.py bench_graph_schema --nodes 1000,100000,1000000 --turns 20 [--neo4j]
+
+For each graph size, bulk-creates that many Patient and Medication nodes,
+then writes --turns sample turns (a new patient taking one of the existing
+medications, with a dosage and frequency) through
+store_entities_as_documents before and after KnowledgeGraph.ensure_schema()
+and prints the mean and p95 latency per turn. Without an index every MERGE
+and MATCH scans its label, so "before" grows with the graph and "after"
+should not.
+
+Uses the in-memory graph (whose lookups scan or use its indexes the same
+way) unless --neo4j is given. On Neo4j, run it against a scratch instance
+without the schema: the constraints it creates are kept, and only the
+sample nodes are deleted afterwards.
+"""
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.management.commands.bench_conversations import percentile
+from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+PREFIX = "Schema Bench"
+CHUNK = 10000  # nodes per bulk CREATE
+
+
+class Command(BaseCommand):
+    help = "Compare knowledge graph MERGE latency before and after creating the schema constraints and indexes"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nodes", default="1000,100000,1000000", help="Comma-separated graph sizes, in nodes")
+        parser.add_argument("--turns", type=int, default=20, help="Turns written before and after the schema")
+        parser.add_argument("--neo4j", action="store_true", help="Run against the Neo4j instance from .env (writes sample data)")
+
+    def make_graph(self):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        if self.use_neo4j:
+            return KnowledgeGraph()
+        return KnowledgeGraph(backend=InMemoryGraph())
+
+    def populate(self, kg, size):
+        # Half patients, half medications: the two labels every medication turn looks up
+        for label, count in (("Patient", size // 2), ("Medication", size - size // 2)):
+            for start in range(0, count, CHUNK):
+                rows = [{"name": f"{PREFIX} {label} {i}"} for i in range(start, min(start + CHUNK, count))]
+                kg.backend.create_nodes(label, rows)
+
+    def write_turns(self, kg, size, turns, run):
+        from ai_bot.entity_extraction import store_entities_as_documents
+
+        timings = []
+        for i in range(turns):
+            entities = dict.fromkeys(ENTITY_FIELDS)
+            entities.update(medications=f"{PREFIX} Medication {i * 7919 % (size - size // 2)}",
+                            dosage=f"{PREFIX} {i}mg", frequency=f"{PREFIX} twice a day")
+            start = time.perf_counter()
+            store_entities_as_documents(entities, f"{PREFIX} {run} patient {i}", kg=kg)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def handle(self, *args, **options):
+        self.use_neo4j = options["neo4j"]
+        self.stdout.write(f"{'nodes':>9}  {'before mean':>12}  {'before p95':>11}  {'after mean':>11}  {'after p95':>10}  speedup")
+        for size in [int(size) for size in options["nodes"].split(",")]:
+            kg = self.make_graph()
+            self.populate(kg, size)
+            before = self.write_turns(kg, size, options["turns"], "before")
+            kg.ensure_schema()
+            after = self.write_turns(kg, size, options["turns"], "after")
+            self.stdout.write(
+                f"{size:>9}  {statistics.mean(before):9.2f} ms  {percentile(before, 95):8.2f} ms  "
+                f"{statistics.mean(after):8.2f} ms  {percentile(after, 95):7.2f} ms  "
+                f"{statistics.mean(before) / statistics.mean(after):6.1f}x"
+            )
+            if self.use_neo4j:
+                self.cleanup(kg)
+            kg.close()
+
+    @staticmethod
+    def cleanup(kg):
+        # Patients and medications by name, dosages and frequencies by value
+        kg.execute_query(
+            "MATCH (n) WHERE n.name STARTS WITH $prefix OR n.value STARTS WITH $prefix "
+            "CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS",
+            {"prefix": PREFIX},
+        )
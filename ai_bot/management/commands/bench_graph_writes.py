@@ -0,0 +1,80 @@
+"""
+benchmark the knowledge graph write path
+
+python manage.py bench_graph_writes --turns 200 --latency-ms 5
+
+Replays sample extracted-entity turns through store_entities_as_documents
+with the per-entity path and the batched path, and reports round trips and
+latency per turn. Uses the in-memory graph unless --neo4j is given.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+SAMPLE_TURNS = [
+    {"medications": "ibuprofen", "dosage": "200mg", "frequency": "every 6 hours", "health_issues": "fever"},
+    {"medications": "lisinopril, metformin", "dosage": "10mg", "frequency": "twice a day"},
+    {"allergies": "penicillin, peanuts", "family_history": "diabetes"},
+    {"weight": "80kg", "height": "180cm", "blood_pressure": "120/80", "heart_rate": "72", "temperature": "98.6f"},
+    {"lab_tests": "cbc, lipid panel", "immunizations": "flu shot, tetanus", "lifestyle_factors": "smoking, running"},
+    {"appointment_time": "next monday", "doctor_notes": "follow up in two weeks"},
+]
+
+ENTITY_FIELDS = [
+    "medications", "dosage", "frequency", "family_history", "health_issues", "appointment_time",
+    "lab_tests", "doctor_notes", "weight", "height", "blood_pressure", "heart_rate", "temperature",
+    "allergies", "lifestyle_factors", "immunizations",
+]
+
+
+class Command(BaseCommand):
+    help = "Compare round trips and latency of per-entity vs batched knowledge graph writes"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=200)
+        parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated round-trip latency of the in-memory graph")
+        parser.add_argument("--neo4j", action="store_true", help="Run against the Neo4j instance from .env (writes sample data)")
+
+    def make_graph(self, latency):
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.graph_backends import InMemoryGraph
+
+        if self.use_neo4j:
+            return KnowledgeGraph()
+        return KnowledgeGraph(backend=InMemoryGraph(latency=latency))
+
+    def run_path(self, batched, turns, latency):
+        from ai_bot.entity_extraction import store_entities_as_documents
+
+        kg = self.make_graph(latency)
+        timings = []
+        for i in range(turns):
+            entities = dict.fromkeys(ENTITY_FIELDS)
+            entities.update(SAMPLE_TURNS[i % len(SAMPLE_TURNS)])
+            start = time.perf_counter()
+            store_entities_as_documents(entities, f"Patient {i % 10}", kg=kg, batched=batched)
+            timings.append(time.perf_counter() - start)
+        return kg, timings
+
+    def handle(self, *args, **options):
+        self.use_neo4j = options["neo4j"]
+        turns = options["turns"]
+        latency = options["latency_ms"] / 1000
+
+        results = {}
+        for name, batched in (("per-entity", False), ("batched", True)):
+            kg, timings = self.run_path(batched, turns, latency)
+            timings.sort()
+            results[name] = kg
+            self.stdout.write(
+                f"{name:>10}: {kg.backend.round_trips / turns:6.1f} round trips/turn  "
+                f"mean {1000 * sum(timings) / turns:7.2f} ms  "
+                f"p95 {1000 * timings[int(0.95 * (turns - 1))]:7.2f} ms"
+            )
+
+        if not self.use_neo4j:
+            per_entity, batched = results["per-entity"].backend, results["batched"].backend
+            same = per_entity.snapshot() == batched.snapshot()
+            self.stdout.write(f"graphs identical: {same} ({batched.node_count()} nodes, {len(batched.relationships)} relationships)")
@@ -0,0 +1,75 @@
+"""
+measure prompt tokens per turn as a conversation grows
+
+python manage.py bench_history --turns 60 --max-tokens 2000
+
+Replays one long conversation through get_bot_response with a stub chat model,
+once with the whole history sent on every call and once with the windowed,
+summarized history, and prints the prompt tokens of every --every'th turn.
+"""
+
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from patients.models import Patient
+
+QUESTIONS = [
+    "I have been getting headaches in the afternoon, is that related to my blood pressure?",
+    "I take lisinopril 10mg every morning, should I take it at night instead?",
+    "What foods should I avoid with hypertension?",
+    "Can I keep running three times a week?",
+]
+REPLY = ("Afternoon headaches can have several causes, including blood pressure changes, dehydration and "
+         "screen time. Keep a short log of when they happen and what you were doing, and share it with "
+         "Dr. Smith at your next appointment. If they are severe or sudden, seek care right away.")
+
+
+class Command(BaseCommand):
+    help = "Compare prompt tokens per turn of the full and the token-budgeted chat history"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=60)
+        parser.add_argument("--max-tokens", type=int, default=2000, help="History budget of the windowed run")
+        parser.add_argument("--every", type=int, default=10, help="Print every n-th turn")
+
+    def replay(self, turns, session_id):
+        from ai_bot.history import prompt_token_stats
+        from ai_bot.langchain_integration import get_bot_response
+
+        patient = Patient(
+            first_name="Long", last_name="Conversation", date_of_birth=date(1980, 1, 1),
+            medical_condition="Hypertension", medication_regimen="Lisinopril 10mg once daily",
+            doctor_name="Dr. John Smith",
+        )
+        tokens = []
+        prompt_token_stats.reset()
+        for turn in range(turns):
+            get_bot_response(QUESTIONS[turn % len(QUESTIONS)], patient, session_id=session_id)
+            tokens.append(prompt_token_stats.snapshot()['last'])
+        return tokens
+
+    def handle(self, *args, **options):
+        from ai_bot import langchain_integration
+        from ai_bot.fakes import StubChatModel
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        set_session_store(MemorySessionStore())
+        langchain_integration.set_response_cache(None)  # every turn should reach the model
+        langchain_integration.set_chat_model(StubChatModel(
+            respond=lambda messages: "Summary: patient asks about headaches, lisinopril timing, diet and running."
+            if "running summary" in messages[-1].content else REPLY,
+        ))
+
+        turns = options["turns"]
+        with override_settings(AI_BOT_HISTORY_MAX_TOKENS=10 ** 9, AI_BOT_HISTORY_SUMMARY=False):
+            full = self.replay(turns, "bench-full")
+        with override_settings(AI_BOT_HISTORY_MAX_TOKENS=options["max_tokens"], AI_BOT_HISTORY_SUMMARY=True):
+            windowed = self.replay(turns, "bench-windowed")
+
+        self.stdout.write(f"{'turn':>5}  {'full history':>12}  {'windowed':>9}")
+        for turn in range(0, turns, options["every"]):
+            self.stdout.write(f"{turn + 1:>5}  {full[turn]:>12}  {windowed[turn]:>9}")
+        self.stdout.write(f"{'total':>5}  {sum(full):>12}  {sum(windowed):>9}")
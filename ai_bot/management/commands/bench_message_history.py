@@ -0,0 +1,107 @@
+"""
+measure opening the chat page and loading its history as a conversation grows
+
+python manage.py bench_message_history --messages 1000,100000 --repeat 10
+
+For each conversation size, against a throwaway test database, bulk-creates
+a conversation of that many messages and times, through the Django test
+client:
+    full      the chat page rendering the whole history (as before pagination)
+    page      the chat page rendering the latest CHAT_HISTORY_PAGE_SIZE messages
+    newest    the history endpoint: the page before the oldest rendered message
+    oldest    the history endpoint: the first page of the conversation (keyset)
+and the query alone for that oldest page, with keyset pagination and with
+LIMIT/OFFSET for comparison. Prints the mean and p95 latency, response size and ORM queries.
+"""
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.management.commands.bench_conversations import make_patient, percentile
+
+CHUNK = 5000  # messages per bulk INSERT
+
+
+class Command(BaseCommand):
+    help = "Report chat page and message history latency for growing conversations"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", default="1000,100000", help="Comma-separated conversation sizes, in messages")
+        parser.add_argument("--repeat", type=int, default=10, help="Requests timed per measurement")
+
+    def handle(self, *args, **options):
+        from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+            teardown_test_environment
+
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.stdout.write(f"{'messages':>9}  {'request':<8}  {'mean':>10}  {'p95':>10}  {'bytes':>10}  queries")
+            for size in [int(size) for size in options["messages"].split(",")]:
+                self.bench(size, options["repeat"])
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+    def populate(self, size):
+        from chat.models import Conversation, Message
+
+        patient = make_patient()
+        conversation = Conversation.objects.create(patient=patient)
+        for start in range(0, size, CHUNK):
+            Message.objects.bulk_create(
+                Message(conversation=conversation, sender=('patient', 'bot')[i % 2], content=f"Message {i} of the sample conversation")
+                for i in range(start, min(start + CHUNK, size))
+            )
+        return patient, conversation
+
+    def bench(self, size, repeat):
+        from django.conf import settings
+        from django.db import connection
+        from django.test import Client
+        from django.test.utils import CaptureQueriesContext
+        from django.urls import reverse
+
+        patient, conversation = self.populate(size)
+        client = Client()
+        client.force_login(patient.user)
+        page_size = settings.CHAT_HISTORY_PAGE_SIZE
+        messages = conversation.messages.order_by('timestamp', 'id')
+        newest = conversation.messages.page(limit=page_size)[0].cursor
+        oldest = messages[page_size].cursor
+        history = reverse('chat_messages')
+
+        def offset_page():
+            # What an OFFSET-paginated endpoint would read for the same page
+            return list(conversation.messages.order_by('-timestamp', '-id')[size - page_size:size])
+
+        requests = {
+            "full": lambda: self.render_all(client, size),
+            "page": lambda: client.get(reverse('chat')),
+            "newest": lambda: client.get(history, {'before': newest}),
+            "oldest": lambda: client.get(history, {'before': oldest}),
+            "keyset": lambda: conversation.messages.page(before=oldest, limit=page_size),
+            "offset": offset_page,
+        }
+        for name, request in requests.items():
+            timings = []
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = request()
+                    timings.append((time.perf_counter() - start) * 1000)
+            length = len(response.content) if hasattr(response, 'content') else ""
+            self.stdout.write(f"{size:>9}  {name:<8}  {statistics.mean(timings):7.2f} ms  {percentile(timings, 95):7.2f} ms  "
+                              f"{length:>10}  {len(queries)}")
+        patient.delete()
+
+    @staticmethod
+    def render_all(client, size):
+        from django.test.utils import override_settings
+        from django.urls import reverse
+
+        with override_settings(CHAT_HISTORY_PAGE_SIZE=size):
+            return client.get(reverse('chat'))
@@ -0,0 +1,108 @@
+"""
+benchmark the patient profile fetch
+
+python manage.py bench_profile_fetch --sizes 1,2,3 --repeat 5
+
+Builds synthetic patients with N items per relationship type (and N dosages
+and frequencies per medication), then compares the chained OPTIONAL MATCH
+query ('cartesian') with the per-relationship aggregated query: intermediate
+rows, round trips and latency. Uses the in-memory graph unless --neo4j is given;
+against Neo4j the row counts come from PROFILE.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.graph_writer import GraphBatch
+from ai_bot.knowledge_graph import owned_node_key
+
+PATIENT_RELATIONSHIPS = [
+    ('HAS', 'HealthIssue', 'description'),
+    ('SCHEDULES', 'Appointment', 'time'),
+    ('HAS_LAB_TEST', 'LabTest', 'name'),
+    ('HAS_NOTE', 'DoctorNote', 'content'),
+    ('HAS_ALLERGY', 'Allergy', 'name'),
+    ('HAS_FAMILY_HISTORY', 'FamilyHistory', 'description'),
+    ('HAS_LIFESTYLE_FACTOR', 'LifestyleFactor', 'description'),
+    ('HAS_IMMUNIZATION', 'Immunization', 'name'),
+]
+
+
+def synthetic_patient(name, size):
+    batch = GraphBatch()
+    patient = {'name': name}
+    batch.add_entity('Patient', patient)
+    for i in range(size):
+        medication = {'name': f'{name} medication {i}'}
+        batch.add_entity('Medication', medication)
+        batch.add_relationship('Patient', patient, 'TAKES', 'Medication', medication)
+        for j in range(size):
+            dosage, frequency = {'value': f'{10 * (j + 1)}mg'}, {'value': f'{j + 1} times a day'}
+            batch.add_entity('Dosage', dosage)
+            batch.add_relationship('Medication', medication, 'HAS_DOSAGE', 'Dosage', dosage)
+            batch.add_entity('Frequency', frequency)
+            batch.add_relationship('Medication', medication, 'HAS_FREQUENCY', 'Frequency', frequency)
+        for relation, label, key in PATIENT_RELATIONSHIPS:
+            node = {key: f'{name} {label} {i}'}
+            if label == 'DoctorNote':
+                node['key'] = owned_node_key(name, node['content'])
+            batch.add_entity(label, node)
+            batch.add_relationship('Patient', patient, relation, label, node)
+        vital = {'weight': f'{70 + i}kg', 'height': '180cm', 'blood_pressure': '120/80', 'heart_rate': f'{60 + i}', 'temperature': '98.6f'}
+        vital = {'key': owned_node_key(name, *vital.values()), **vital}
+        batch.add_entity('Vital', vital)
+        batch.add_relationship('Patient', patient, 'HAS_VITAL', 'Vital', vital)
+    return batch
+
+
+class Command(BaseCommand):
+    help = "Compare row counts and latency of the cartesian and aggregated patient profile queries"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1,2,3", help="Comma-separated items per relationship type")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated round-trip latency of the in-memory graph")
+        parser.add_argument("--neo4j", action="store_true", help="Run against the Neo4j instance from .env (writes synthetic patients)")
+
+    def row_count(self, kg, query_name, name):
+        if not self.use_neo4j:
+            return kg.backend.last_row_count
+        from ai_bot.cypher_queries import catalog
+
+        def rows(plan):
+            return plan.get('rows', 0) + sum(rows(child) for child in plan.get('children', []))
+
+        with kg.backend.driver.session(database=kg.backend.database) as session:
+            summary = session.run("PROFILE " + catalog.prepare(query_name).text, {'name': name}).consume()
+        return rows(summary.profile)
+
+    def handle(self, *args, **options):
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.graph_backends import InMemoryGraph
+
+        self.use_neo4j = options["neo4j"]
+        kg = KnowledgeGraph() if self.use_neo4j else KnowledgeGraph(backend=InMemoryGraph(latency=options["latency_ms"] / 1000))
+        repeat = options["repeat"]
+
+        self.stdout.write(f"{'size':>4}  {'mode':>10}  {'rows':>10}  {'round trips':>11}  {'mean ms':>9}")
+        for size in (int(s) for s in options["sizes"].split(",")):
+            name = f"Synthetic Patient {size}"
+            kg.write_batch(synthetic_patient(name, size))
+            kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+
+            records = {}
+            for mode, query_name in (("cartesian", "patient_profile"), ("aggregated", "patient_profile_aggregated")):
+                round_trips = kg.backend.round_trips
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    records[mode] = kg.get_patient_profile(name, mode=mode)
+                elapsed = (time.perf_counter() - start) / repeat
+                round_trips = (kg.backend.round_trips - round_trips) / repeat
+                rows = self.row_count(kg, query_name, name)
+                self.stdout.write(f"{size:>4}  {mode:>10}  {rows:>10}  {round_trips:>11.0f}  {1000 * elapsed:>9.2f}")
+
+            same = {k: sorted(v) if isinstance(v, list) else v for k, v in records["cartesian"].items()} == \
+                {k: sorted(v) if isinstance(v, list) else v for k, v in records["aggregated"].items()}
+            self.stdout.write(f"      profiles identical: {same}")
@@ -0,0 +1,115 @@
+"""
+replay patient conversations against the profile read model
+
+python manage.py bench_profile_store --patients 50 --turns 12 --latency-ms 5 [--store memory|db] [--neo4j]
+
+Replays the turns of bench_graph_reset (medications, dosages and health
+issues shared by every patient, plus notes of their own) for --patients
+patients, interleaved, with merge_patient before each write and a reset of
+every tenth patient halfway through. After every turn it reads the
+patient's profile through the read model (read_patient_profile) and from
+the graph (get_patient_profile), checks that they match, and prints both
+latencies, the store's hit rate and the graph round trips of each read.
+Uses the in-memory graph unless --neo4j is given.
+"""
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_bot.management.commands.bench_conversations import percentile
+from ai_bot.management.commands.bench_graph_reset import patient_turns
+
+PREFIX = "Profile Bench"
+
+
+def same_profile(a, b):
+    """
+    Compare two profile records regardless of the order of their values
+    """
+    def normalized(record):
+        return record and {k: sorted(v) if isinstance(v, list) else v for k, v in record.items()}
+
+    return normalized(a) == normalized(b)
+
+
+class Command(BaseCommand):
+    help = "Check the patient profile read model against the graph and compare read latency"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--patients", type=int, default=50)
+        parser.add_argument("--turns", type=int, default=12, help="Turns replayed per patient")
+        parser.add_argument("--store", choices=["memory", "db"], default="memory")
+        parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated round-trip latency of the in-memory graph")
+        parser.add_argument("--neo4j", action="store_true", help="Run against the Neo4j instance from .env (writes sample data)")
+
+    def handle(self, *args, **options):
+        from django.test.utils import setup_databases, teardown_databases
+
+        # The db store writes ProfileEntry rows: keep them in a throwaway test database
+        databases = setup_databases(verbosity=0, interactive=False) if options["store"] == "db" else None
+        try:
+            self.bench(options)
+        finally:
+            if databases is not None:
+                teardown_databases(databases, verbosity=0)
+
+    def make_graph(self, options):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.profile_store import DatabaseProfileStore, MemoryProfileStore
+
+        if options["neo4j"]:
+            kg = KnowledgeGraph()
+        else:
+            kg = KnowledgeGraph(backend=InMemoryGraph(latency=options["latency_ms"] / 1000))
+        kg.profiles = DatabaseProfileStore() if options["store"] == "db" else MemoryProfileStore()
+        return kg
+
+    def bench(self, options):
+        from ai_bot.entity_extraction import store_entities_as_documents
+
+        kg = self.make_graph(options)
+        patients = options["patients"]
+        turns = {i: list(patient_turns(i)) for i in range(patients)}
+        reads = {"graph": [], "store": []}
+        round_trips = {"graph": 0, "store": 0}
+        mismatches = 0
+
+        for turn in range(options["turns"]):
+            for i in range(patients):
+                name = f"{PREFIX} {i}"
+                if i % 10 == 0 and turn == options["turns"] // 2:
+                    kg.reset_patient(name)
+                kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=turn % 3 == 0)
+                store_entities_as_documents(turns[i][turn % len(turns[i])], name, kg=kg)
+
+                records = {}
+                for source, read in (("store", kg.read_patient_profile), ("graph", kg.get_patient_profile)):
+                    before = kg.backend.round_trips
+                    start = time.perf_counter()
+                    records[source] = read(name)
+                    reads[source].append((time.perf_counter() - start) * 1000)
+                    round_trips[source] += kg.backend.round_trips - before
+                if not same_profile(records["store"], records["graph"]):
+                    mismatches += 1
+                    self.stderr.write(f"Profile of {name} after turn {turn} differs:\n"
+                                      f"  store {records['store']}\n  graph {records['graph']}")
+
+        stats = kg.profiles.stats()
+        self.stdout.write(f"{patients} patients x {options['turns']} turns, {stats['backend']}")
+        self.stdout.write(f"{'read':<6}  {'mean':>10}  {'p95':>10}  round trips/read")
+        for source, timings in reads.items():
+            self.stdout.write(f"{source:<6}  {statistics.mean(timings):7.3f} ms  {percentile(timings, 95):7.3f} ms  "
+                              f"{round_trips[source] / len(timings):.2f}")
+        self.stdout.write(f"hit rate {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses), "
+                          f"{stats['updates']} entry updates, {stats['entries']} entries")
+
+        if options["neo4j"]:
+            for i in range(patients):
+                kg.reset_patient(f"{PREFIX} {i}")
+        if mismatches:
+            raise CommandError(f"{mismatches} profiles read from the store differ from the graph")
+        self.stdout.write("store matches the graph after every turn")
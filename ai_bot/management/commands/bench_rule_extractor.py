@@ -0,0 +1,95 @@
+"""
+measure the rule-based extraction fast path against a labelled corpus
+
+python manage.py bench_rule_extractor --threshold 0.8 [--llm] [--verbose]
+
+Runs ai_bot.rule_extractor over ai_bot/data/extraction_corpus.jsonl (one
+{"input", "entities"} object per line) and prints the share of messages it
+answers without the LLM, how often those answers agree with the labels, and
+the time per message. With --llm every message is also sent through the LLM
+extraction chain (needs OPENAI_API_KEY), to report how often the rules agree
+with the LLM and the LLM with the labels.
+"""
+
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+CORPUS = Path(__file__).resolve().parents[2] / "data" / "extraction_corpus.jsonl"
+
+
+def comparable(entities):
+    # Order, case and spacing of comma-separated values don't matter
+    return {
+        field: sorted(item.strip().replace(" ", "") for item in str(value).lower().split(","))
+        for field, value in (entities or {}).items() if value
+    }
+
+
+def agree(left, right):
+    return comparable(left) == comparable(right)
+
+
+class Command(BaseCommand):
+    help = "Report LLM-call avoidance and agreement of the rule-based entity extractor"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--corpus", default=str(CORPUS))
+        parser.add_argument("--threshold", type=float, default=None,
+                            help="Confidence needed to skip the LLM (default: settings.AI_BOT_RULE_EXTRACTOR_CONFIDENCE)")
+        parser.add_argument("--llm", action="store_true", help="Also compare with the live LLM extraction")
+        parser.add_argument("--verbose", action="store_true", help="Print every message and its outcome")
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        from ai_bot import rule_extractor
+
+        threshold = options["threshold"]
+        if threshold is None:
+            threshold = settings.AI_BOT_RULE_EXTRACTOR_CONFIDENCE
+        with open(options["corpus"]) as corpus:
+            examples = [json.loads(line) for line in corpus if line.strip()]
+
+        confident = agreed = 0
+        llm_agreed = rules_llm_agreed = 0
+        elapsed = 0.0
+        for example in examples:
+            start = time.perf_counter()
+            result = rule_extractor.extract(example["input"])
+            elapsed += time.perf_counter() - start
+
+            skipped = result.confident(threshold)
+            correct = skipped and agree(result.entities, example["entities"])
+            confident += skipped
+            agreed += correct
+
+            outcome = ("ok" if correct else "WRONG") if skipped else "llm"
+            if options["llm"]:
+                llm_entities = self.llm_extract(example["input"])
+                llm_agreed += agree(llm_entities, example["entities"])
+                rules_llm_agreed += skipped and agree(result.entities, llm_entities)
+            if options["verbose"]:
+                self.stdout.write(f"{outcome:<6} {result.score:.2f}  {example['input']!r} -> {result.entities}")
+
+        total = len(examples)
+        self.stdout.write(f"messages                    {total}")
+        self.stdout.write(f"answered by rules           {confident} ({confident / total:.0%} of LLM calls avoided)")
+        self.stdout.write(f"rules agree with labels     {agreed}/{confident} ({agreed / max(confident, 1):.0%})")
+        self.stdout.write(f"rule time per message       {elapsed / total * 1000:.3f} ms")
+        if options["llm"]:
+            self.stdout.write(f"rules agree with LLM        {rules_llm_agreed}/{confident} ({rules_llm_agreed / max(confident, 1):.0%})")
+            self.stdout.write(f"LLM agrees with labels      {llm_agreed}/{total} ({llm_agreed / total:.0%})")
+
+    @staticmethod
+    def llm_extract(text):
+        # Straight to the chain: neither the rules nor the extraction cache
+        from ai_bot import entity_extraction
+
+        try:
+            response = entity_extraction.get_chains().chain.invoke({"input": text})
+        except Exception as error:
+            return {"error": str(error)}
+        return {field: value for field, value in response.items() if value}
@@ -0,0 +1,109 @@
+"""
+A/B the two-call pipeline against single-shot turns
+
+python manage.py bench_single_shot --turns 20 --llm-latency-ms 800 --ms-per-token 15
+
+Replays the same conversation through the sequential pipeline, the pipeline
+with a speculative reply (AI_BOT_SPECULATIVE_RESPONSE) and single-shot turns
+(AI_BOT_SINGLE_SHOT), with StubChatModel and InMemoryGraph standing in for
+OpenAI and Neo4j, and prints the mean wall time, LLM calls and tokens per
+turn of each. The same numbers are collected in production by the
+ai_bot_turn_* histograms at /metrics (AI_BOT_SINGLE_SHOT=ab).
+"""
+
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from ai_bot.management.commands.bench_concurrency import make_patient
+
+MESSAGES = [
+    "I twisted my ankle yesterday, what should I do?",
+    "I take lisinopril 10mg once a day",
+    "Is it fine to go for a walk?",
+    "I have been feeling tired after my morning runs, should I worry?",
+]
+MODES = [
+    ("pipeline", dict(AI_BOT_SINGLE_SHOT="off", AI_BOT_SPECULATIVE_RESPONSE=False)),
+    ("speculative", dict(AI_BOT_SINGLE_SHOT="off", AI_BOT_SPECULATIVE_RESPONSE=True)),
+    ("single_shot", dict(AI_BOT_SINGLE_SHOT="on", AI_BOT_SPECULATIVE_RESPONSE=False)),
+]
+MEDICATION = {"medications": "lisinopril", "dosage": "10mg", "frequency": "once a day"}
+REPLY = "Rest, ice, compress and elevate the ankle, and avoid putting weight on it for a day or two."
+
+
+def entities_for(message):
+    return MEDICATION if "mg" in message else {}
+
+
+def stub_reply(messages, per_token):
+    from ai_bot.history import count_tokens
+
+    message = messages[-1].content
+    if "Answer in JSON only" in messages[0].content:
+        reply = json.dumps({"reply": REPLY, "entities": entities_for(message)})
+    elif "Extract" in messages[0].content:  # full or targeted extraction
+        reply = json.dumps(entities_for(message))
+    else:
+        reply = REPLY
+    time.sleep(per_token * count_tokens(reply))
+    return reply
+
+
+class Command(BaseCommand):
+    help = "Compare latency and LLM tokens per turn of the pipeline and single-shot agent modes"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=20)
+        parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+        parser.add_argument("--ms-per-token", type=float, default=15.0, help="Stub generation time per completion token")
+        parser.add_argument("--graph-latency-ms", type=float, default=20.0)
+
+    def install_stubs(self, options):
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.fakes import StubChatModel
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph, set_knowledge_graph
+
+        set_knowledge_graph(KnowledgeGraph(backend=InMemoryGraph(latency=options["graph_latency_ms"] / 1000)))
+        entity_extraction.set_extraction_cache(None)
+        langchain_integration.set_response_cache(None)
+        per_token, latency = options["ms_per_token"] / 1000, options["llm_latency_ms"] / 1000
+        model = StubChatModel(respond=lambda messages: stub_reply(messages, per_token), latency=latency)
+        entity_extraction.set_chat_model(model)
+        langchain_integration.set_chat_model(model)
+
+    def run(self, turns, mode):
+        from ai_bot import agent, instrumentation
+        from ai_bot.bot import generate_bot_response
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        # Every mode starts from an empty chat history
+        set_session_store(MemorySessionStore())
+        patient = make_patient(mode)
+        totals = dict.fromkeys(("ms", "llm_calls", "prompt_tokens", "completion_tokens"), 0)
+        for turn in range(turns):
+            metrics, tokens = instrumentation.begin("bench")
+            start = time.perf_counter()
+            generate_bot_response(MESSAGES[turn % len(MESSAGES)], patient, session_id=f"single-shot-{mode}")
+            totals["ms"] += (time.perf_counter() - start) * 1000
+            instrumentation.end(tokens)
+            for counter in ("llm_calls", "prompt_tokens", "completion_tokens"):
+                totals[counter] += metrics.totals()[counter]
+        agent.graph_writes.flush()
+        return {counter: value / turns for counter, value in totals.items()}
+
+    def handle(self, *args, **options):
+        self.install_stubs(options)
+        results = {}
+        for mode, settings in MODES:
+            with override_settings(**settings):
+                results[mode] = self.run(options["turns"], mode)
+
+        self.stdout.write(f"{'mean per turn':<20}  " + "  ".join(f"{mode:>12}" for mode, _ in MODES))
+        for counter, label in (("ms", "wall ms"), ("llm_calls", "LLM calls"),
+                               ("prompt_tokens", "prompt tokens"), ("completion_tokens", "completion tokens")):
+            self.stdout.write(f"{label:<20}  " + "  ".join(f"{results[mode][counter]:>12.1f}" for mode, _ in MODES))
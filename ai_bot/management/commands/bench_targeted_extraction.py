@@ -0,0 +1,100 @@
+"""
+compare full and targeted extraction of answers to follow-up questions
+
+python manage.py bench_targeted_extraction --llm-latency-ms 300 --ms-per-token 15 [--live]
+
+Extracts the answers of the medication follow-up flow (QUESTIONS[...]["follow_ups"])
+three ways: the full HealthEntity prompt, the targeted prompt for the pending
+question, and the targeted prompt behind the rule-based fast path. Prints LLM
+calls, prompt and completion tokens and extraction time per answer. The stub
+model answers like the real one would (every requested key, null when absent)
+and takes --llm-latency-ms plus --ms-per-token for each completion token;
+--live uses the configured OpenAI model instead.
+"""
+
+import json
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+# (pending question, patient's answer, what the answer contains)
+ANSWERS = [
+    ("medications", "lisinopril and metformin", {"medications": "lisinopril, metformin"}),
+    ("dosages", "lisinopril, 10mg", {"medications": "lisinopril", "dosage": "10mg"}),
+    ("frequencies", "lisinopril, twice a day", {"medications": "lisinopril", "frequency": "twice a day"}),
+    ("dosages", "500 mg", {"dosage": "500mg"}),
+    ("frequencies", "every 8 hours as needed", {"frequency": "every 8 hours, as needed"}),
+    ("dosages", "the small one is ten milligrams I think", {"dosage": "ten milligrams"}),
+    ("frequencies", "whenever the pain comes back, maybe two or three times", {"frequency": "two or three times"}),
+    ("medications", "the blood pressure pill my doctor gave me in march", {}),
+    ("family_history", "My mother had diabetes", {"family_history": "mother had diabetes"}),
+    ("health_issues", "headaches and nausea", {"health_issues": "headaches, nausea"}),
+]
+MODES = [
+    ("full", dict(AI_BOT_TARGETED_EXTRACTION=False, AI_BOT_RULE_EXTRACTOR=False)),
+    ("targeted", dict(AI_BOT_TARGETED_EXTRACTION=True, AI_BOT_RULE_EXTRACTOR=False)),
+    ("targeted+rules", dict(AI_BOT_TARGETED_EXTRACTION=True, AI_BOT_RULE_EXTRACTOR=True)),
+]
+ALL_FIELDS = ["medications", "dosage", "frequency", "family_history", "health_issues", "appointment_time",
+              "lab_tests", "doctor_notes", "weight", "height", "blood_pressure", "heart_rate", "temperature",
+              "allergies", "lifestyle_factors", "immunizations"]
+
+
+def stub_reply(messages, per_token):
+    from ai_bot.history import count_tokens
+
+    system, answer = messages[0].content, messages[-1].content
+    asked = re.search(r"Extract only these fields from their answer: (.+)\.", system)
+    fields = asked.group(1).split(", ") if asked else ALL_FIELDS
+    found = next((entities for _, text, entities in ANSWERS if text == answer), {})
+    reply = json.dumps({field: found.get(field) for field in fields})
+    time.sleep(per_token * count_tokens(reply))
+    return reply
+
+
+class Command(BaseCommand):
+    help = "Report LLM tokens and latency of full vs targeted follow-up answer extraction"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+        parser.add_argument("--ms-per-token", type=float, default=15.0, help="Stub generation time per completion token")
+        parser.add_argument("--live", action="store_true", help="Use the configured OpenAI model instead of the stub")
+
+    def run(self, settings):
+        from ai_bot import instrumentation
+        from ai_bot.entity_extraction import extract_answer, extract_entities
+
+        totals = dict.fromkeys(("llm_calls", "prompt_tokens", "completion_tokens", "ms"), 0)
+        with override_settings(**settings):
+            for question, answer, _ in ANSWERS:
+                metrics, tokens = instrumentation.begin("bench")
+                start = time.perf_counter()
+                if settings["AI_BOT_TARGETED_EXTRACTION"]:
+                    extract_answer(answer, question)
+                else:
+                    extract_entities(answer)
+                totals["ms"] += (time.perf_counter() - start) * 1000
+                instrumentation.end(tokens)
+                for counter in ("llm_calls", "prompt_tokens", "completion_tokens"):
+                    totals[counter] += metrics.totals()[counter]
+        return {counter: value / len(ANSWERS) for counter, value in totals.items()}
+
+    def handle(self, *args, **options):
+        from ai_bot import entity_extraction
+        from ai_bot.fakes import StubChatModel
+
+        entity_extraction.set_extraction_cache(None)
+        if not options["live"]:
+            per_token = options["ms_per_token"] / 1000
+            entity_extraction.set_chat_model(StubChatModel(
+                respond=lambda messages: stub_reply(messages, per_token), latency=options["llm_latency_ms"] / 1000,
+            ))
+
+        results = {name: self.run(settings) for name, settings in MODES}
+        self.stdout.write(f"per answer ({len(ANSWERS)} answers)  " + "  ".join(f"{name:>14}" for name, _ in MODES))
+        for counter, label in (("llm_calls", "LLM calls"), ("prompt_tokens", "prompt tokens"),
+                               ("completion_tokens", "completion tokens"), ("ms", "extraction ms")):
+            self.stdout.write(f"{label:<24}  " + "  ".join(f"{results[name][counter]:>14.1f}" for name, _ in MODES))
@@ -0,0 +1,21 @@
+"""
+delete expired ChatSession rows
+
+python manage.py clear_chat_sessions
+
+Only needed with AI_BOT_SESSION_STORE=db; the memory and redis backends
+expire sessions themselves. Run it periodically, like clearsessions.
+"""
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.session_store import DatabaseSessionStore
+
+
+class Command(BaseCommand):
+    help = "Delete expired agent sessions from the database session store"
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        deleted = DatabaseSessionStore().clear_expired()
+        self.stdout.write(f"Deleted {deleted} expired session(s)")
@@ -0,0 +1,30 @@
+"""
+delete persisted entity extractions
+
+python manage.py clear_extraction_cache [--all]
+
+By default only entries of an older extraction prompt, schema or model, and
+expired ones, are deleted; --all empties the table.
+"""
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.extraction_cache import ExtractionCache
+
+
+class Command(BaseCommand):
+    help = "Delete stale (or all) entries of the persistent entity extraction cache"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Delete every entry, not just stale ones")
+
+    def handle(self, *args, **options):
+        from ai_bot.entity_extraction import get_chains
+
+        cache = ExtractionCache(persistent=True)
+        if options["all"]:
+            deleted = cache.model.objects.all().delete()[0]
+        else:
+            deleted = cache.purge_stale(get_chains().cache_version)
+        self.stdout.write(f"Deleted {deleted} cached extraction(s)")
@@ -0,0 +1,31 @@
+"""
+delete cached general replies
+
+python manage.py clear_response_cache [--all]
+
+By default only entries of an older system prompt or model, and expired
+ones, are deleted; --all empties the table (e.g. after changing medical
+guidance the bot should give).
+"""
+
+from django.core.management.base import BaseCommand
+
+from ai_bot.response_cache import ResponseCache
+
+
+class Command(BaseCommand):
+    help = "Delete stale (or all) entries of the general reply cache"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Delete every entry, not just stale ones")
+
+    def handle(self, *args, **options):
+        from ai_bot.langchain_integration import get_chains
+
+        cache = ResponseCache()
+        if options["all"]:
+            deleted = cache.model.objects.all().delete()[0]
+        else:
+            deleted = cache.purge_stale(get_chains().cache_version)
+        self.stdout.write(f"Deleted {deleted} cached replies")
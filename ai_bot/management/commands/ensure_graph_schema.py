@@ -0,0 +1,39 @@
+"""
+create the knowledge graph constraints and indexes
+
+python manage.py ensure_graph_schema
+
+Creates a uniqueness constraint or index for every label of the knowledge
+graph schema (ai_bot.knowledge_graph.SCHEMA_INDEXES) on the configured graph,
+skipping the ones that already exist, so it is safe to run on every deploy.
+Constraints of earlier schemas (OBSOLETE_INDEXES) are dropped first.
+Workers do the same when they first connect unless
+AI_BOT_GRAPH_ENSURE_SCHEMA is off.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_bot.knowledge_graph import SCHEMA_INDEXES
+
+
+class Command(BaseCommand):
+    help = "Create the knowledge graph constraints and indexes that do not exist yet"
+    requires_system_checks = []
+
+    def handle(self, *args, **options):
+        from ai_bot.backends import build_graph_backend
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        kg = KnowledgeGraph(backend=build_graph_backend())
+        try:
+            kg.ensure_schema()
+        except Exception as error:
+            # Typically duplicates written before the constraints existed
+            raise CommandError(f"Could not create the graph schema: {error}")
+        finally:
+            kg.close()
+
+        for label, keys, kind in SCHEMA_INDEXES:
+            self.stdout.write(f"{kind:<6}  :{label}({', '.join(keys)})")
+        self.stdout.write(f"{len(SCHEMA_INDEXES)} constraints and indexes in place "
+                          f"({kg.timings['ensure_schema']['total_ms']:.0f} ms)")
@@ -0,0 +1,111 @@
+"""
+report the import time of Django startup and of the AI stack, per module
+
+python manage.py importtime [--top 15] [--check] [--output importtime.json]
+
+Runs `python -X importtime` in a fresh interpreter for each stage:
+    setup   django.setup(): settings, apps and models (every manage.py command)
+    urls    setup plus the URLconf and middleware (manage.py check, a worker boot)
+    chat    urls plus ai_bot.bot, which the first chat turn imports
+and prints each stage's total import time, the packages and the modules
+that cost the most (self time, and cumulative time of the modules
+outside Django), and whether the AI stack (LangChain, LangGraph, OpenAI,
+the Neo4j driver) was imported. With --check the command fails when setup
+or urls imports the AI stack.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Code run in a fresh interpreter after django.setup(), cumulatively
+STAGES = {
+    "setup": "",
+    # Loads the middleware and resolves every URL pattern, i.e. imports the views
+    "urls": "from django.core.handlers.wsgi import WSGIHandler; WSGIHandler()\n"
+            "from django.urls import get_resolver; get_resolver().url_patterns\n",
+    "chat": "import ai_bot.bot\n",
+}
+# Stages that must not import the AI stack (--check)
+LIGHT_STAGES = ("setup", "urls")
+AI_STACK = ("langchain", "langchain_core", "langchain_community", "langchain_openai", "langgraph", "openai", "neo4j")
+
+
+def parse_importtime(stderr):
+    """
+    {module: (self_us, cumulative_us)} from the stderr of `python -X importtime`
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def summarize(modules, top):
+    packages = {}
+    for name, (self_us, _) in modules.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    by_self = sorted(modules.items(), key=lambda item: -item[1][0])
+    # Cumulative time says which import pulled a package in; Django's own are left out
+    by_cumulative = sorted(((name, times) for name, times in modules.items() if not name.startswith("django")),
+                           key=lambda item: -item[1][1])
+    return {
+        "total_ms": round(sum(self_us for self_us, _ in modules.values()) / 1000, 1),
+        "modules": len(modules),
+        "ai_stack": sorted(package for package in packages if package in AI_STACK),
+        "packages_ms": {package: round(us / 1000, 1) for package, us in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        "self_ms": {name: round(self_us / 1000, 1) for name, (self_us, _) in by_self[:top]},
+        "cumulative_ms": {name: round(cumulative_us / 1000, 1) for name, (_, cumulative_us) in by_cumulative[:top]},
+    }
+
+
+class Command(BaseCommand):
+    help = "Report the import time of Django startup, the URLconf and the AI stack, per module"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=15, help="Packages and modules listed per stage")
+        parser.add_argument("--check", action="store_true",
+                            help="Fail when django.setup() or the URLconf imports the AI stack")
+        parser.add_argument("--output", help="Write the report to this JSON file")
+
+    def handle(self, *args, **options):
+        report, code = {}, "import django; django.setup()\n"
+        for stage, stage_code in STAGES.items():
+            code += stage_code
+            report[stage] = summarize(self.importtime(code), options["top"])
+        for stage, summary in report.items():
+            self.report(stage, summary)
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(report, output, indent=2)
+        if options["check"]:
+            heavy = {stage: report[stage]["ai_stack"] for stage in LIGHT_STAGES if report[stage]["ai_stack"]}
+            if heavy:
+                raise CommandError("The AI stack is imported at startup: " + "; ".join(
+                    f"{stage}: {', '.join(packages)}" for stage, packages in heavy.items()))
+
+    @staticmethod
+    def importtime(code):
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "patient_chat_app.settings")}
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True)
+        if result.returncode:
+            errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+            raise CommandError(errors[-1] if errors else f"exit status {result.returncode}")
+        return parse_importtime(result.stderr)
+
+    def report(self, stage, summary):
+        stack = ", ".join(summary["ai_stack"]) or "not imported"
+        self.stdout.write(f"{stage}: {summary['total_ms']} ms in {summary['modules']} modules; AI stack: {stack}")
+        for title in ("packages_ms", "self_ms", "cumulative_ms"):
+            self.stdout.write(f"  {title.replace('_ms', '')}:")
+            for name, ms in summary[title].items():
+                self.stdout.write(f"    {ms:>9.1f} ms  {name}")
@@ -0,0 +1,298 @@
+"""
+drive concurrent patient traffic through chat.urls at target request rates
+
+python manage.py loadtest --patients 20 --rates 2,5,10,20 --duration 30 --workers wsgi:8,asgi [--fakes]
+
+Creates --patients patients, each with their own user and Conversation,
+on a throwaway test database. Every patient signs in and replays the medication, appointment
+and general-inquiry scripts (one after the other, starting at a different
+one per patient) and restarts their conversation after each script.
+Messages arrive open loop at each --rates value (requests per second) for
+--duration seconds, each taken by the next patient that is not waiting on
+a reply, and are posted through the full view stack with the Django test
+client under every --workers model:
+    wsgi:N  chat_view on a pool of N threads, like N sync workers
+    asgi    chat_async_view as tasks on one event loop
+With --fakes, OpenAI and Neo4j are replaced by the fakes of ai_bot.backends
+(latencies from the --*-latency-ms options or the AI_BOT_FAKE_* settings);
+otherwise the configured backends are used.
+
+For every worker model and rate it prints the achieved rate, error rate,
+p50/p95/p99 latency (from the scheduled arrival, so queueing counts) and a
+latency histogram, and the first rate at which the model saturates: it
+falls below 90% of the target rate, its p95 exceeds --slo-ms, more than 1%
+of the requests fail, or a conversation ends up with messages another
+patient sent (isolation violations).
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_bot.management.commands.bench_conversations import CONVERSATIONS, percentile
+
+MS_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+MIN_THROUGHPUT = 0.9  # of the target rate
+MAX_ERROR_RATE = 0.01
+
+
+def make_patients(count):
+    from datetime import date
+
+    from django.contrib.auth import get_user_model
+
+    from chat.models import Conversation
+    from patients.models import Patient
+
+    patients = []
+    for i in range(count):
+        patient = Patient.objects.create(
+            first_name="Load", last_name=f"Patient {i}", date_of_birth=date(1950 + i % 50, 1, 1),
+            phone_number="555-0100", email=f"load{i}@example.com",
+            medical_condition="Hypertension", medication_regimen="Lisinopril 10mg once daily",
+            doctor_name="Dr. Smith", user=get_user_model().objects.create_user(f"load{i}"),
+        )
+        Conversation.objects.create(patient=patient).add_welcome_message()
+        patients.append(patient)
+    return patients
+
+
+class VirtualPatient:
+    """
+    A signed-in patient with their own client, working through the scripts
+    in order; `sent` holds what they said since their conversation restarted
+    """
+
+    def __init__(self, patient, client, offset):
+        self.patient = patient
+        self.client = client
+        names = list(CONVERSATIONS)
+        self.scripts = itertools.cycle(names[offset % len(names):] + names[:offset % len(names)])
+        self.script, self.turn = [], 0
+        self.sent = []
+
+    def next_message(self):
+        """
+        (message, True when it is the last one of its script)
+        """
+        if self.turn == len(self.script):
+            self.script, self.turn = CONVERSATIONS[next(self.scripts)], 0
+        self.turn += 1
+        message = self.script[self.turn - 1]
+        self.sent.append(message)
+        return message, self.turn == len(self.script)
+
+    def restarted(self):
+        self.sent = []
+
+    def isolated(self):
+        """
+        True when the conversation holds exactly what this patient sent
+        """
+        from chat.models import Message
+
+        received = Message.objects.filter(conversation__patient=self.patient, sender='patient') \
+            .order_by('pk').values_list('content', flat=True)
+        return list(received) == self.sent
+
+
+def summarize(target_rate, results, elapsed, virtuals, slo_ms):
+    latencies = [ms for ms, ok in results if ok]
+    errors = sum(not ok for _, ok in results)
+    summary = {
+        "target_rps": target_rate,
+        "requests": len(results),
+        "isolation_violations": sum(not virtual.isolated() for virtual in virtuals),
+        "achieved_rps": round(len(results) / elapsed, 2),
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95), 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99), 1) if latencies else None,
+        "histogram": histogram(latencies),
+    }
+    summary["saturated"] = (
+        summary["achieved_rps"] < MIN_THROUGHPUT * target_rate
+        or summary["error_rate"] > MAX_ERROR_RATE
+        or summary["isolation_violations"] > 0
+        or summary["p95_ms"] is None or summary["p95_ms"] > slo_ms
+    )
+    return summary
+
+
+def histogram(latencies):
+    counts = [0] * (len(MS_BUCKETS) + 1)
+    for ms in latencies:
+        counts[bisect_left(MS_BUCKETS, ms)] += 1
+    return {f"le_{bound}": count for bound, count in zip(MS_BUCKETS + ("inf",), counts)}
+
+
+class Command(BaseCommand):
+    help = "Replay mixed patient conversations through chat.urls at target rates and report latency and saturation"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--patients", type=int, default=20)
+        parser.add_argument("--rates", default="2,5,10,20", help="Comma-separated target requests per second")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds of traffic per rate")
+        parser.add_argument("--workers", default="wsgi:8,asgi",
+                            help="Comma-separated worker models: wsgi:<threads> and/or asgi")
+        parser.add_argument("--slo-ms", type=float, default=5000.0, help="p95 latency above which a rate saturates")
+        parser.add_argument("--fakes", action="store_true", help="Use the fake chat model and in-memory graph")
+        parser.add_argument("--llm-latency-ms", type=float, default=None)
+        parser.add_argument("--ms-per-token", type=float, default=None)
+        parser.add_argument("--graph-latency-ms", type=float, default=None)
+        parser.add_argument("--output", help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+            teardown_test_environment
+
+        try:
+            rates = [float(rate) for rate in options["rates"].split(",")]
+            workers = [self.worker_model(spec) for spec in options["workers"].split(",")]
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options["fakes"]:
+            from ai_bot.backends import use_fakes
+            use_fakes(options["llm_latency_ms"], options["ms_per_token"], options["graph_latency_ms"])
+        # One line per request (and a traceback per failed one); the summary is below
+        logging.getLogger("ai_bot.metrics").disabled = True
+        logging.getLogger("django.request").disabled = True
+
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            patients = make_patients(options["patients"])
+            results = {}
+            for name, threads in workers:
+                results[name] = []
+                for rate in rates:
+                    virtuals = self.sign_in(patients, asynchronous=threads is None)
+                    run = self.run_wsgi(virtuals, rate, options["duration"], threads) if threads \
+                        else asyncio.run(self.run_asgi(virtuals, rate, options["duration"]))
+                    results[name].append(summarize(rate, *run, virtuals, options["slo_ms"]))
+                    self.report_rate(name, results[name][-1])
+                self.report_saturation(name, results[name])
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+
+    @staticmethod
+    def worker_model(spec):
+        kind, _, threads = spec.strip().partition(":")
+        if kind == "asgi":
+            return "asgi", None
+        if kind == "wsgi":
+            return f"wsgi:{int(threads or 1)}", int(threads or 1)
+        raise ValueError(f"Unknown worker model {spec!r}, expected wsgi:<threads> or asgi")
+
+    @staticmethod
+    def arrivals(rate, duration):
+        return [i / rate for i in range(int(rate * duration))]
+
+    @staticmethod
+    def sign_in(patients, asynchronous=False):
+        """
+        A VirtualPatient per patient, signed in, with a fresh conversation
+        """
+        from django.test import AsyncClient, Client
+        from django.urls import reverse
+
+        virtuals = []
+        for offset, patient in enumerate(patients):
+            client = Client(raise_request_exception=False)
+            client.force_login(patient.user)
+            client.post(reverse("restart_conversation"))
+            if asynchronous:
+                cookies, client = client.cookies, AsyncClient(raise_request_exception=False)
+                client.cookies = cookies
+            virtuals.append(VirtualPatient(patient, client, offset))
+        return virtuals
+
+    def run_wsgi(self, virtuals, rate, duration, threads):
+        from django.db import connection
+        from django.urls import reverse
+
+        idle = queue.Queue()
+        for virtual in virtuals:
+            idle.put(virtual)
+        results, lock = [], threading.Lock()
+
+        def request(scheduled):
+            virtual = idle.get()
+            try:
+                message, last = virtual.next_message()
+                ok = virtual.client.post(reverse("chat"), {"message": message}).status_code == 200
+                with lock:
+                    results.append(((time.perf_counter() - scheduled) * 1000, ok))
+                if last:
+                    virtual.client.post(reverse("restart_conversation"))
+                    virtual.restarted()
+            finally:
+                idle.put(virtual)
+                connection.close()  # like the end of a request in a sync worker
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for offset in self.arrivals(rate, duration):
+                time.sleep(max(0.0, start + offset - time.perf_counter()))
+                pool.submit(request, time.perf_counter())
+        return results, time.perf_counter() - start
+
+    async def run_asgi(self, virtuals, rate, duration):
+        from django.urls import reverse
+
+        idle = asyncio.Queue()
+        for virtual in virtuals:
+            idle.put_nowait(virtual)
+        results = []
+
+        async def request(scheduled):
+            virtual = await idle.get()
+            try:
+                message, last = virtual.next_message()
+                response = await virtual.client.post(reverse("chat_async"), {"message": message})
+                results.append(((time.perf_counter() - scheduled) * 1000, response.status_code == 200))
+                if last:
+                    await virtual.client.post(reverse("restart_conversation"))
+                    virtual.restarted()
+            finally:
+                idle.put_nowait(virtual)
+
+        start, tasks = time.perf_counter(), []
+        for offset in self.arrivals(rate, duration):
+            await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+            tasks.append(asyncio.create_task(request(time.perf_counter())))
+        await asyncio.gather(*tasks)
+        return results, time.perf_counter() - start
+
+    def report_rate(self, name, summary):
+        self.stdout.write(
+            f"{name:>8} @ {summary['target_rps']:>6.1f} rps: {summary['achieved_rps']:>6.1f} rps achieved  "
+            f"errors {summary['error_rate']:>6.1%}  p50 {summary['p50_ms']} ms  p95 {summary['p95_ms']} ms  "
+            f"p99 {summary['p99_ms']} ms  isolation violations {summary['isolation_violations']}"
+            f"{'  SATURATED' if summary['saturated'] else ''}"
+        )
+        self.stdout.write("           " + "  ".join(
+            f"{bucket.replace('le_', '<=')}:{count}" for bucket, count in summary["histogram"].items()
+        ))
+
+    def report_saturation(self, name, summaries):
+        saturated = next((summary for summary in summaries if summary["saturated"]), None)
+        if saturated:
+            self.stdout.write(f"{name:>8} saturates at {saturated['target_rps']} rps")
+        else:
+            self.stdout.write(f"{name:>8} keeps up with {summaries[-1]['target_rps']} rps")
@@ -0,0 +1,54 @@
+"""
+move patient nodes to their per-patient graph names
+
+python manage.py rename_graph_patients [--dry-run]
+
+Patient nodes used to be named after the patient's full name; they are now
+named Patient.get_graph_name() ("<full name> #<pk>"), so two patients with
+the same name stay apart. Nodes written under the old names are orphaned:
+the agent no longer reads them and reset_patient no longer deletes them.
+This renames each old node to its patient's graph name, merging it into the
+new node when the patient has chatted since. Names shared by several
+patients are skipped: their facts can't be told apart, so the old node is
+left for an operator to split or delete. Safe to run more than once.
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Rename knowledge graph Patient nodes from full names to Patient.get_graph_name()"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only list the renames")
+
+    def handle(self, *args, **options):
+        from ai_bot.backends import build_graph_backend
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from patients.models import Patient
+
+        by_name = defaultdict(list)
+        for patient in Patient.objects.order_by('pk'):
+            by_name[patient.get_full_name()].append(patient)
+
+        kg = KnowledgeGraph(backend=build_graph_backend())
+        renamed = skipped = 0
+        try:
+            for old_name, patients in by_name.items():
+                if len(patients) > 1:
+                    skipped += 1
+                    self.stderr.write(f"skipped  {old_name!r}: shared by patients {', '.join(str(p.pk) for p in patients)}")
+                    continue
+                new_name = patients[0].get_graph_name()
+                if options["dry_run"]:
+                    self.stdout.write(f"would rename  {old_name!r} -> {new_name!r}")
+                    continue
+                if kg.run_query('rename_patient', old_name=old_name, new_name=new_name)[0]['renamed']:
+                    renamed += 1
+                    self.stdout.write(f"renamed  {old_name!r} -> {new_name!r}")
+        finally:
+            kg.close()
+        self.stdout.write(f"{renamed} patient nodes renamed, {skipped} names skipped")
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_bot', '0004_responsecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileEntry',
+            fields=[
+                ('key', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('data', models.JSONField()),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -19,4 +19,62 @@ class AppointmentRequest(models.Model):
 
     @classmethod
     def restart(cls, patient):
-        cls.objects.filter(patient=patient).delete()
\ No newline at end of file
+        cls.objects.filter(patient=patient).delete()
+
+class ChatSession(models.Model):
+    """
+    Agent state and chat history of a session (see ai_bot/session_store.py)
+    """
+    key = models.CharField(max_length=255, primary_key=True)
+    data = models.BinaryField()
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key
+
+
+class ExtractionCacheEntry(models.Model):
+    """
+    Persisted extract_entities result (see ai_bot/extraction_cache.py)
+    """
+    key = models.CharField(max_length=64, primary_key=True)  # sha256 of version and normalized input
+    version = models.CharField(max_length=16, db_index=True)
+    normalized_input = models.TextField()
+    entities = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return self.normalized_input
+
+
+class ResponseCacheEntry(models.Model):
+    """
+    Cached reply to a general question (see ai_bot/response_cache.py)
+    """
+    key = models.CharField(max_length=64, primary_key=True)  # sha256 of version, question and patient context
+    version = models.CharField(max_length=16, db_index=True)
+    normalized_question = models.TextField()
+    context = models.JSONField()  # age band and condition, nothing identifying
+    response = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(db_index=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return self.normalized_question
+
+
+class ProfileEntry(models.Model):
+    """
+    Materialized knowledge graph profile entry (see ai_bot/profile_store.py)
+    """
+    key = models.CharField(max_length=255, primary_key=True)  # 'patient:<name>' or 'medication:<name>'
+    data = models.JSONField()  # {field: [values]}, plus the store flags of a patient
+    version = models.PositiveIntegerField(default=1)  # compare-and-set of concurrent updates
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,324 @@
+"""
+materialized patient profiles: a write-through read model of the knowledge graph
+
+python manage.py bench_profile_store --patients 50 --turns 12
+
+generate_response_step reads the patient's profile on every medication,
+appointment and follow-up turn, although it only changes when the graph is
+written. KnowledgeGraph keeps a ProfileStore next to its backend and applies
+every write it makes to the stored profiles: the relationships of structured
+writes (add_entity, add_relationship, write_batch), the PROFILE_EFFECTS the
+catalog declares for named queries (merge_patient, reset_patient, ...), and
+a full clear for raw Cypher and clear_graph. read_patient_profile()
+assembles the record from the store, querying the graph only on a miss.
+
+Two kinds of entries, as {field: [values]} in write order:
+    patient:<name>      the fields of the patient's own relationships
+                        (medications and PROFILE_CLAUSES) and the store flags
+    medication:<name>   dosages and frequencies of a medication node, which
+                        every patient taking that medication shares
+A profile is a patient entry plus the entries of its medications. Entries
+are only created from the graph (seed(), on a miss), so they are complete;
+writes extend the entries that exist and leave the others to the next miss.
+
+Backends (settings.AI_BOT_PROFILE_STORE):
+    memory  per-process LRU (one process serves each patient)
+    db      ProfileEntry rows shared by workers; every update checks the
+            row's version, so concurrent writers never lose an update
+    off     read every profile from the graph
+"""
+
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+
+from ai_bot.graph_backends import PROFILE_CLAUSES, PROFILE_FIELDS
+
+FLAGS = ('store_medication', 'store_appointment')
+MEDICATION_FIELDS = {'HAS_DOSAGE': 'dosages', 'HAS_FREQUENCY': 'frequencies'}
+# (relation, label) of the patient's relationships -> [(profile field, node property)]
+PATIENT_FIELDS = {('TAKES', 'Medication'): [('medications', 'name')],
+                  **{(relation, label): fields for relation, label, fields in PROFILE_CLAUSES}}
+
+
+def patient_key(name):
+    return f'patient:{name}'
+
+
+def medication_key(name):
+    return f'medication:{name}'
+
+
+def _extend(data, additions, values):
+    """
+    data with the new values of additions appended ({field: [values]}) and values set
+    """
+    data = {**data, **values}
+    for field, new in additions.items():
+        current = list(data.get(field) or [])
+        current.extend(value for value in new if value not in current)
+        data[field] = current
+    return data
+
+
+class ProfileStore:
+    """
+    Patient profiles assembled from patient and medication entries.
+    Subclasses implement _get_many/_set_many/_update/_delete_many/_clear.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def get_profile(self, name):
+        """
+        The patient's profile record, shaped like KnowledgeGraph.get_patient_profile();
+        None on a miss
+        """
+        entries = self._get_many([patient_key(name)])
+        patient = entries.get(patient_key(name))
+        if patient is not None and patient.get('medications'):
+            keys = [medication_key(medication) for medication in patient['medications']]
+            entries = self._get_many(keys)
+            if len(entries) < len(keys):
+                patient = None
+        if patient is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        record = {field: patient.get(field) or None for field in PROFILE_FIELDS}
+        for field in MEDICATION_FIELDS.values():
+            values = []
+            for medication in record['medications'] or []:
+                values.extend(value for value in entries[medication_key(medication)][field] if value not in values)
+            record[field] = values or None
+        record.update({flag: patient.get(flag) for flag in FLAGS})
+        return record
+
+    def seed(self, name, record, medication_details=()):
+        """
+        Store the profile record read from the graph, with the dosages and
+        frequencies of its medications (rows of the medication_details query)
+        """
+        # Written after the graph read: a write another process makes in between
+        # is missed until the entry is dropped (reset_patient, clear_graph) or evicted
+        entries = {patient_key(name): {
+            **{field: record.get(field) or [] for field in PROFILE_FIELDS if field not in MEDICATION_FIELDS.values()},
+            **{flag: record.get(flag) for flag in FLAGS},
+        }}
+        for row in medication_details:
+            entries[medication_key(row['name'])] = {field: list(row[field]) for field in MEDICATION_FIELDS.values()}
+        self._set_many(entries)
+
+    def apply(self, relationships):
+        """
+        Apply relationships written to the graph, as (start_label, start_props,
+        relation, end_label, end_props), to the entries that exist
+        """
+        additions = {}  # key -> {field: [values]}
+        for start_label, start_props, relation, end_label, end_props in relationships:
+            if start_label == 'Patient' and (relation, end_label) in PATIENT_FIELDS:
+                fields = additions.setdefault(patient_key(start_props['name']), {})
+                for field, prop in PATIENT_FIELDS[(relation, end_label)]:
+                    if end_props.get(prop) is not None:
+                        fields.setdefault(field, []).append(end_props[prop])
+            elif start_label == 'Medication' and relation in MEDICATION_FIELDS:
+                fields = additions.setdefault(medication_key(start_props['name']), {})
+                fields.setdefault(MEDICATION_FIELDS[relation], []).append(end_props['value'])
+        for key, fields in additions.items():
+            self._update(key, fields, {})
+
+    def apply_batch(self, batch):
+        self.apply(batch.iter_relationships())
+
+    def set_flags(self, name, store_medication, store_appointment):
+        self._update(patient_key(name), {}, {'store_medication': store_medication, 'store_appointment': store_appointment})
+
+    def forget_patient(self, name):
+        """
+        Drop the patient's entry and its medications' entries: the reset
+        deletes the medications only this patient took, with their dosages
+        """
+        patient = self._get_many([patient_key(name)]).get(patient_key(name))
+        if patient is None:
+            # Which medications went with the patient is unknown
+            self._clear(prefix='medication:')
+        else:
+            self._delete_many([medication_key(medication) for medication in patient.get('medications') or []])
+        self._delete_many([patient_key(name)])
+
+    def forget_profile(self, name):
+        """
+        Drop the patient's entry only, when the query leaves medication nodes in place
+        """
+        self._delete_many([patient_key(name)])
+
+    def apply_query(self, prepared, params):
+        """
+        Apply the profile effects the catalog declares for a named query that ran with params
+        """
+        for method, names in prepared.profile_effects:
+            getattr(self, method)(*(params[name] for name in names))
+
+    def clear(self):
+        self._clear()
+
+    async def aget_profile(self, name):
+        return await sync_to_async(self.get_profile)(name)
+
+    async def aseed(self, name, record, medication_details=()):
+        await sync_to_async(self.seed)(name, record, medication_details)
+
+    async def aapply_batch(self, batch):
+        await sync_to_async(self.apply_batch)(batch)
+
+    async def aapply_query(self, prepared, params):
+        await sync_to_async(self.apply_query)(prepared, params)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'updates': self.updates,
+        }
+
+
+class MemoryProfileStore(ProfileStore):
+    """
+    Per-process LRU of at most max_entries entries
+    """
+
+    def __init__(self, max_entries=10000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> data
+        self._lock = threading.Lock()
+
+    def _get_many(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+            return found
+
+    def _set_many(self, entries):
+        with self._lock:
+            for key, data in entries.items():
+                self._entries.pop(key, None)
+                self._entries[key] = data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _update(self, key, additions, values):
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = _extend(self._entries[key], additions, values)
+                self.updates += 1
+
+    def _delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def _clear(self, prefix=''):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    # Nothing to wait for in-process
+    async def aget_profile(self, name):
+        return self.get_profile(name)
+
+    async def aseed(self, name, record, medication_details=()):
+        self.seed(name, record, medication_details)
+
+    async def aapply_batch(self, batch):
+        self.apply_batch(batch)
+
+    async def aapply_query(self, prepared, params):
+        self.apply_query(prepared, params)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {**super().stats(), 'entries': entries}
+
+
+class DatabaseProfileStore(ProfileStore):
+    """
+    ProfileEntry rows, shared by every worker using the same database. An
+    update only lands on the version it read (compare-and-set); after
+    `retries` conflicts the entry is dropped, and the next read reseeds it.
+    """
+
+    retries = 3
+
+    @property
+    def model(self):
+        from ai_bot.models import ProfileEntry
+        return ProfileEntry
+
+    def _get_many(self, keys):
+        return dict(self.model.objects.filter(key__in=keys).values_list('key', 'data'))
+
+    def _set_many(self, entries):
+        from django.db.models import F
+        from django.utils import timezone
+
+        for key, data in entries.items():
+            if len(key) > self.model._meta.get_field('key').max_length:
+                continue  # never stored: that profile is always read from the graph
+            # Bump the version so an update racing with the seed retries on top of it
+            updated = self.model.objects.filter(key=key).update(data=data, version=F('version') + 1, updated_at=timezone.now())
+            if not updated:
+                self.model.objects.get_or_create(key=key, defaults={'data': data})
+
+    def _update(self, key, additions, values):
+        from django.utils import timezone
+
+        for _ in range(self.retries):
+            row = self.model.objects.filter(key=key).values_list('data', 'version').first()
+            if row is None:
+                return
+            data, version = row
+            if self.model.objects.filter(key=key, version=version).update(
+                    data=_extend(data, additions, values), version=version + 1, updated_at=timezone.now()):
+                self.updates += 1
+                return
+        self._delete_many([key])
+
+    def _delete_many(self, keys):
+        self.model.objects.filter(key__in=keys).delete()
+
+    def _clear(self, prefix=''):
+        self.model.objects.filter(key__startswith=prefix).delete()
+
+    def stats(self):
+        return {**super().stats(), 'entries': self.model.objects.count()}
+
+
+def build_profile_store(backend=None, shared_graph=True):
+    """
+    Create the store configured in settings.AI_BOT_PROFILE_STORE, or None when
+    it is 'off'. A graph that is not shared between processes (InMemoryGraph)
+    gets a memory store, so it never reads entries written for another graph.
+    """
+    from django.conf import settings
+
+    backend = backend or settings.AI_BOT_PROFILE_STORE
+    if backend == 'off':
+        return None
+    if backend == 'memory' or (backend == 'db' and not shared_graph):
+        return MemoryProfileStore(max_entries=settings.AI_BOT_PROFILE_STORE_MAX_ENTRIES)
+    if backend == 'db':
+        return DatabaseProfileStore()
+    raise ValueError(f"Unknown profile store backend: {backend!r}")
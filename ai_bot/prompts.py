@@ -4,7 +4,8 @@ prompts, query examples
 refer to https://python.langchain.com/docs/how_to/graph_prompting/
 """
 
-__all__ = ['cypher_query_examples', 'entity_extraction_prompt', 'QUESTIONS']
+__all__ = ['cypher_query_examples', 'entity_extraction_prompt', 'targeted_extraction_prompt', 'single_shot_instructions',
+           'history_summary_prompt', 'QUESTIONS']
 
 
 entity_extraction_prompt = """
@@ -15,6 +16,41 @@ Do not infer any information from the user's input. Lowercase all the fields.
 """.strip()
 
 
+# Extraction of the answer to a pending follow-up question (QUESTIONS[...]["fields"])
+targeted_extraction_prompt = """
+You are a helpful AI health assistant bot. The patient was asked: "{question}"
+Extract only these fields from their answer: {fields}.
+Reply with a JSON object with exactly these keys, using null for anything not mentioned.
+For fields with multiple items, combine them into a single string using commas as separators.
+Do not infer any information from the user's input. Lowercase all the fields.
+""".strip()
+
+
+# Appended to the chat system prompt in single-shot mode (reply and extraction in one call);
+# a template, hence the doubled braces
+single_shot_instructions = """
+Answer in JSON only: an object with two keys.
+"reply": your reply to the patient's latest message.
+"entities": an object with the keys medications, dosage, frequency, family_history, health_issues, appointment_time, lab_tests, doctor_notes, weight, height, blood_pressure, heart_rate, temperature, allergies, lifestyle_factors, immunizations, holding the health-related information in the patient's latest message only (null when not mentioned).
+For entities with multiple items, combine them into a single string using commas as separators. Do not infer any information. Lowercase all the entities.
+Example: {{"reply": "...", "entities": {{"medications": "lisinopril", "dosage": "10mg", "frequency": null, ...}}}}
+""".strip()
+
+
+history_summary_prompt = """
+You maintain a running summary of a conversation between a patient and their AI health assistant.
+Update the summary with the new messages below. Keep the facts that matter for the patient's care
+(symptoms, medications, dosages, appointments, requests to the doctor) and drop small talk.
+Reply with the updated summary only, in at most 120 words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+""".strip()
+
+
 
 cypher_query_examples = [
     {
@@ -69,26 +105,33 @@ cypher_query_examples = [
 ]
 
 # Define the QUESTIONS dictionary with follow-ups
+# "fields": the HealthEntity fields an answer is extracted into, the one that
+# answers the question first (targeted extraction)
 QUESTIONS = {
     "medications": {
         "question": "Can you please list all the medications you are currently taking?",
-        "follow_ups": ["dosages", "frequencies"]
+        "follow_ups": ["dosages", "frequencies"],
+        "fields": ["medications", "dosage", "frequency"]
     },
     "dosages": {
         "question": "What is the dosage for each of your medications? (e.g. lisinopril, 10mg)",
-        "follow_ups": []
+        "follow_ups": [],
+        "fields": ["dosage", "medications"]
     },
     "frequencies": {
         "question": "How often do you take each medication? (e.g. lisinopril, twice a day)",
-        "follow_ups": []
+        "follow_ups": [],
+        "fields": ["frequency", "medications"]
     },
     "family_history": {
         "question": "Do you have any family members with a history of medical conditions?",
-        "follow_ups": []
+        "follow_ups": [],
+        "fields": ["family_history"]
     },
     "health_issues": {
         "question": "What current health problems or symptoms are you experiencing?",
-        "follow_ups": []
+        "follow_ups": [],
+        "fields": ["health_issues"]
     },
     # ... add other primary questions
 }
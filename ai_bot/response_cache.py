@@ -0,0 +1,259 @@
+"""
+cache for general health replies
+
+python ai_bot/response_cache.py
+
+Replies to general questions ("What helps a twisted ankle heal?") are
+reused across patients when they were asked in the same context. The key is
+a fingerprint of:
+    - the version of the chat system prompt and model
+    - the normalized question
+    - a non-identifying slice of the patient: age band and medical condition
+A cacheable reply is generated from a prompt holding only that key (the
+question, age band and condition; see langchain_integration.cacheable_prompt),
+never from the patient's name, doctor, appointments, profile or history, so
+it can be served to any patient with the same key.
+Entries live in the ResponseCacheEntry table (Postgres or SQLite, whatever
+DATABASES points to), behind a per-process LRU, with a TTL and a bound on
+the number of rows. Every evict_every stores, the rows used since the last
+eviction (hits of either tier) are touched and the least recently used rows
+beyond max_entries are deleted.
+
+Lookups are bypassed when the answer needs more than the key: when the
+conversation history changes what it should be (follow-ups like "what about
+at night?" or "is it safe?"), and when the question is about the patient's
+own record ("when is my next appointment?", "who is my doctor?", "is
+ibuprofen ok with food?"). Those replies come from the full prompt and are
+never stored.
+"""
+
+import re
+import threading
+
+from asgiref.sync import sync_to_async
+
+from ai_bot import rule_extractor
+from ai_bot.extraction_cache import cache_version, entry_key, normalize
+from ai_bot.session_store import MemorySessionStore
+
+RESULTS = ('memory', 'db', 'miss', 'bypass')
+
+# Words that only make sense with the earlier turns in mind
+CONTEXT_REFERENCE = re.compile(
+    r"^(?:and|but|so|also|then|ok|okay)\b"
+    r"|\b(?:it|its|that|this|these|those|they|them|there|he|she|him|her|same|again|instead|else|"
+    r"above|before|earlier|previous|you said|what about|how about|more|other)\b"
+)
+MIN_WORDS = 4  # "why?", "how long?" only make sense after an earlier turn
+
+# Words about the patient themselves or their record (doctor, appointments,
+# medications), which only the full prompt knows
+PATIENT_REFERENCE = re.compile(
+    r"\b(?:my|mine|me|myself|doctors?|dr|physician|gp|nurse|appointments?|visits?|check-?ups?|follow-?ups?|"
+    r"medications?|medicines?|meds|pills?|tablets?|prescriptions?|prescribed|doses?|dosages?|regimen|refills?|"
+    r"treatments?|labs?|tests?|results?|records?)\b"
+)
+
+
+def age_band(age):
+    return f"{age // 10 * 10}s" if age is not None else None
+
+
+def patient_context(patient):
+    """
+    The part of the patient the reply may depend on, without identifying them
+    """
+    return {
+        'age_band': age_band(patient.get_age()),
+        'condition': normalize(patient.medical_condition or ''),
+    }
+
+
+def refers_to_patient(question):
+    """
+    True when `question` is about the patient's own data: a PATIENT_REFERENCE
+    word, or anything the rule extractor maps to a profile field (a medication,
+    dosage, appointment time, ...)
+    """
+    if PATIENT_REFERENCE.search(normalize(question)):
+        return True
+    return bool(rule_extractor.extract(question).entities)
+
+
+def depends_on_history(question, history):
+    """
+    True when `question` can't be answered the same way without `history`
+    """
+    if not history:
+        return False
+    normalized = normalize(question)
+    return len(normalized.split()) < MIN_WORDS or CONTEXT_REFERENCE.search(normalized) is not None
+
+
+class ResponseCache:
+    """
+    ResponseCacheEntry rows behind a per-process LRU
+    """
+
+    def __init__(self, max_entries=5000, ttl=None, memory_entries=1000, evict_every=100):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.memory = MemorySessionStore(max_entries=memory_entries, ttl=ttl)
+        self.counts = dict.fromkeys(RESULTS, 0)
+        self._stores = 0
+        self._touched = set()  # keys served from memory since the last eviction
+        self._lock = threading.Lock()
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+
+    @property
+    def model(self):
+        from ai_bot.models import ResponseCacheEntry
+        return ResponseCacheEntry
+
+    @staticmethod
+    def key(version, question, context):
+        return entry_key(version, f"{normalize(question)}|{cache_version(context)}")
+
+    # Persistent tier
+
+    def _live(self, key):
+        from django.db.models import Q
+        from django.utils import timezone
+        return self.model.objects.filter(key=key).filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+
+    def _db_get(self, key):
+        from django.db.models import F
+        from django.utils import timezone
+
+        response = self._live(key).values_list('response', flat=True).first()
+        if response is not None:
+            self.model.objects.filter(key=key).update(hits=F('hits') + 1, last_used_at=timezone.now())
+        return response
+
+    def _db_set(self, key, version, question, context, response):
+        from django.utils import timezone
+
+        now = timezone.now()
+        self.model.objects.update_or_create(key=key, defaults={
+            'version': version, 'normalized_question': normalize(question), 'context': context,
+            'response': response, 'last_used_at': now,
+            'expires_at': now + timezone.timedelta(seconds=self.ttl) if self.ttl else None,
+        })
+        with self._lock:
+            self._stores += 1
+            due = self._stores % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def _memory_hit(self, key):
+        with self._lock:
+            self._touched.add(key)
+        self._count('memory')
+
+    def evict(self):
+        """
+        Record the memory-tier hits on their rows, then keep the max_entries
+        most recently used rows
+        """
+        from django.utils import timezone
+
+        with self._lock:
+            touched, self._touched = self._touched, set()
+        if touched:
+            self.model.objects.filter(key__in=touched).update(last_used_at=timezone.now())
+        keys = self.model.objects.order_by('-last_used_at').values_list('key', flat=True)[self.max_entries:]
+        stale = list(keys)
+        if stale:
+            self.model.objects.filter(key__in=stale).delete()
+
+    # Lookups
+
+    def get(self, version, question, context):
+        key = self.key(version, question, context)
+        response = self.memory.get(key)
+        if response is not None:
+            self._memory_hit(key)
+            return response
+        response = self._db_get(key)
+        if response is not None:
+            self.memory.set(key, response)
+            self._count('db')
+            return response
+        self._count('miss')
+        return None
+
+    async def aget(self, version, question, context):
+        key = self.key(version, question, context)
+        response = self.memory.get(key)
+        if response is not None:
+            self._memory_hit(key)
+            return response
+        response = await sync_to_async(self._db_get)(key)
+        if response is not None:
+            self.memory.set(key, response)
+            self._count('db')
+            return response
+        self._count('miss')
+        return None
+
+    def set(self, version, question, context, response):
+        key = self.key(version, question, context)
+        self.memory.set(key, response)
+        self._db_set(key, version, question, context, response)
+
+    async def aset(self, version, question, context, response):
+        key = self.key(version, question, context)
+        self.memory.set(key, response)
+        await sync_to_async(self._db_set)(key, version, question, context, response)
+
+    def bypass(self):
+        self._count('bypass')
+
+    def purge_stale(self, version):
+        """
+        Delete entries of other prompt versions and expired ones
+        """
+        from django.db.models import Q
+        from django.utils import timezone
+        return self.model.objects.filter(~Q(version=version) | Q(expires_at__lte=timezone.now())).delete()[0]
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts['memory'] + counts['db'] + counts['miss']
+        return {**counts, 'hit_rate': (counts['memory'] + counts['db']) / lookups if lookups else 0.0}
+
+    def metric_lines(self):
+        # Prometheus counters for /metrics (ai_bot.instrumentation.collectors)
+        counts = self.stats()
+        lines = [
+            "# HELP ai_bot_response_cache_total General reply cache lookups and stores by result",
+            "# TYPE ai_bot_response_cache_total counter",
+        ]
+        return lines + [f'ai_bot_response_cache_total{{result="{result}"}} {counts[result]}' for result in RESULTS]
+
+
+def build_response_cache():
+    """
+    Create the cache configured in settings (AI_BOT_RESPONSE_CACHE and friends),
+    or None when it is off
+    """
+    from django.conf import settings
+
+    if settings.AI_BOT_RESPONSE_CACHE == 'off':
+        return None
+    return ResponseCache(
+        max_entries=settings.AI_BOT_RESPONSE_CACHE_MAX_ENTRIES,
+        ttl=settings.AI_BOT_RESPONSE_CACHE_TTL or None,
+    )
+
+
+if __name__ == "__main__":
+    history = ["an earlier turn"]
+    for question in ["What helps a twisted ankle heal?", "What about at night?", "why?", "Who is my doctor?"]:
+        print(f"{question!r}: bypass={depends_on_history(question, history) or refers_to_patient(question)}")
+    print(ResponseCache.key("v1", "What helps a twisted ankle heal?", {'age_band': age_band(47), 'condition': 'hypertension'}))
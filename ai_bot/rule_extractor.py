@@ -0,0 +1,182 @@
+"""
+rule-based entity extraction
+
+python ai_bot/rule_extractor.py "lisinopril, 10mg twice a day"
+
+Deterministic fast path in front of the LLM extraction: compiled patterns for
+medication names, doses, frequency phrases, vitals, allergies, vaccines,
+symptoms and appointment times fill HealthEntity fields, each with a
+confidence. The result is only trusted (RuleExtraction.confident) when every
+word of the message is either matched or filler ("I take", "per", "my"...),
+i.e. for the short, structured answers patients give to QUESTIONS; anything
+else goes to the LLM. So does any message with a negation or cessation cue
+("no ibuprofen", "I stopped taking metformin"): the patterns can't tell a
+medication taken from one refused or quit.
+"""
+
+import re
+from dataclasses import dataclass, field
+
+# Common generic names; the suffix pattern below catches most others
+MEDICATIONS = [
+    'acetaminophen', 'albuterol', 'allopurinol', 'alprazolam', 'amitriptyline', 'amlodipine', 'amoxicillin',
+    'apixaban', 'aspirin', 'atenolol', 'atorvastatin', 'azithromycin', 'budesonide', 'bupropion', 'buspirone',
+    'carvedilol', 'cetirizine', 'ciprofloxacin', 'citalopram', 'clopidogrel', 'cyclobenzaprine', 'diclofenac',
+    'digoxin', 'diltiazem', 'doxycycline', 'duloxetine', 'empagliflozin', 'enalapril', 'escitalopram',
+    'esomeprazole', 'ezetimibe', 'famotidine', 'fluoxetine', 'fluticasone', 'furosemide', 'gabapentin',
+    'glipizide', 'hydrochlorothiazide', 'hydrocodone', 'ibuprofen', 'insulin', 'levetiracetam',
+    'levothyroxine', 'lisinopril', 'loratadine', 'losartan', 'meloxicam', 'metformin', 'methotrexate',
+    'methylprednisolone', 'metoprolol', 'montelukast', 'naproxen', 'nitroglycerin', 'omeprazole',
+    'ondansetron', 'oxycodone', 'pantoprazole', 'paracetamol', 'paroxetine', 'pravastatin', 'prednisone',
+    'pregabalin', 'propranolol', 'quetiapine', 'ramipril', 'rivaroxaban', 'rosuvastatin', 'semaglutide',
+    'sertraline', 'simvastatin', 'sitagliptin', 'spironolactone', 'sumatriptan', 'tamsulosin', 'tramadol',
+    'trazodone', 'valsartan', 'venlafaxine', 'warfarin', 'zolpidem',
+]
+MEDICATION_SUFFIXES = [
+    'pril', 'olol', 'sartan', 'statin', 'dipine', 'formin', 'prazole', 'cillin', 'mycin', 'cycline',
+    'floxacin', 'oxetine', 'tidine', 'gliptin', 'glitazone', 'parin', 'triptan',
+]
+SYMPTOMS = [
+    'abdominal pain', 'back pain', 'chest pain', 'chills', 'constipation', 'cough', 'diarrhea', 'dizziness',
+    'dizzy', 'fatigue', 'fever', 'headache', 'headaches', 'heartburn', 'insomnia', 'joint pain', 'migraine',
+    'migraines', 'nausea', 'rash', 'shortness of breath', 'sore throat', 'swelling', 'tired', 'vomiting',
+]
+VACCINES = ['covid', 'covid-19', 'flu', 'hepatitis b', 'hpv', 'measles', 'mmr', 'pneumonia', 'shingles', 'tetanus', 'tdap']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october',
+          'november', 'december']
+
+# Words that carry no entity on their own
+FILLER = set("""
+a about after all also am an and any are around as at be been before by bp can could day do does dose doses dosage
+each every for from get got had have having hi i i'm im in is it it's its just like me meds medication medications
+medicine mostly my need of on once one or other per pill pills please prescribed received right same so sometimes
+take takes taking tablet tablets than that the then these this those to took twice usually was we with would
+yes ok okay thanks thank you yeah yep currently feel feeling today yesterday morning evening night now
+last earlier appointment reschedule schedule change move book visit want wanted see doctor dr instead possible
+allergic allergy allergies vaccine vaccinated shot shots blood pressure heart rate pulse temperature temp
+weigh weight height tall hr i'd i've since week
+""".split())
+
+FREQUENCY = (
+    r"(?:once|twice|thrice|(?:one|two|three|four|\d+) times?)\s+(?:a|per|each|every)\s+(?:day|week|month|night)"
+    r"|every\s+(?:\d+|one|two|three|four|six|eight|twelve)\s*(?:-\s*\d+\s*)?(?:hours?|hrs?|days?|weeks?)"
+    r"|every\s+(?:day|morning|evening|night|other\s+day|week)"
+    r"|(?:once|twice)\s+daily|(?:daily|nightly|weekly|monthly)"
+    r"|in\s+the\s+(?:morning|evening)|(?:morning|evening)s|at\s+(?:night|bedtime)|before\s+bed(?:time)?"
+    r"|as\s+needed|when\s+needed|prn|qd|bid|tid|qid|q\d+h"
+)
+DOSE = r"\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|ml|iu|units?|tablets?|pills?|puffs?|drops?|capsules?)\b"
+TIME = r"\d{1,2}(?::\d{2})?\s*(?:am|pm)|noon|\d{1,2}:\d{2}"
+DAY = (rf"(?:next\s+|this\s+)?(?:{'|'.join(WEEKDAYS)})|tomorrow|today|next\s+week"
+       rf"|(?:{'|'.join(MONTHS)})\s+\d{{1,2}}(?:st|nd|rd|th)?|\d{{1,2}}/\d{{1,2}}(?:/\d{{2,4}})?")
+ITEM = r"[a-z][a-z\-]*(?:\s[a-z][a-z\-]*)?"  # one or two words
+
+
+def _words(words):
+    # Longest first, so "shortness of breath" wins over shorter alternatives
+    return '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+# (field, compiled pattern, confidence, normalize); earlier patterns claim their span first
+PATTERNS = [
+    ('blood_pressure', re.compile(r"\b(\d{2,3})\s*/\s*(\d{2,3})\b(?:\s*mm\s*hg)?(?!\s*/)"), 0.95,
+     lambda m: f"{m.group(1)}/{m.group(2)}"),
+    ('heart_rate', re.compile(r"\b(?:heart\s*rate|pulse)(?:\s+(?:is|was|of))?\s+(\d{2,3})\b(?:\s*bpm)?|\b(\d{2,3})\s*(?:bpm|beats\s+per\s+minute)\b"),
+     0.95, lambda m: m.group(1) or m.group(2)),
+    ('temperature', re.compile(r"\b(\d{2,3}(?:\.\d)?)\s*(?:°\s*|degrees\s*)?(f|c|fahrenheit|celsius)\b"), 0.9,
+     lambda m: f"{m.group(1)}{m.group(2)[0]}"),
+    ('weight', re.compile(r"\b(\d{2,3}(?:\.\d)?)\s*(kg|kgs|lbs?|pounds)\b"), 0.9,
+     lambda m: f"{m.group(1)}{'kg' if m.group(2).startswith('kg') else 'lbs'}"),
+    ('height', re.compile(r"\b(\d)\s*(?:'|ft|feet)\s*(\d{1,2})?\s*(?:\"|in|inches)?(?=\s|$|[,.])|\b(1\d{2}|2[0-4]\d)\s*cm\b"), 0.9,
+     lambda m: f"{m.group(3)}cm" if m.group(3) else f"{m.group(1)}'{m.group(2) or 0}"),
+    ('dosage', re.compile(rf"\b{DOSE}"), 0.95, lambda m: re.sub(r"\s+", "", m.group(0))),
+    ('frequency', re.compile(rf"\b(?:{FREQUENCY})\b"), 0.9, lambda m: re.sub(r"\s+", " ", m.group(0))),
+    ('allergies', re.compile(rf"\ballergic\s+to\s+({ITEM}(?:(?:,\s*|,?\s+and\s+|\s+or\s+){ITEM})*)(?=\s*(?:[.,;!]|$|\band\b))"), 0.85,
+     lambda m: ", ".join(re.split(r",?\s+and\s+|\s+or\s+|,\s*", m.group(1)))),
+    ('medications', re.compile(rf"\b(?:{_words(MEDICATIONS)})\b"), 0.95, lambda m: m.group(0)),
+    ('medications', re.compile(rf"\b[a-z]{{3,}}(?:{'|'.join(MEDICATION_SUFFIXES)})\b"), 0.75, lambda m: m.group(0)),
+    ('immunizations', re.compile(rf"\b(?:{_words(VACCINES)})\s+(?:shot|vaccine|vaccination|booster|jab)s?\b"), 0.85,
+     lambda m: m.group(0)),
+    ('health_issues', re.compile(rf"\b(?:{_words(SYMPTOMS)})\b"), 0.8, lambda m: m.group(0)),
+]
+APPOINTMENT_WORDS = re.compile(r"\b(?:appointment|reschedule|schedule|visit|book|move)\b")
+APPOINTMENT_TIME = re.compile(rf"\b(?:(?:{DAY})(?:\s+(?:at\s+)?(?:{TIME}))?|(?:at\s+)?(?:{TIME}))\b")
+# "no", "not", "don't", "stopped", "quit", "never", "no longer", ...: the entities may be negated
+NEGATION = re.compile(
+    r"\b(?:no|nope|not|none|never|neither|nor|without|stop|stopped|stopping|quit|quitting|discontinued|"
+    r"anymore|longer|off|refuse|refused)\b|n't\b|\bdont\b|\bdidnt\b|\bdoesnt\b"
+)
+NEGATION_CONFIDENCE = 0.3
+TOKEN = re.compile(r"[a-z0-9]+(?:['\-][a-z0-9]+)*")
+
+
+@dataclass
+class RuleExtraction:
+    entities: dict = field(default_factory=dict)  # HealthEntity field -> value
+    confidence: dict = field(default_factory=dict)  # HealthEntity field -> score
+    coverage: float = 0.0  # share of the message's words explained by matches or filler
+    negated: bool = False  # the message has a NEGATION cue
+
+    @property
+    def score(self):
+        """
+        Overall confidence: the weakest field, scaled by coverage; at most
+        NEGATION_CONFIDENCE for a negated message
+        """
+        score = min(self.confidence.values(), default=1.0) * self.coverage
+        return min(score, NEGATION_CONFIDENCE) if self.negated else score
+
+    def confident(self, threshold=0.8):
+        return self.score >= threshold
+
+
+def extract(text):
+    """
+    Extract HealthEntity fields (lowercased, multiple values joined by ", ",
+    like the LLM output) from `text`
+    """
+    text = text.lower().strip()
+    spans, values, confidence = [], {}, {}
+
+    def add(name, value, score, span):
+        values.setdefault(name, [])
+        if value not in values[name]:
+            values[name].append(value)
+        confidence[name] = min(confidence.get(name, 1.0), score)
+        spans.append(span)
+
+    for name, pattern, score, normalize in PATTERNS:
+        for match in pattern.finditer(text):
+            if any(start < match.end() and match.start() < end for start, end in spans):
+                continue
+            add(name, normalize(match).strip(), score, match.span())
+
+    if APPOINTMENT_WORDS.search(text):
+        for match in APPOINTMENT_TIME.finditer(text):
+            if not any(start < match.end() and match.start() < end for start, end in spans):
+                add('appointment_time', match.group(0), 0.85, match.span())
+
+    tokens = list(TOKEN.finditer(text))
+    explained = sum(
+        1 for token in tokens
+        if token.group(0) in FILLER or any(start <= token.start() and token.end() <= end for start, end in spans)
+    )
+    coverage = explained / len(tokens) if tokens else 0.0
+    negated = NEGATION.search(text) is not None
+    if negated:
+        confidence = {name: min(score, NEGATION_CONFIDENCE) for name, score in confidence.items()}
+    return RuleExtraction(
+        entities={name: ", ".join(items) for name, items in values.items()},
+        confidence=confidence,
+        coverage=coverage,
+        negated=negated,
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    for message in sys.argv[1:] or ["lisinopril, 10mg", "ibuprofen, every 6 hours", "I feel dizzy after my walks"]:
+        result = extract(message)
+        print(f"{message!r}: {result.entities} score={result.score:.2f} confident={result.confident()}")
@@ -0,0 +1,526 @@
+"""
+session store for the agent state and chat histories
+
+python ai_bot/session_store.py
+
+Per-session state lives in a SessionStore instead of module-level dicts, so
+it is bounded, survives restarts (db, redis) and is shared between workers.
+Values are stored as compact JSON; AGENT_STATE_FIELDS are the only AgentState
+fields carried from one turn to the next (input and patient come with every
+request, the rest is recomputed by the agent).
+
+Chat histories ({'summary': str, 'messages': [message dicts]}) are never
+read, extended and written back: append_messages() and fold_messages() change
+them in one atomic step (under the lock in memory, on a locked row in the
+database, with RPUSH/LTRIM on a Redis list), so two workers handling turns of
+the same session never drop each other's messages.
+
+Backends (settings.AI_BOT_SESSION_STORE):
+    memory  per-process LRU with a TTL (default)
+    db      ChatSession rows in Postgres
+    redis   any redis-py compatible client (REDIS_URL)
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+from ai_bot import instrumentation
+
+AGENT_STATE_FIELDS = ('entities', 'current_question')
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode()
+
+
+def loads(data):
+    return json.loads(data) if data is not None else None
+
+
+def _history(value):
+    if isinstance(value, list):  # written before histories had a summary
+        return {'summary': '', 'messages': value}
+    return value or {'summary': '', 'messages': []}
+
+
+class SessionStore:
+    """
+    Key/value store of JSON-serializable session data. Subclasses implement
+    _get/_set/_delete on bytes and _modify for histories (or override
+    _get_history/_append_messages/_fold_messages); hits and misses are counted here.
+    """
+
+    # The async methods run the sync ones in Django's thread-sensitive executor,
+    # where ORM calls keep their connection (and a TestCase its transaction)
+    thread_sensitive = True
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self._get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return loads(data)
+
+    def set(self, key, value):
+        self._set(key, dumps(value))
+
+    def delete(self, key):
+        self._delete(key)
+
+    async def aget(self, key):
+        return await sync_to_async(self.get, thread_sensitive=self.thread_sensitive)(key)
+
+    async def aset(self, key, value):
+        await sync_to_async(self.set, thread_sensitive=self.thread_sensitive)(key, value)
+
+    async def adelete(self, key):
+        await sync_to_async(self.delete, thread_sensitive=self.thread_sensitive)(key)
+
+    def get_history(self, key):
+        history = self._get_history(key)
+        if history is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return history or _history(None)
+
+    def append_messages(self, key, messages):
+        """
+        Append message dicts to the history at key in one atomic step; returns the history after it
+        """
+        return self._append_messages(key, messages)
+
+    def fold_messages(self, key, head, summary, new_summary):
+        """
+        Replace `head`, the oldest messages of the history, with new_summary if
+        the history still starts with them under `summary` (compare-and-set);
+        returns whether it did
+        """
+        return self._fold_messages(key, head, summary, new_summary)
+
+    async def aget_history(self, key):
+        return await sync_to_async(self.get_history, thread_sensitive=self.thread_sensitive)(key)
+
+    async def aappend_messages(self, key, messages):
+        return await sync_to_async(self.append_messages, thread_sensitive=self.thread_sensitive)(key, messages)
+
+    async def afold_messages(self, key, head, summary, new_summary):
+        return await sync_to_async(self.fold_messages, thread_sensitive=self.thread_sensitive)(key, head, summary, new_summary)
+
+    def _get_history(self, key):
+        value = loads(self._get(key))
+        return _history(value) if value is not None else None
+
+    def _append_messages(self, key, messages):
+        def append(history):
+            history['messages'].extend(messages)
+            return history
+
+        return self._modify(key, append)
+
+    def _fold_messages(self, key, head, summary, new_summary):
+        def fold(history):
+            if history['summary'] != summary or history['messages'][:len(head)] != head:
+                return None
+            return {'summary': new_summary, 'messages': history['messages'][len(head):]}
+
+        return self._modify(key, fold) is not None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def metric_lines(self):
+        # Prometheus counters and gauges for /metrics (ai_bot.instrumentation.collectors)
+        stats = self.stats()
+        lines = [
+            "# HELP ai_bot_session_store_lookups_total Session store lookups by result",
+            "# TYPE ai_bot_session_store_lookups_total counter",
+            f'ai_bot_session_store_lookups_total{{result="hit"}} {stats["hits"]}',
+            f'ai_bot_session_store_lookups_total{{result="miss"}} {stats["misses"]}',
+        ]
+        for name, kind, help_text in (('entries', 'gauge', "Values held by the session store"),
+                                      ('bytes', 'gauge', "Bytes used by the session store"),
+                                      ('evictions', 'counter', "Sessions evicted from the session store")):
+            if name in stats:
+                metric = f"ai_bot_session_store_{name}" + ("_total" if kind == 'counter' else "")
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}", f"{metric} {stats[name]}"]
+        return lines
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Per-process LRU: at most max_entries sessions, each expiring ttl seconds
+    after its last write
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, data)
+        self._bytes = 0
+        # Reentrant: _modify holds it around _get and _set
+        self._lock = threading.RLock()
+
+    def _pop(self, key):
+        _, data = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key, data):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (expires_at, data)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def _modify(self, key, change):
+        with self._lock:
+            history = change(_history(loads(self._get(key))))
+            if history is None:
+                return None
+            data = dumps(history)
+            self._set(key, data)
+            return loads(data)  # as a later read returns it, for fold_messages to compare
+
+    # Nothing to wait for in-process
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        self.set(key, value)
+
+    async def adelete(self, key):
+        self.delete(key)
+
+    async def aget_history(self, key):
+        return self.get_history(key)
+
+    async def aappend_messages(self, key, messages):
+        return self.append_messages(key, messages)
+
+    async def afold_messages(self, key, head, summary, new_summary):
+        return self.fold_messages(key, head, summary, new_summary)
+
+    def stats(self):
+        with self._lock:
+            entries, size = len(self._entries), self._bytes
+        return {**super().stats(), 'entries': entries, 'bytes': size, 'evictions': self.evictions}
+
+
+class DatabaseSessionStore(SessionStore):
+    """
+    ChatSession rows, shared by every worker using the same database. Expired
+    rows are ignored on read; `python manage.py clear_chat_sessions` (or
+    clear_expired()) deletes them.
+    """
+
+    retries = 3
+
+    @property
+    def model(self):
+        from ai_bot.models import ChatSession
+        return ChatSession
+
+    def _expires_at(self):
+        from django.utils import timezone
+        return timezone.now() + timezone.timedelta(seconds=self.ttl) if self.ttl else None
+
+    def _live(self):
+        from django.db.models import Q
+        from django.utils import timezone
+        return self.model.objects.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+
+    def _get(self, key):
+        data = self._live().filter(key=key).values_list('data', flat=True).first()
+        return bytes(data) if data is not None else None
+
+    def _set(self, key, data):
+        self.model.objects.update_or_create(key=key, defaults={'data': data, 'expires_at': self._expires_at()})
+
+    def _delete(self, key):
+        self.model.objects.filter(key=key).delete()
+
+    def _modify(self, key, change):
+        from django.db import IntegrityError, transaction
+        from django.utils import timezone
+
+        for attempt in range(self.retries):
+            try:
+                with transaction.atomic():
+                    # The row stays locked until commit: concurrent changes to the session queue up behind it
+                    row = self.model.objects.select_for_update().filter(key=key).first()
+                    live = row is not None and (row.expires_at is None or row.expires_at > timezone.now())
+                    history = change(_history(loads(bytes(row.data)) if live else None))
+                    if history is None:
+                        return None
+                    data = dumps(history)
+                    if row is None:
+                        self.model.objects.create(key=key, data=data, expires_at=self._expires_at())
+                    else:
+                        row.data, row.expires_at = data, self._expires_at()
+                        row.save(update_fields=['data', 'expires_at', 'updated_at'])
+                    return loads(data)
+            except IntegrityError:
+                # Another worker created the row first: apply the change on top of theirs
+                if attempt == self.retries - 1:
+                    raise
+
+    def clear_expired(self):
+        from django.utils import timezone
+        return self.model.objects.filter(expires_at__lte=timezone.now()).delete()[0]
+
+    def stats(self):
+        from django.db.models import Count, Sum
+        from django.db.models.functions import Length
+        totals = self._live().aggregate(entries=Count('key'), bytes=Sum(Length('data')))
+        return {**super().stats(), 'entries': totals['entries'], 'bytes': totals['bytes'] or 0}
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Keys under `prefix` in Redis, expired by Redis itself. A history is a list
+    of messages (RPUSH, LTRIM) plus a `:summary` string. `client` is any object
+    with redis-py's get/set(ex=, nx=)/delete/expire/rpush/lrange/ltrim (e.g.
+    ai_bot.fakes.FakeRedis); by default one is created from `url` (needs the
+    redis package).
+    """
+
+    fold_lock_seconds = 30
+    thread_sensitive = False  # no ORM: any worker thread will do
+
+    def __init__(self, client=None, url=None, prefix='ai_bot:session:', ttl=None):
+        super().__init__(ttl)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+        self.client = client
+        self.prefix = prefix
+
+    def _get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def _set(self, key, data):
+        self.client.set(self.prefix + key, data, ex=self.ttl or None)
+
+    def _delete(self, key):
+        # A history's summary goes with it
+        self.client.delete(self.prefix + key, self.prefix + key + ':summary')
+
+    def _get_history(self, key):
+        messages = self.client.lrange(self.prefix + key, 0, -1)
+        summary = self.client.get(self.prefix + key + ':summary')
+        if not messages and summary is None:
+            return None
+        return {'summary': summary.decode() if summary else '', 'messages': [loads(message) for message in messages]}
+
+    def _append_messages(self, key, messages):
+        self.client.rpush(self.prefix + key, *[dumps(message) for message in messages])
+        if self.ttl:
+            self.client.expire(self.prefix + key, self.ttl)
+            self.client.expire(self.prefix + key + ':summary', self.ttl)
+        # Messages appended by another worker since may be included: fold_messages checks again
+        return self._get_history(key)
+
+    def _fold_messages(self, key, head, summary, new_summary):
+        # Appends only touch the tail; the lock keeps a second fold from trimming the same head twice
+        lock = self.prefix + key + ':fold'
+        if not self.client.set(lock, b'1', nx=True, ex=self.fold_lock_seconds):
+            return False
+        try:
+            history = self._get_history(key) or _history(None)
+            if history['summary'] != summary or history['messages'][:len(head)] != head:
+                return False
+            self.client.ltrim(self.prefix + key, len(head), -1)
+            self.client.set(self.prefix + key + ':summary', new_summary.encode(), ex=self.ttl or None)
+            return True
+        finally:
+            self.client.delete(lock)
+
+    def stats(self):
+        stats = super().stats()
+        try:
+            stats['entries'] = self.client.dbsize()
+            stats['bytes'] = self.client.info('memory')['used_memory']
+        except Exception:  # stand-ins and restricted servers may not support INFO
+            pass
+        return stats
+
+
+def build_session_store(backend=None):
+    """
+    Create the store configured in settings (AI_BOT_SESSION_STORE and friends)
+    """
+    from django.conf import settings
+
+    backend = backend or settings.AI_BOT_SESSION_STORE
+    ttl = settings.AI_BOT_SESSION_TTL or None
+    if backend == 'memory':
+        return MemorySessionStore(max_entries=settings.AI_BOT_SESSION_MAX_ENTRIES, ttl=ttl)
+    if backend == 'db':
+        return DatabaseSessionStore(ttl=ttl)
+    if backend == 'redis':
+        return RedisSessionStore(url=settings.REDIS_URL, ttl=ttl)
+    raise ValueError(f"Unknown session store backend: {backend!r}")
+
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Return the shared SessionStore, creating it on first use (thread-safe)
+    """
+    global _shared_store
+    if _shared_store is None:
+        with _shared_store_lock:
+            if _shared_store is None:
+                _shared_store = build_session_store()
+    return _shared_store
+
+
+def set_session_store(store):
+    """
+    Replace the shared SessionStore; None resets it to the configured one
+    """
+    global _shared_store
+    with _shared_store_lock:
+        _shared_store = store
+
+
+def _session_store_metric_lines():
+    store = _shared_store
+    return store.metric_lines() if store is not None else []
+
+
+instrumentation.collectors.append(_session_store_metric_lines)
+
+
+# Agent state
+
+def state_key(session_id):
+    return f'state:{session_id}'
+
+
+def dump_agent_state(state):
+    # Only the fields carried between turns; None-valued entities read the same as missing ones
+    values = state if isinstance(state, dict) else state.model_dump(include=set(AGENT_STATE_FIELDS))
+    data = {}
+    entities = {k: v for k, v in (values.get('entities') or {}).items() if v is not None}
+    if entities:
+        data['entities'] = entities
+    if values.get('current_question'):
+        data['current_question'] = values['current_question']
+    return data
+
+
+def load_agent_state(session_id, message, patient, store=None):
+    from ai_bot.agent import AgentState
+    data = (store or get_session_store()).get(state_key(session_id)) or {}
+    return AgentState(input=message, patient=patient, session_id=session_id, **data)
+
+
+async def aload_agent_state(session_id, message, patient, store=None):
+    from ai_bot.agent import AgentState
+    data = await (store or get_session_store()).aget(state_key(session_id)) or {}
+    return AgentState(input=message, patient=patient, session_id=session_id, **data)
+
+
+def save_agent_state(session_id, state, store=None):
+    (store or get_session_store()).set(state_key(session_id), dump_agent_state(state))
+
+
+async def asave_agent_state(session_id, state, store=None):
+    await (store or get_session_store()).aset(state_key(session_id), dump_agent_state(state))
+
+
+# Chat histories
+
+def history_key(session_id):
+    return f'history:{session_id}'
+
+
+class StoredChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history of one session, read from and written back to a SessionStore
+    """
+
+    def __init__(self, session_id, store=None):
+        self.session_id = session_id
+        self.store = store or get_session_store()
+
+    @property
+    def messages(self):
+        return messages_from_dict(self.store.get_history(history_key(self.session_id))['messages'])
+
+    def add_messages(self, messages):
+        # One atomic append per turn (RunnableWithMessageHistory adds input and output together)
+        self.store.append_messages(history_key(self.session_id), messages_to_dict(messages))
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    async def aget_messages(self):
+        return messages_from_dict((await self.store.aget_history(history_key(self.session_id)))['messages'])
+
+    async def aadd_messages(self, messages):
+        await self.store.aappend_messages(history_key(self.session_id), messages_to_dict(messages))
+
+    def clear(self) -> None:
+        self.store.delete(history_key(self.session_id))
+
+    async def aclear(self) -> None:
+        await self.store.adelete(history_key(self.session_id))
+
+
+def clear_session(session_id, store=None):
+    store = store or get_session_store()
+    store.delete(state_key(session_id))
+    store.delete(history_key(session_id))
+
+
+if __name__ == "__main__":
+    store = MemorySessionStore(max_entries=2)
+    for i in range(3):
+        save_agent_state(f"session-{i}", {'entities': {'medications': 'Lisinopril'}, 'current_question': 'dosages'}, store)
+    print(store.get(state_key("session-0")), store.get(state_key("session-2")))
+    print("\n".join(store.metric_lines()))
@@ -1,3 +1,1093 @@
-from django.test import TestCase
+import asyncio
+import json
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from ai_bot.fakes import StubChatModel
+
+
+class StubChatModelStreamingTests(SimpleTestCase):
+    def test_stream_yields_reply_word_by_word(self):
+        model = StubChatModel(responses=["Rest the ankle and ice it."])
+        tokens = [chunk.content for chunk in model.stream("I twisted my ankle")]
+        self.assertEqual(tokens, ["Rest ", "the ", "ankle ", "and ", "ice ", "it."])
+
+    def test_astream_matches_invoke(self):
+        model = StubChatModel(responses=["Take it with food."])
+
+        async def collect():
+            return "".join([chunk.content async for chunk in model.astream("How do I take it?")])
+
+        self.assertEqual(asyncio.run(collect()), model.invoke("How do I take it?").content)
+
+
+class FakeBackendTests(SimpleTestCase):
+    def test_stub_reports_token_usage(self):
+        message = StubChatModel(responses=["Take it with food."]).invoke("How do I take it?")
+        self.assertGreater(message.usage_metadata['input_tokens'], 0)
+        self.assertEqual(message.usage_metadata['total_tokens'],
+                         message.usage_metadata['input_tokens'] + message.usage_metadata['output_tokens'])
+
+    def test_fake_reply_extracts_with_the_rules(self):
+        from langchain_core.messages import HumanMessage, SystemMessage
+        from ai_bot.fakes import FAKE_REPLY, fake_reply
+
+        extraction = [SystemMessage("Extract health-related entities ..."), HumanMessage("I take lisinopril 10mg")]
+        self.assertEqual(json.loads(fake_reply(extraction))['dosage'], "10mg")
+        self.assertEqual(fake_reply([SystemMessage("You are a helpful assistant"), HumanMessage("Hi")]), FAKE_REPLY)
+
+    @override_settings(AI_BOT_CHAT_MODEL='stub', AI_BOT_GRAPH_BACKEND='memory')
+    def test_settings_select_the_fakes(self):
+        from ai_bot.backends import build_chat_model, build_graph_backend
+        from ai_bot.graph_backends import InMemoryGraph
+
+        self.assertIsInstance(build_chat_model(model="gpt-4o-mini"), StubChatModel)
+        self.assertIsInstance(build_graph_backend(), InMemoryGraph)
+
+
+class RuleExtractorTests(SimpleTestCase):
+    def test_structured_answers_skip_the_llm(self):
+        from ai_bot.rule_extractor import extract
+
+        result = extract("lisinopril, 10mg twice a day")
+        self.assertTrue(result.confident())
+        self.assertEqual(result.entities, {'medications': "lisinopril", 'dosage': "10mg", 'frequency': "twice a day"})
+
+    def test_negated_answers_go_to_the_llm(self):
+        from ai_bot.rule_extractor import extract
+
+        for message in ("no ibuprofen", "nope", "I stopped taking metformin", "not anymore, I quit lisinopril",
+                        "I don't take aspirin", "never had a flu shot", "no longer on metoprolol 25mg"):
+            with self.subTest(message=message):
+                self.assertFalse(extract(message).confident())
+
+
+class AgentFlowTests(SimpleTestCase):
+    """
+    The README flows through the agent, with the fakes in place of OpenAI and Neo4j
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+
+    def reply(self, message):
+        from ai_bot.bot import generate_bot_response
+        from ai_bot.management.commands.bench_concurrency import make_patient
+
+        return generate_bot_response(message, make_patient(0), session_id="agent-flow")
+
+    def test_medication_follow_ups(self):
+        from ai_bot.prompts import QUESTIONS
+
+        self.assertEqual(self.reply("I'm taking ibuprofen for my fever."), QUESTIONS["dosages"]["question"])
+        self.assertEqual(self.reply("ibuprofen, 200mg"), QUESTIONS["frequencies"]["question"])
+        self.assertNotIn(self.reply("ibuprofen, every 6 hours."),
+                         [QUESTIONS["dosages"]["question"], QUESTIONS["frequencies"]["question"]])
+
+    def test_general_question(self):
+        from ai_bot.fakes import FAKE_REPLY
+
+        self.assertEqual(self.reply("I twisted my ankle, what should I do?"), FAKE_REPLY)
+
+
+@override_settings(AI_BOT_SINGLE_SHOT='on')
+class SingleShotFlowTests(SimpleTestCase):
+    """
+    AgentFlowTests in single-shot mode: one LLM call for the entities and the reply
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.management.commands.bench_concurrency import make_patient
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+        self.patient = make_patient(0)
+        self.calls = []  # 'single_shot' or 'other', per LLM call
+        self.use_model()
+
+    def use_model(self, single_shot_reply=None):
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.fakes import fake_reply
+
+        def respond(messages):
+            single_shot = '"reply":' in messages[0].content
+            self.calls.append('single_shot' if single_shot else 'other')
+            return single_shot_reply if single_shot and single_shot_reply is not None else fake_reply(messages)
+
+        entity_extraction.set_chat_model(StubChatModel(respond=respond))
+        langchain_integration.set_chat_model(StubChatModel(respond=respond))
+
+    def reply(self, message):
+        from ai_bot.bot import generate_bot_response
+
+        return generate_bot_response(message, self.patient, session_id="single-shot-flow")
+
+    def test_medication_follow_ups(self):
+        from ai_bot.prompts import QUESTIONS
+
+        self.assertEqual(self.reply("I'm taking ibuprofen for my fever."), QUESTIONS["dosages"]["question"])
+        self.assertEqual(self.calls, ['single_shot'])
+        # Answers to a follow-up question go through the extraction pipeline
+        self.assertEqual(self.reply("ibuprofen, 200mg"), QUESTIONS["frequencies"]["question"])
+        self.assertNotIn(self.reply("ibuprofen, every 6 hours."),
+                         [QUESTIONS["dosages"]["question"], QUESTIONS["frequencies"]["question"]])
+        self.assertEqual(self.calls.count('single_shot'), 1)
+
+    def test_general_question_takes_one_call(self):
+        from ai_bot.bot import arun_turn
+        from ai_bot.fakes import FAKE_REPLY
+
+        self.assertEqual(self.reply("I twisted my ankle, what should I do?"), FAKE_REPLY)
+        turn = asyncio.run(arun_turn("Is it fine to go for a walk?", self.patient, session_id="single-shot-flow"))
+        self.assertEqual(turn.reply, FAKE_REPLY)
+        self.assertEqual(self.calls, ['single_shot', 'single_shot'])
+
+    def test_bad_response_falls_back_to_the_pipeline(self):
+        from ai_bot.fakes import FAKE_REPLY
+        from ai_bot.prompts import QUESTIONS
+
+        # Valid JSON without a reply: _single_shot_result raises ValueError
+        self.use_model(single_shot_reply=json.dumps({'answer': "Rest it."}))
+        with self.assertLogs('ai_bot.agent', 'ERROR'):
+            self.assertEqual(self.reply("I twisted my ankle, what should I do?"), FAKE_REPLY)
+        with self.assertLogs('ai_bot.agent', 'ERROR'):
+            self.assertEqual(self.reply("I'm taking ibuprofen for my fever."), QUESTIONS["dosages"]["question"])
+        self.assertEqual(self.calls.count('single_shot'), 2)
+        self.assertIn('other', self.calls)
+
+    @override_settings(AI_BOT_SINGLE_SHOT='ab')
+    def test_ab_split_records_turns_per_mode(self):
+        from unittest import mock
+        from ai_bot import instrumentation
+
+        instrumentation.turn_llm_calls.reset()
+        with mock.patch('ai_bot.bot.random.choice', side_effect=['single_shot', 'pipeline', 'pipeline']):
+            for _ in range(3):
+                self.reply("I twisted my ankle, what should I do?")
+        lines = instrumentation.turn_llm_calls.render()
+        self.assertIn('ai_bot_turn_llm_calls_count{mode="single_shot"} 1', lines)
+        self.assertIn('ai_bot_turn_llm_calls_sum{mode="single_shot"} 1', lines)
+        self.assertIn('ai_bot_turn_llm_calls_count{mode="pipeline"} 2', lines)
+        self.assertEqual(self.calls.count('single_shot'), 1)
+
+
+class WriteBehindTests(SimpleTestCase):
+    """
+    Per-key ordering of background writes, and how their errors reach readers
+    """
+
+    def test_writes_for_a_key_apply_in_submission_order(self):
+        import time
+        from ai_bot.write_behind import WriteBehind
+
+        writes, applied = WriteBehind(), []
+        for i in range(3):
+            writes.submit("patient", lambda i=i: (time.sleep(0.02 * (3 - i)), applied.append(i)))
+        writes.submit("other", applied.append, "other")
+        writes.wait("patient")
+        self.assertEqual([i for i in applied if i != "other"], [0, 1, 2])
+
+    def test_async_writes_for_a_key_apply_in_submission_order(self):
+        from ai_bot.write_behind import WriteBehind
+
+        writes, applied = WriteBehind(), []
+
+        async def write(i):
+            await asyncio.sleep(0.02 * (3 - i))
+            applied.append(i)
+
+        async def turn():
+            for i in range(3):
+                writes.asubmit("patient", write, i)
+            await writes.await_key("patient")
+
+        asyncio.run(turn())
+        self.assertEqual(applied, [0, 1, 2])
+
+    def test_failed_write_surfaces_to_the_next_reader(self):
+        from ai_bot.write_behind import WriteBehind
+
+        def fail():
+            raise ValueError("Neo4j is down")
+
+        writes = WriteBehind()
+        with self.assertLogs('ai_bot.write_behind', 'ERROR'):
+            writes.submit("patient", fail).exception()  # done before anyone reads
+            with self.assertRaises(ValueError):
+                writes.wait("patient")
+        writes.wait("patient")  # reported once
+        self.assertEqual(writes.stats()['failed'], 1)
+
+    def test_wait_covers_writes_queued_on_an_event_loop(self):
+        import threading
+        from ai_bot.write_behind import WriteBehind
+
+        writes, applied = WriteBehind(), []
+
+        async def write():
+            await asyncio.sleep(0.05)
+            applied.append("async")
+
+        async def submit():
+            writes.asubmit("patient", write)
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(submit(), loop).result()
+            writes.wait("patient")
+            self.assertEqual(applied, ["async"])
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+@override_settings(AI_BOT_GRAPH_WRITE_BEHIND=True, AI_BOT_SPECULATIVE_RESPONSE=True)
+class WriteBehindFlowTests(SimpleTestCase):
+    """
+    AgentFlowTests with the turn's graph writes in the background, a slow
+    graph, and a speculative general reply
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.management.commands.bench_concurrency import make_patient
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=10)
+        set_session_store(MemorySessionStore())
+        self.patient = make_patient(0)
+
+    def turn(self, message):
+        from ai_bot.bot import run_turn
+
+        return run_turn(message, self.patient, session_id="write-behind-flow")
+
+    def aturn(self, message):
+        from ai_bot.bot import arun_turn
+
+        return asyncio.run(arun_turn(message, self.patient, session_id="write-behind-flow"))
+
+    def profile(self):
+        from ai_bot.agent import graph_writes
+        from ai_bot.knowledge_graph import get_knowledge_graph
+
+        graph_writes.wait(self.patient.get_graph_name())
+        return get_knowledge_graph().get_patient_profile(self.patient.get_graph_name())
+
+    def test_medication_turns_read_back_their_writes(self):
+        from unittest import mock
+        from ai_bot.prompts import QUESTIONS
+
+        self.assertEqual(self.turn("I'm taking ibuprofen for my fever.").reply, QUESTIONS["dosages"]["question"])
+        self.assertEqual(self.turn("ibuprofen, 200mg").reply, QUESTIONS["frequencies"]["question"])
+        # The speculative general reply is discarded for one about the stored medication
+        with mock.patch('ai_bot.agent.get_bot_response_based_on_entities', return_value="About your ibuprofen") as reply:
+            self.assertEqual(self.turn("ibuprofen, every 6 hours.").reply, "About your ibuprofen")
+        self.assertIn("200mg", reply.call_args.args[0])
+        profile = self.profile()
+        self.assertEqual(profile['medications'], ["ibuprofen"])
+        self.assertTrue(profile['dosages'])
+        self.assertTrue(profile['frequencies'])
+
+    def test_appointment_turn_discards_the_speculative_reply(self):
+        for turn in (self.turn, self.aturn):
+            with self.subTest(turn=turn.__name__):
+                result = turn("I want to change the appointment to next Monday")
+                self.assertTrue(result.reply.startswith("I will convey your request to Dr."))
+                self.assertEqual(result.appointment_request.requested_time.lower(), "next monday")
+
+    def test_general_question_uses_the_speculative_reply(self):
+        from ai_bot.fakes import FAKE_REPLY
+
+        self.assertEqual(self.turn("I twisted my ankle, what should I do?").reply, FAKE_REPLY)
+        self.assertEqual(self.aturn("I twisted my ankle, what should I do?").reply, FAKE_REPLY)
+
+    def test_failed_write_surfaces_to_the_next_turn(self):
+        from unittest import mock
+
+        with mock.patch('ai_bot.agent._store_turn', side_effect=ValueError("Neo4j is down")), \
+                self.assertLogs('ai_bot.write_behind', 'ERROR'):
+            self.turn("I'm taking ibuprofen for my fever.")
+            with self.assertRaises(ValueError):
+                self.turn("ibuprofen, 200mg")
+
+    def test_failed_async_write_surfaces_to_the_next_turn(self):
+        from unittest import mock
+        from ai_bot.bot import arun_turn
+
+        async def turns():
+            await arun_turn("I'm taking ibuprofen for my fever.", self.patient, session_id="write-behind-flow")
+            await arun_turn("ibuprofen, 200mg", self.patient, session_id="write-behind-flow")
+
+        with mock.patch('ai_bot.agent._astore_turn', side_effect=ValueError("Neo4j is down")), \
+                self.assertLogs('ai_bot.write_behind', 'ERROR'):
+            with self.assertRaises(ValueError):
+                asyncio.run(turns())
+
+
+class TargetedExtractionTests(SimpleTestCase):
+    """
+    Answers to a follow-up question only extract that question's fields
+    """
+
+    def setUp(self):
+        from ai_bot import entity_extraction
+        from ai_bot.backends import use_fakes
+        from ai_bot.extraction_cache import ExtractionCache
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+        self.prompts = []
+        # The LLM answers every field, whatever it was asked for
+        reply = json.dumps({'medications': "ibuprofen", 'dosage': "200mg", 'frequency': "twice a day", 'health_issues': "fever"})
+        entity_extraction.set_chat_model(StubChatModel(respond=lambda messages: self.prompts.append(messages[0].content) or reply))
+        self.cache = ExtractionCache()
+        entity_extraction.set_extraction_cache(self.cache)
+        self.addCleanup(entity_extraction.set_extraction_cache, None)
+
+    def targeted_calls(self):
+        from ai_bot.prompts import QUESTIONS
+
+        return [prompt for prompt in self.prompts if any(q['question'] in prompt for q in QUESTIONS.values())]
+
+    def test_answers_fill_only_the_requested_fields(self):
+        from ai_bot.entity_extraction import aextract_answer, extract_answer
+
+        for _ in range(2):
+            answer = extract_answer("two hundred milligrams I think", "dosages")
+            self.assertEqual((answer['dosage'], answer['medications'], answer['frequency'], answer['health_issues']),
+                             ("200mg", "ibuprofen", None, None))
+        answer = asyncio.run(aextract_answer("whenever the pain comes back", "frequencies"))
+        self.assertEqual((answer['frequency'], answer['medications'], answer['dosage'], answer['health_issues']),
+                         ("twice a day", "ibuprofen", None, None))
+        self.assertEqual(len(self.targeted_calls()), 2)  # the repeated answer came from the cache
+
+    def test_targeted_entries_never_collide_with_full_extraction(self):
+        from ai_bot.entity_extraction import extract_answer, extract_entities
+
+        message = "two hundred milligrams I think"
+        self.assertIsNone(extract_answer(message, "dosages")['health_issues'])
+        # Same message, other fields: each is its own cache entry and LLM call
+        self.assertEqual(extract_entities(message)['health_issues'], "fever")
+        self.assertIsNone(extract_answer(message, "frequencies")['dosage'])
+        self.assertEqual(len(self.prompts), 3)
+        self.assertEqual(len(self.targeted_calls()), 2)
+        self.assertEqual(self.cache.stats()['entries'], 3)
+
+    def test_falls_back_to_full_extraction(self):
+        from ai_bot.agent import AgentState, extract_entities_step
+        from ai_bot.management.commands.bench_concurrency import make_patient
+
+        def extract(message, current_question):
+            self.prompts.clear()
+            extract_entities_step(AgentState(input=message, patient=make_patient(0), current_question=current_question))
+            return len(self.targeted_calls())
+
+        self.assertEqual(extract("two hundred milligrams I think", "dosages"), 1)
+        self.assertEqual(extract("it's the small white pill", None), 0)
+        with override_settings(AI_BOT_TARGETED_EXTRACTION=False):
+            self.assertEqual(extract("whenever the pain comes back", "frequencies"), 0)
+        self.assertEqual(len(self.prompts), 1)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        from ai_bot import langchain_integration
+        from ai_bot.response_cache import ResponseCache
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        self.prompts = []
+        model = StubChatModel(respond=lambda messages: self.prompts.append(messages) or "Rest and ice the ankle.")
+        langchain_integration.set_chat_model(model)
+        langchain_integration.set_response_cache(ResponseCache())
+        set_session_store(MemorySessionStore())
+        self.addCleanup(langchain_integration.set_chat_model, None)
+        self.addCleanup(langchain_integration.set_response_cache, None)
+
+    def test_shared_replies_come_from_the_key_alone(self):
+        from ai_bot.langchain_integration import get_bot_response
+        from ai_bot.management.commands.bench_concurrency import make_patient
+
+        ann, bob = make_patient(0), make_patient(1)
+        question = "What helps a twisted ankle heal faster?"
+        self.assertEqual(get_bot_response(question, ann, session_id="ann"), "Rest and ice the ankle.")
+        self.assertEqual(get_bot_response(question, bob, session_id="bob"), "Rest and ice the ankle.")
+
+        self.assertEqual(len(self.prompts), 1)  # Bob got Ann's reply
+        prompt = " ".join(message.content for message in self.prompts[0]).lower()
+        for private in ("load", "test 0", "smith", "lisinopril"):
+            self.assertNotIn(private, prompt)
+
+    def test_questions_about_the_patient_skip_the_cache(self):
+        from ai_bot.langchain_integration import get_bot_response, get_response_cache
+        from ai_bot.management.commands.bench_concurrency import make_patient
+
+        ann, bob = make_patient(0), make_patient(1)
+        for question in ("When is my next appointment?", "Who is the doctor I see?", "Is ibuprofen safe with food?"):
+            with self.subTest(question=question):
+                self.prompts.clear()
+                get_bot_response(question, ann, session_id=f"ann {question}")
+                get_bot_response(question, bob, session_id=f"bob {question}")
+                # Bob's reply is generated from his own record, not served from Ann's entry
+                self.assertEqual(len(self.prompts), 2)
+                self.assertIn(bob.get_full_name(), self.prompts[1][0].content)
+        self.assertEqual(get_response_cache().stats()['bypass'], 6)
+
+    def test_memory_hits_keep_their_rows(self):
+        from ai_bot.models import ResponseCacheEntry
+        from ai_bot.response_cache import ResponseCache
+
+        cache = ResponseCache(max_entries=2, evict_every=1)
+        context = {'age_band': "40s", 'condition': "hypertension"}
+        for question in ("how do I sleep better", "how do I eat better"):
+            cache.set("v1", question, context, f"Reply to {question}")
+        cache.get("v1", "how do I sleep better", context)  # served from memory
+        cache.set("v1", "how do I walk better", context, "Reply")
+        self.assertEqual(sorted(ResponseCacheEntry.objects.values_list('normalized_question', flat=True)),
+                         ["how do i sleep better", "how do i walk better"])
+
+
+class ResetPatientTests(SimpleTestCase):
+    def setUp(self):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        self.kg = KnowledgeGraph(backend=InMemoryGraph())
+        for name, entities in (
+            ("Ann", {"medications": "ibuprofen", "dosage": "200mg", "health_issues": "fever"}),
+            ("Bob", {"medications": "ibuprofen", "health_issues": "fever, cough"}),
+            ("Ann", {"medications": "metformin", "dosage": "500mg", "frequency": "twice a day"}),
+        ):
+            self.kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+            store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), **entities}, name, kg=self.kg)
+
+    def values(self, label, prop):
+        return sorted(node[prop] for node in self.kg.backend.nodes.get(label, {}).values())
+
+    def test_keeps_what_other_patients_reference(self):
+        bob = self.kg.get_patient_profile("Bob")
+        self.kg.reset_patient("Ann", batch_size=2)
+
+        self.assertIsNone(self.kg.get_patient_profile("Ann"))
+        self.assertEqual(self.kg.get_patient_profile("Bob"), bob)
+        self.assertEqual(self.values('Medication', 'name'), ["ibuprofen"])
+        self.assertEqual(self.values('HealthIssue', 'description'), ["cough", "fever"])
+        # ibuprofen's dosage stays with ibuprofen; metformin's values go with it
+        self.assertEqual(self.values('Dosage', 'value'), ["200mg"])
+        self.assertEqual(self.values('Frequency', 'value'), [])
+
+    def test_last_patient_leaves_an_empty_graph(self):
+        self.kg.reset_patient("Ann")
+        self.kg.reset_patient("Bob")
+        self.assertEqual(self.kg.backend.node_count(), 0)
+        self.assertEqual(self.kg.backend.relationships, set())
+
+
+class RenamePatientTests(SimpleTestCase):
+    def test_old_node_merges_into_the_graph_name(self):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        kg = KnowledgeGraph(backend=InMemoryGraph())
+        for name, entities in (("Ann Lee", {"medications": "ibuprofen", "dosage": "200mg"}),
+                               ("Ann Lee #1", {"health_issues": "fever"})):
+            kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+            store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), **entities}, name, kg=kg)
+
+        self.assertEqual(kg.run_query('rename_patient', old_name="Ann Lee", new_name="Ann Lee #1"), [{'renamed': 1}])
+        self.assertIsNone(kg.get_patient_profile("Ann Lee"))
+        profile = kg.get_patient_profile("Ann Lee #1")
+        self.assertEqual((profile['medications'], profile['dosages'], profile['health_issues']),
+                         (["ibuprofen"], ["200mg"], ["fever"]))
+        self.assertEqual(kg.run_query('rename_patient', old_name="Ann Lee", new_name="Ann Lee #1"), [{'renamed': 0}])
+
+
+class QueryCatalogTests(SimpleTestCase):
+    def test_missing_parameters_are_refused(self):
+        from ai_bot.cypher_queries import catalog
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        with self.assertRaisesMessage(ValueError, "missing parameters: medication"):
+            catalog.bind('medication_detail_counts', {'name': "Ann"})
+        with self.assertRaises(ValueError):
+            KnowledgeGraph(backend=InMemoryGraph()).run_query('merge_patient', name="Ann")
+        self.assertIs(catalog.bind('medication_detail_counts', {'name': "Ann", 'medication': "ibuprofen"}),
+                      catalog.prepare('medication_detail_counts'))
+
+    @override_settings(AI_BOT_PROFILE_STORE='off')
+    def test_one_query_text_per_named_query(self):
+        from unittest import mock
+        from ai_bot.graph_backends import Neo4jBackend, query_texts
+        from ai_bot.instrumentation import render_metrics
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        backend = Neo4jBackend('bolt://localhost:7687', auth=('neo4j', 'secret'))
+        self.addCleanup(backend.close)
+        backend.driver = mock.MagicMock()  # every query returns no records
+        kg = KnowledgeGraph(backend=backend)
+        kg.run_query('medication_detail_counts', name="Ann", medication="ibuprofen")
+        distinct, executions = query_texts.distinct(), query_texts.executions
+        for name in ("Bob", "O'Brien"):
+            kg.run_query('medication_detail_counts', name=name, medication="aspirin")
+        # The names are parameters: no new text for Neo4j to plan
+        self.assertEqual(query_texts.distinct(), distinct)
+        self.assertEqual(query_texts.executions - executions, 2)
+        self.assertIn("ai_bot_cypher_query_texts", render_metrics())
+
+
+class CypherCapabilityTests(SimpleTestCase):
+    def setUp(self):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        self.kg = KnowledgeGraph(backend=InMemoryGraph())
+
+    def test_in_memory_graph_has_no_cypher(self):
+        self.assertFalse(self.kg.supports_cypher)
+        self.assertFalse(hasattr(self.kg.backend, 'query'))
+
+    def test_arbitrary_cypher_raises_a_domain_error(self):
+        from ai_bot.graph_backends import CypherNotSupported
+
+        with self.assertRaisesMessage(CypherNotSupported, "InMemoryGraph"):
+            self.kg.execute_query("MATCH (n) RETURN n")
+        with self.assertRaises(CypherNotSupported):
+            self.kg.get_entity_info('Patient', {'name': "Ann"})
+
+    def test_ask_needs_cypher(self):
+        from ai_bot.graph_backends import CypherNotSupported
+
+        # Before any QA chain (and its LLM) is built
+        with self.assertRaisesMessage(CypherNotSupported, "ask()"):
+            self.kg.ask("Which medications does Ann take?")
+        self.assertIsNone(self.kg.qa_chain)
+
+
+class Neo4jBackendTests(SimpleTestCase):
+    @override_settings(NEO4J_URI='bolt://localhost:7687', NEO4J_USERNAME='neo4j', NEO4J_PASSWORD='secret',
+                       NEO4J_DATABASE='patients')
+    def test_backend_builds_its_driver_from_settings(self):
+        import neo4j
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        kg = KnowledgeGraph()  # the driver connects on first use, so no server is needed
+        self.addCleanup(kg.close)
+        self.assertIsInstance(kg.backend.driver, neo4j.Driver)
+        self.assertEqual(kg.backend.database, 'patients')
+        self.assertEqual(kg.backend.auth, ('neo4j', 'secret'))
+        self.assertIsNone(kg.backend._graph)  # langchain's Neo4jGraph waits for ask()
+
+    def test_close_closes_the_async_drivers(self):
+        from ai_bot.graph_backends import Neo4jBackend
+
+        backend = Neo4jBackend('bolt://localhost:7687', auth=('neo4j', 'secret'))
+
+        async def driver():
+            return backend._async_driver()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        async_driver = loop.run_until_complete(driver())
+        backend.close()
+        self.assertTrue(async_driver._closed)
+        self.assertEqual(len(backend._async_drivers), 0)
+
+
+class KnowledgeGraphTimingTests(SimpleTestCase):
+    def test_concurrent_operations_are_all_counted(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        kg = KnowledgeGraph(backend=InMemoryGraph())
+
+        def operation(_):
+            with kg.timed('op'):
+                pass
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(operation, range(2000)))
+        self.assertEqual(kg.timings_snapshot()['op']['count'], 2000)
+
+
+class GraphSchemaTests(SimpleTestCase):
+    def write_samples(self, kg, patients=("Ann", "Bob")):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS, SAMPLE_TURNS
+
+        for name in patients:
+            for turn in SAMPLE_TURNS:
+                store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), **turn}, name, kg=kg)
+
+    def make_graph(self):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        return KnowledgeGraph(backend=InMemoryGraph())
+
+    def test_indexed_graph_matches_label_scans(self):
+        scanned, indexed = self.make_graph(), self.make_graph()
+        indexed.ensure_schema()
+        indexed.ensure_schema()  # idempotent
+        for kg in (scanned, indexed):
+            self.write_samples(kg)
+        self.assertEqual(indexed.backend.snapshot(), scanned.backend.snapshot())
+
+    def test_index_follows_deletes(self):
+        kg = self.make_graph()
+        kg.ensure_schema()
+        self.write_samples(kg)
+        kg.reset_patient("Ann")
+        self.write_samples(kg, patients=("Ann",))
+        self.assertEqual(kg.get_patient_profile("Ann"), kg.get_patient_profile("Bob"))
+
+    def test_notes_and_vitals_are_keyed_per_patient(self):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        kg = self.make_graph()
+        kg.ensure_schema()
+        note = "Follow up on the blood pressure in two weeks. " * 500  # past Neo4j's index key size
+        for name in ("Ann", "Bob"):
+            store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), 'doctor_notes': note, 'blood_pressure': "120/80"},
+                                        name, kg=kg)
+        # Identical notes and vitals of two patients stay two nodes, with bounded keys
+        for label in ('DoctorNote', 'Vital'):
+            self.assertEqual(len(kg.backend.nodes[label]), 2)
+            self.assertTrue(all(len(props['key']) == 32 for props in kg.backend.nodes[label].values()))
+        kg.reset_patient("Ann")
+        self.assertEqual(kg.get_patient_profile("Bob")['doctor_notes'], [note])
+        self.assertEqual(kg.get_patient_profile("Bob")['blood_pressure'], ["120/80"])
+
+    def test_schema_statements(self):
+        from unittest import mock
+        from ai_bot.graph_backends import Neo4jBackend
+        from ai_bot.knowledge_graph import KnowledgeGraph
+
+        backend = Neo4jBackend('bolt://localhost:7687', auth=('neo4j', 'secret'))
+        self.addCleanup(backend.close)
+        with mock.patch.object(backend, 'query') as query:
+            KnowledgeGraph(backend=backend).ensure_schema()
+        statements = [call.args[0] for call in query.call_args_list]
+        self.assertIn("DROP CONSTRAINT doctornote_content_unique IF EXISTS", statements)
+        self.assertIn("CREATE CONSTRAINT doctornote_key_unique IF NOT EXISTS FOR (n:DoctorNote) REQUIRE (n.key) IS UNIQUE",
+                      statements)
+        self.assertIn("CREATE TEXT INDEX doctornote_content_text IF NOT EXISTS FOR (n:DoctorNote) ON (n.content)", statements)
+        self.assertIn("CREATE INDEX immunization_name IF NOT EXISTS FOR (n:Immunization) ON (n.name)", statements)
+        self.assertFalse([statement for statement in statements if "IS UNIQUE" in statement and "content" in statement])
+
+    def test_unique_key_refuses_duplicates(self):
+        kg = self.make_graph()
+        kg.backend.create_nodes('Medication', [{'name': "ibuprofen"}, {'name': "ibuprofen"}])
+        with self.assertRaises(ValueError):
+            kg.ensure_schema()
+
+
+class SameEmbeddings:
+    # Every message is a perfect semantic match: only the exact-token guard tells them apart
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+    async def aembed_query(self, text):
+        return [1.0, 0.0]
+
+
+class ExtractionCacheTests(TestCase):
+    version = "v1"
+
+    def test_exact_hit_after_normalization(self):
+        from ai_bot.extraction_cache import ExtractionCache
+
+        cache = ExtractionCache()
+        cache.set("Twice a day.", self.version, {'frequency': "twice a day"})
+        self.assertEqual(cache.get("  twice  a DAY!", self.version), {'frequency': "twice a day"})
+        self.assertIsNone(cache.get("twice a week", self.version))
+        stats = cache.stats()
+        self.assertEqual((stats['hits']['memory'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+        self.assertIn('ai_bot_extraction_cache_lookups_total{result="miss"} 1', cache.metric_lines())
+
+    def test_version_change_invalidates_entries(self):
+        from ai_bot.extraction_cache import ExtractionCache, cache_version
+
+        cache = ExtractionCache(persistent=True)
+        version = cache_version("prompt", {'schema': 1})
+        cache.set("twice a day", version, {'frequency': "twice a day"})
+        self.assertIsNone(cache.get("twice a day", cache_version("prompt v2", {'schema': 1})))
+        self.assertIsNone(ExtractionCache(persistent=True).get("twice a day", cache_version("prompt", {'schema': 2})))
+
+    def test_entries_expire_after_the_ttl(self):
+        from unittest import mock
+        from django.utils import timezone
+        from ai_bot.extraction_cache import ExtractionCache
+
+        cache = ExtractionCache(ttl=60, persistent=True)
+        cache.set("twice a day", self.version, {'frequency': "twice a day"})
+        later = timezone.now() + timezone.timedelta(seconds=61)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            # A fresh process: nothing in memory, the row has expired
+            self.assertIsNone(ExtractionCache(ttl=60, persistent=True).get("twice a day", self.version))
+            self.assertEqual(cache.purge_stale(self.version), 1)
+
+    def test_db_tier_is_shared_across_caches(self):
+        from ai_bot.extraction_cache import ExtractionCache
+
+        ExtractionCache(persistent=True).set("twice a day", self.version, {'frequency': "twice a day"})
+        other = ExtractionCache(persistent=True)
+        self.assertEqual(other.get("twice a day", self.version), {'frequency': "twice a day"})
+        self.assertEqual(other.get("twice a day", self.version), {'frequency': "twice a day"})
+        self.assertEqual(other.stats()['hits'], {'memory': 1, 'db': 1, 'semantic': 0})
+
+    def test_purge_stale_keeps_current_entries(self):
+        from ai_bot.extraction_cache import ExtractionCache
+
+        cache = ExtractionCache(persistent=True)
+        cache.set("twice a day", "old", {'frequency': "twice a day"})
+        cache.set("twice a day", self.version, {'frequency': "twice a day"})
+        self.assertEqual(cache.purge_stale(self.version), 1)
+        self.assertEqual(list(cache.model.objects.values_list('version', flat=True)), [self.version])
+
+    def test_semantic_hit_needs_the_same_numbers_units_and_negations(self):
+        from ai_bot.extraction_cache import ExtractionCache, SemanticIndex
+
+        cache = ExtractionCache(semantic=SemanticIndex(SameEmbeddings()))
+        cache.set("I took 200 mg of ibuprofen", self.version, {'dosage': "200 mg"})
+        cache.set("I take aspirin twice a day", self.version, {'medications': "aspirin"})
+        self.assertEqual(cache.get("took 200mg of ibuprofen", self.version), {'dosage': "200 mg"})
+        for message in ("I took 400 mg of ibuprofen", "I took 200 ml of ibuprofen", "I don't take aspirin twice a day",
+                        "I take aspirin once a day", "I never take aspirin twice a day"):
+            with self.subTest(message=message):
+                self.assertIsNone(cache.get(message, self.version))
+        self.assertEqual(asyncio.run(cache.aget("I take aspirin, twice a day", self.version)), {'medications': "aspirin"})
+        self.assertEqual(cache.stats()['hits']['semantic'], 2)
+
+
+class ProfileQueryTests(SimpleTestCase):
+    def test_aggregated_query_matches_the_cartesian_one(self):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+        from ai_bot.management.commands.bench_profile_store import same_profile
+
+        kg = KnowledgeGraph(backend=InMemoryGraph())
+        kg.run_query('merge_patient', name="Ann", store_medication=True, store_appointment=False)
+        for entities in ({'medications': "ibuprofen", 'dosage': "200mg", 'frequency': "every 6 hours"},
+                         {'medications': "metformin", 'dosage': "500mg", 'frequency': "twice a day"},
+                         {'medications': "lisinopril", 'dosage': "10mg"},
+                         {'health_issues': "fever, headache, diabetes", 'allergies': "penicillin, peanuts"},
+                         {'blood_pressure': "120/80", 'heart_rate': "72", 'temperature': "38.5", 'weight': "80kg"},
+                         {'blood_pressure': "130/85", 'heart_rate': "80"}):
+            store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), **entities}, "Ann", kg=kg)
+
+        cartesian = kg.get_patient_profile("Ann", mode='cartesian')
+        cartesian_rows = kg.backend.last_row_count
+        aggregated = kg.get_patient_profile("Ann", mode='aggregated')
+        self.assertTrue(same_profile(aggregated, cartesian), f"{aggregated} != {cartesian}")
+        self.assertEqual(sorted(aggregated['medications']), ["ibuprofen", "lisinopril", "metformin"])
+        self.assertEqual(len(aggregated['health_issues']), 3)
+        self.assertLess(kg.backend.last_row_count, cartesian_rows)
+
+
+class ProfileStoreTests(SimpleTestCase):
+    def make_graph(self):
+        from ai_bot.graph_backends import InMemoryGraph
+        from ai_bot.knowledge_graph import KnowledgeGraph
+        from ai_bot.profile_store import MemoryProfileStore
+
+        kg = KnowledgeGraph(backend=InMemoryGraph())
+        kg.profiles = MemoryProfileStore()
+        return kg
+
+    def write(self, kg, name, **entities):
+        from ai_bot.entity_extraction import store_entities_as_documents
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        kg.run_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+        store_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), **entities}, name, kg=kg)
+
+    def assertMatchesGraph(self, kg, name):
+        from ai_bot.management.commands.bench_profile_store import same_profile
+
+        stored, graph = kg.read_patient_profile(name), kg.get_patient_profile(name)
+        self.assertTrue(same_profile(stored, graph), f"store {stored} != graph {graph}")
+
+    def test_writes_update_the_stored_profiles(self):
+        kg = self.make_graph()
+        self.write(kg, "Ann", medications="ibuprofen", dosage="200mg", health_issues="fever")
+        self.write(kg, "Bob", medications="ibuprofen")
+        for name in ("Ann", "Bob"):
+            self.assertMatchesGraph(kg, name)  # seeds the store
+
+        # A dosage Bob adds to the shared medication shows in Ann's profile too
+        self.write(kg, "Bob", medications="ibuprofen", dosage="400mg", frequency="every 6 hours")
+        self.write(kg, "Ann", allergies="penicillin", weight="80kg")
+        for name in ("Ann", "Bob"):
+            self.assertMatchesGraph(kg, name)
+        self.assertEqual(sorted(kg.read_patient_profile("Ann")['dosages']), ["200mg", "400mg"])
+
+        kg.reset_patient("Ann")
+        self.assertIsNone(kg.read_patient_profile("Ann"))
+        self.assertMatchesGraph(kg, "Bob")
+        kg.clear_graph()
+        self.assertIsNone(kg.read_patient_profile("Bob"))
+
+    def test_hits_skip_the_graph(self):
+        kg = self.make_graph()
+        self.write(kg, "Ann", medications="ibuprofen", dosage="200mg")
+        kg.read_patient_profile("Ann")
+        round_trips = kg.backend.round_trips
+        self.write(kg, "Ann", medications="ibuprofen", frequency="twice a day", health_issues="fever")
+        writes = kg.backend.round_trips - round_trips
+
+        record = kg.read_patient_profile("Ann")
+        self.assertEqual(kg.backend.round_trips - round_trips, writes)
+        self.assertEqual(record['frequencies'], ["twice a day"])
+        self.assertEqual(record['health_issues'], ["fever"])
+        self.assertTrue(record['store_medication'])
+
+        # A medication new to the store is read from the graph once
+        self.write(kg, "Ann", medications="metformin", dosage="500mg")
+        self.assertMatchesGraph(kg, "Ann")
+        self.assertEqual(kg.profiles.stats()['misses'], 2)
+
+    def test_every_write_path_keeps_the_store_coherent(self):
+        from ai_bot.entity_extraction import astore_entities_as_documents, store_entities_as_documents
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        def entities(**values):
+            return {**dict.fromkeys(ENTITY_FIELDS), **values}
+
+        kg = self.make_graph()
+        names = ("Ann", "Bob", "Cy", "Ann Lee", "Ann Lee #1")
+        for name in names:
+            self.write(kg, name, medications="ibuprofen", dosage="200mg", health_issues=f"fever of {name}")
+
+        writes = [
+            lambda: store_entities_as_documents(entities(medications="ibuprofen", dosage="400mg"), "Bob", kg=kg, batched=False),
+            lambda: kg.add_entity('Patient', {'name': "Dee"}),
+            lambda: kg.add_relationship('Patient', {'name': "Cy"}, 'TAKES', 'Medication', {'name': "ibuprofen"}),
+            lambda: store_entities_as_documents(entities(medications="metformin", frequency="daily"), "Ann", kg=kg),
+            lambda: asyncio.run(astore_entities_as_documents(entities(allergies="penicillin"), "Cy", kg=kg)),
+            lambda: kg.run_query('merge_patient', name="Ann", store_medication=False, store_appointment=True),
+            lambda: asyncio.run(kg.arun_query('merge_patient', name="Bob", store_medication=False, store_appointment=True)),
+            lambda: kg.reset_patient("Ann"),
+            lambda: asyncio.run(kg.areset_patient("Cy")),
+            lambda: kg.run_query('rename_patient', old_name="Ann Lee", new_name="Ann Lee #1"),
+            kg.clear_graph,
+        ]
+        for write in writes:
+            for name in names:
+                self.assertMatchesGraph(kg, name)  # seeds the store before each write
+            write()
+            for name in names:
+                self.assertMatchesGraph(kg, name)
+
+    def test_every_query_declares_its_profile_effects(self):
+        import re
+
+        from ai_bot.cypher_queries import PROFILE_EFFECTS, QUERIES, catalog
+        from ai_bot.profile_store import ProfileStore
+
+        self.assertEqual(PROFILE_EFFECTS.keys(), QUERIES.keys())
+        for name in QUERIES:
+            prepared = catalog.prepare(name)
+            if re.search(r'\b(MERGE|SET|DELETE|CREATE|REMOVE)\b', prepared.text):
+                self.assertTrue(prepared.profile_effects, f"{name} writes but declares no profile effects")
+            for method, params in prepared.profile_effects:
+                self.assertTrue(callable(getattr(ProfileStore, method)))
+                self.assertLessEqual(set(params), prepared.parameters)
+
+    @override_settings(AI_BOT_PROFILE_STORE='db')
+    def test_unshared_graph_gets_a_memory_store(self):
+        from ai_bot.profile_store import MemoryProfileStore, build_profile_store
+
+        self.assertIsInstance(build_profile_store(shared_graph=False), MemoryProfileStore)
+        self.assertIsNone(build_profile_store('off'))
+
+
+class DatabaseProfileStoreTests(TestCase):
+    def setUp(self):
+        from ai_bot.profile_store import DatabaseProfileStore
+
+        self.store = DatabaseProfileStore()
+        self.store.seed("Ann", {'medications': ["ibuprofen"], 'store_medication': True},
+                        [{'name': "ibuprofen", 'dosages': ["200mg"], 'frequencies': []}])
+
+    def test_updates_bump_the_version(self):
+        from ai_bot.models import ProfileEntry
+
+        self.store.apply([('Medication', {'name': "ibuprofen"}, 'HAS_DOSAGE', 'Dosage', {'value': "400mg"})])
+        self.assertEqual(ProfileEntry.objects.get(key="medication:ibuprofen").version, 2)
+        self.assertEqual(self.store.get_profile("Ann")['dosages'], ["200mg", "400mg"])
+
+    def test_conflicting_update_drops_the_entry(self):
+        from unittest import mock
+        from django.db.models import F
+        from ai_bot import profile_store
+        from ai_bot.models import ProfileEntry
+
+        def concurrent_write(data, additions, values):
+            # Another worker updates the entry between our read and our compare-and-set
+            ProfileEntry.objects.filter(key="patient:Ann").update(version=F('version') + 1)
+            return data
+
+        with mock.patch.object(profile_store, '_extend', side_effect=concurrent_write):
+            self.store.set_flags("Ann", True, True)
+        # Dropped after `retries` conflicts, and read from the graph again next time
+        self.assertIsNone(self.store.get_profile("Ann"))
+
+    def test_async_methods_see_the_test_transaction(self):
+        from asgiref.sync import async_to_sync
+        from ai_bot.cypher_queries import catalog
+
+        # ORM calls run on the thread-sensitive executor, in this test's transaction
+        self.assertEqual(async_to_sync(self.store.aget_profile)("Ann")['dosages'], ["200mg"])
+        async_to_sync(self.store.aapply_query)(catalog.prepare('merge_patient'),
+                                               {'name': "Ann", 'store_medication': True, 'store_appointment': True})
+        self.assertTrue(self.store.get_profile("Ann")['store_appointment'])
+
+    def test_writes_to_unknown_patients_are_skipped(self):
+        from ai_bot.models import ProfileEntry
+
+        self.store.set_flags("Bob", True, False)
+        self.assertFalse(ProfileEntry.objects.filter(key="patient:Bob").exists())
+        self.assertIsNone(self.store.get_profile("Bob"))
+
+
+class SessionStoreTests(TestCase):
+    def stores(self):
+        from ai_bot.fakes import FakeRedis
+        from ai_bot.session_store import DatabaseSessionStore, MemorySessionStore, RedisSessionStore
+
+        return [MemorySessionStore(), DatabaseSessionStore(ttl=60), RedisSessionStore(client=FakeRedis(), ttl=60)]
+
+    def test_concurrent_turns_keep_every_message(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from langchain_core.messages import AIMessage, HumanMessage
+        from ai_bot.session_store import StoredChatMessageHistory
+
+        # Threads get their own database connections, outside the test transaction
+        for store in self.stores()[::2]:
+            history = StoredChatMessageHistory("busy", store=store)
+
+            def turn(i):
+                history.add_messages([HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")])
+
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(turn, range(40)))
+            with self.subTest(store=type(store).__name__):
+                self.assertEqual(len(history.messages), 80)
+
+    def test_fold_applies_to_the_history_it_read(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                history = store.append_messages("history:s", [{'n': i} for i in range(4)])
+                head = history['messages'][:2]
+                self.assertTrue(store.fold_messages("history:s", head, '', "first two"))
+                # A second fold of the same head, by a turn that read the history before, is refused
+                self.assertFalse(store.fold_messages("history:s", head, '', "first two"))
+                store.append_messages("history:s", [{'n': 4}])
+                self.assertEqual(store.get_history("history:s"), {'summary': "first two", 'messages': [{'n': i} for i in (2, 3, 4)]})
+                store.delete("history:s")
+                self.assertEqual(store.get_history("history:s"), {'summary': '', 'messages': []})
+
+    def test_async_methods_see_the_test_transaction(self):
+        from asgiref.sync import async_to_sync
+
+        # The database store runs its ORM calls on the thread-sensitive executor
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                store.set("state:s", {'current_question': "dosages"})
+                self.assertEqual(async_to_sync(store.aget)("state:s"), {'current_question': "dosages"})
+                async_to_sync(store.aappend_messages)("history:s", [{'n': 0}])
+                self.assertEqual(store.get_history("history:s")['messages'], [{'n': 0}])
+                async_to_sync(store.adelete)("state:s")
+                self.assertIsNone(store.get("state:s"))
+
+    def test_stats_are_exported(self):
+        from ai_bot.instrumentation import render_metrics
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        store = MemorySessionStore()
+        set_session_store(store)
+        self.addCleanup(set_session_store, None)
+        store.get("state:missing")
+        self.assertIn('ai_bot_session_store_lookups_total{result="miss"} 1', render_metrics())
+
+
+class HistoryMetricsTests(SimpleTestCase):
+    def test_window_and_summary_sizes_are_exported(self):
+        from langchain_core.messages import AIMessage, HumanMessage
+        from ai_bot.history import WindowedChatMessageHistory, history_tokens
+        from ai_bot.instrumentation import render_metrics
+        from ai_bot.session_store import MemorySessionStore
+
+        history_tokens.reset()
+        history = WindowedChatMessageHistory("metrics", store=MemorySessionStore(), max_tokens=1000, keep_summary=False)
+        history.add_messages([HumanMessage(content="I take ibuprofen"), AIMessage(content="How much do you take?")])
+        metrics = render_metrics()
+        self.assertIn('ai_bot_history_tokens_count{part="window"} 1', metrics)
+        self.assertIn('ai_bot_history_tokens_sum{part="summary"} 0', metrics)
+        self.assertIn('ai_bot_prompt_tokens_count', metrics)
+
+
+class StartupTests(SimpleTestCase):
+    def test_startup_does_not_import_the_ai_stack(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        # Fails with CommandError when django.setup() or the URLconf imports LangChain, OpenAI or Neo4j
+        call_command('importtime', '--check', '--top', '1', stdout=StringIO())
+
+
+class WarmUpTests(SimpleTestCase):
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+
+    def test_run_builds_the_ai_stack(self):
+        from ai_bot.warmup import WarmUp
+
+        warm_up = WarmUp()
+        warm_up.run()
+        self.assertTrue(warm_up.ready, warm_up.error)
+        self.assertEqual(list(warm_up.steps), ['chat_models', 'caches', 'session_store', 'token_counter',
+                                               'knowledge_graph', 'agent_apps'])
+
+    def test_dry_run_restores_the_configured_backends(self):
+        from ai_bot import entity_extraction
+        from ai_bot.warmup import WarmUp
+
+        with override_settings(AI_BOT_CHAT_MODEL='stub', AI_BOT_GRAPH_BACKEND='memory'):
+            WarmUp().dry_run()
+            self.assertIsInstance(entity_extraction.get_chains().llm, StubChatModel)
+
+    def test_readiness(self):
+        import os
+        from unittest import mock
+        from ai_bot.warmup import warm_up
+
+        with mock.patch.multiple(warm_up, status='warming', pid=os.getpid()):
+            self.assertEqual(self.client.get('/healthz/ready').status_code, 503)
+        with mock.patch.multiple(warm_up, status='ready', pid=os.getpid()):
+            response = self.client.get('/healthz/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ready')
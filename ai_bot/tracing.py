@@ -0,0 +1,171 @@
+"""
+per-node latency tracing for the agent graph
+
+python ai_bot/tracing.py
+
+build_agent_app wraps every node with traced(); bot.py opens a trace_turn()
+around each run. A TurnTrace keeps the start/end of every node, so the wall
+time of the turn (its critical path) can be compared with the sum of the node
+times (what a strictly sequential pipeline would take). current_node() names
+the node being run, and span_hooks are called with (node, ms) after each one
+(ai_bot/instrumentation.py uses both).
+"""
+
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('agent_turn_trace', default=None)
+_current_node = contextvars.ContextVar('agent_node', default=None)
+
+span_hooks = []
+
+
+class TurnTrace:
+    """
+    Node spans of one agent run, in ms since the start of the turn
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []  # (node, start_ms, end_ms)
+        self._lock = threading.Lock()
+
+    def _ms(self, t):
+        return (t - self.start) * 1000
+
+    def add(self, node, start, end):
+        with self._lock:
+            self.spans.append((node, self._ms(start), self._ms(end)))
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    @property
+    def wall_ms(self):
+        return self._ms(self.end or time.perf_counter())
+
+    @property
+    def serial_ms(self):
+        return sum(end - start for _, start, end in self.spans)
+
+    def summary(self):
+        return {
+            'wall_ms': round(self.wall_ms, 1),
+            'serial_ms': round(self.serial_ms, 1),
+            'nodes': [(node, round(start, 1), round(end, 1)) for node, start, end in sorted(self.spans, key=lambda s: s[1])],
+        }
+
+
+class NodeTimings:
+    """
+    Aggregated node and turn timings of the process
+    """
+
+    def __init__(self):
+        self.nodes = {}  # node -> {'count', 'total_ms', 'max_ms'}
+        self.turns = {'count': 0, 'wall_ms': 0.0, 'serial_ms': 0.0}
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        with self._lock:
+            for node, start, end in trace.spans:
+                timing = self.nodes.setdefault(node, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+                timing['count'] += 1
+                timing['total_ms'] += end - start
+                timing['max_ms'] = max(timing['max_ms'], end - start)
+            self.turns['count'] += 1
+            self.turns['wall_ms'] += trace.wall_ms
+            self.turns['serial_ms'] += trace.serial_ms
+
+    def reset(self):
+        with self._lock:
+            self.nodes.clear()
+            self.turns = {'count': 0, 'wall_ms': 0.0, 'serial_ms': 0.0}
+
+    def snapshot(self):
+        with self._lock:
+            count = self.turns['count'] or 1
+            return {
+                'turns': self.turns['count'],
+                'mean_wall_ms': self.turns['wall_ms'] / count,
+                'mean_serial_ms': self.turns['serial_ms'] / count,
+                'nodes': {node: {**t, 'mean_ms': t['total_ms'] / t['count']} for node, t in self.nodes.items()},
+            }
+
+
+node_timings = NodeTimings()
+
+
+@contextmanager
+def trace_turn():
+    """
+    Collect the node spans of the agent run(s) inside the block
+    """
+    trace = TurnTrace()
+    _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.set(None)
+        trace.finish()
+        node_timings.record(trace)
+        logger.debug("agent turn %s", trace.summary())
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_node():
+    return _current_node.get()
+
+
+def _end_span(node, trace, start, token):
+    end = time.perf_counter()
+    _current_node.reset(token)
+    if trace is not None:
+        trace.add(node, start, end)
+    for hook in span_hooks:
+        hook(node, (end - start) * 1000)
+
+
+def traced(node, fn):
+    """
+    Wrap a (sync or async) graph node so its span is added to the current trace
+    """
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            trace, start, token = _current_trace.get(), time.perf_counter(), _current_node.set(node)
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _end_span(node, trace, start, token)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace, start, token = _current_trace.get(), time.perf_counter(), _current_node.set(node)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _end_span(node, trace, start, token)
+    return wrapper
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    step = traced("sleep", lambda seconds: time.sleep(seconds))
+    with trace_turn() as trace:
+        with ThreadPoolExecutor() as pool:
+            futures = [pool.submit(contextvars.copy_context().run, step, seconds) for seconds in (0.1, 0.2)]
+            [future.result() for future in futures]
+    print(trace.summary())
@@ -1,3 +1,24 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
 
-# Create your views here.
+from ai_bot.instrumentation import render_metrics
+from ai_bot.warmup import warm_up
+
+
+def metrics_view(request):
+    """
+    Request, node, LLM, Cypher and ORM histograms in Prometheus text format
+    """
+    if not settings.AI_BOT_METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
+
+
+def readiness_view(request):
+    """
+    200 once this worker has warmed up (ai_bot.warmup), 503 until then
+    """
+    if warm_up.as_dict()['status'] in ('pending', 'failed'):
+        # Not started in this process (e.g. runserver), or retry a failed warm-up
+        warm_up.start()
+    return JsonResponse(warm_up.as_dict(), status=200 if warm_up.ready else 503)
@@ -0,0 +1,129 @@
+"""
+worker warm-up and readiness
+
+python manage.py shell -c "from ai_bot.warmup import warm_up; warm_up.run(); print(warm_up.as_dict())"
+
+The first chat turn after a deploy would otherwise pay for importing the AI
+stack, building the OpenAI clients, connecting to Neo4j, building the Cypher
+QA chain and compiling the LangGraph apps. patient_chat_app/wsgi.py and
+asgi.py call warm_up.start() when a worker loads the application: it does
+all of that in a background thread, and /healthz/ready answers 503 until it
+has finished (and 200 after), so a load balancer only routes to warm workers.
+
+With settings.AI_BOT_WARMUP_DRY_RUN, start() first runs a couple of turns
+through the agent pipeline against the fakes (ai_bot.backends.use_fakes), before the
+worker serves anything, so the code paths of a turn (and their imports)
+are warm too; the chat models, graph and caches are put back afterwards.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import date
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DRY_RUN_MESSAGES = ["I'm taking ibuprofen for my fever.", "Is it fine to go for a walk?"]
+DRY_RUN_SESSION = "warm-up"
+
+
+class WarmUp:
+    """
+    Warm-up state of this process: 'pending', 'warming', 'ready', 'failed',
+    or 'skipped' when settings.AI_BOT_WARMUP is off
+    """
+
+    def __init__(self):
+        self.status = 'pending'
+        self.steps = {}  # step -> ms
+        self.error = None
+        self.pid = None  # a forked worker warms up again
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Warm this process up in a background thread, unless it is done or under way
+        """
+        with self._lock:
+            if self.pid == os.getpid() and self.status in ('warming', 'ready', 'skipped'):
+                return
+            self.pid, self.steps, self.error = os.getpid(), {}, None
+            if not settings.AI_BOT_WARMUP:
+                self.status = 'skipped'
+                return
+            self.status = 'warming'
+        if settings.AI_BOT_WARMUP_DRY_RUN:
+            self._step('dry_run', self.dry_run)
+        threading.Thread(target=self.run, name='ai-bot-warm-up', daemon=True).start()
+
+    def run(self):
+        """
+        Build everything a chat turn needs, in this thread
+        """
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.agent import AGENT_APPS, get_agent_app
+        from ai_bot.history import count_tokens
+        from ai_bot.knowledge_graph import get_knowledge_graph
+        from ai_bot.session_store import get_session_store
+
+        self.pid, self.status = os.getpid(), 'warming'
+        try:
+            self._step('chat_models', lambda: (entity_extraction.get_chains(), langchain_integration.get_chains()))
+            self._step('caches', lambda: (entity_extraction.get_extraction_cache(), langchain_integration.get_response_cache()))
+            self._step('session_store', get_session_store)
+            self._step('token_counter', lambda: count_tokens("warm up"))
+            self._step('knowledge_graph', lambda: get_knowledge_graph().warm_up())
+            self._step('agent_apps', lambda: [get_agent_app(name) for name in AGENT_APPS])
+        except Exception as error:
+            logger.exception("Warm-up failed; /healthz/ready retries it")
+            self.status, self.error = 'failed', f"{error.__class__.__name__}: {error}"
+        else:
+            self.status = 'ready'
+            logger.info("Warmed up in %.0f ms: %s", sum(self.steps.values()), self.steps)
+
+    def dry_run(self):
+        """
+        Run DRY_RUN_MESSAGES through the agent with use_fakes(), then go back
+        to the configured chat models, graph and caches
+        """
+        from ai_bot import entity_extraction, langchain_integration
+        from ai_bot.agent import graph_writes
+        from ai_bot.backends import use_fakes
+        from ai_bot.bot import generate_bot_response
+        from ai_bot.extraction_cache import build_extraction_cache
+        from ai_bot.knowledge_graph import set_knowledge_graph
+        from ai_bot.response_cache import build_response_cache
+        from ai_bot.session_store import clear_session
+        from patients.models import Patient
+
+        patient = Patient(first_name="Warm", last_name="Up", date_of_birth=date(1980, 1, 1), doctor_name="Dr. Smith")
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        try:
+            for message in DRY_RUN_MESSAGES:
+                generate_bot_response(message, patient, session_id=DRY_RUN_SESSION)
+            graph_writes.flush()
+        finally:
+            clear_session(DRY_RUN_SESSION)
+            entity_extraction.set_chat_model(None)
+            langchain_integration.set_chat_model(None)
+            set_knowledge_graph(None)
+            entity_extraction.set_extraction_cache(build_extraction_cache())
+            langchain_integration.set_response_cache(build_response_cache())
+
+    def _step(self, name, build):
+        start = time.perf_counter()
+        build()
+        self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    @property
+    def ready(self):
+        return self.pid == os.getpid() and self.status in ('ready', 'skipped')
+
+    def as_dict(self):
+        return {'status': self.status if self.pid == os.getpid() else 'pending', 'steps': dict(self.steps), 'error': self.error}
+
+
+warm_up = WarmUp()
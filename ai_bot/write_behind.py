@@ -0,0 +1,157 @@
+"""
+write-behind queue for knowledge graph writes
+
+python ai_bot/write_behind.py
+
+The agent hands each turn's graph writes to WriteBehind instead of waiting
+for them, and only waits (wait/await_key) right before it reads data the
+writes produce. Writes for the same key (the patient name) are applied in
+submission order; a failed write is logged, and raised to the next reader
+of its key.
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Background writer: submit() runs a function on a small thread pool,
+    asubmit() runs a coroutine as a task on the current event loop. The
+    error of a failed write is kept for the key until a reader (wait or
+    await_key) takes it, even when the write ended before the reader came.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.submitted = 0
+        self.failed = 0
+        self._executor = None
+        self._pending = {}  # key -> last Future
+        self._tasks = {}  # key -> last asyncio.Task
+        self._errors = {}  # key -> error of its last failed write, until a reader takes it
+        self._lock = threading.Lock()
+
+    def _done(self, pending, key, job):
+        with self._lock:
+            if pending.get(key) is job:
+                del pending[key]
+        if not job.cancelled() and job.exception() is not None:
+            self.failed += 1
+            logger.error("Background graph write for %s failed", key, exc_info=job.exception())
+
+    def _failed(self, key, error):
+        # Recorded by the job itself, so it is there as soon as the job is done
+        with self._lock:
+            self._errors[key] = error
+
+    def _raise_error(self, key):
+        with self._lock:
+            error = self._errors.pop(key, None)
+        if error is not None:
+            raise error
+
+    def _run(self, key, previous, fn, args, kwargs):
+        if previous is not None:
+            wait_futures([previous])  # keep the order; its error is reported on its own
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            self._failed(key, e)
+            raise
+
+    def submit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='graph-write')
+            # Run in a copy of the caller's context, like an asyncio task (keeps request metrics)
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._run, key, self._pending.get(key), fn, args, kwargs)
+            self._pending[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda f: self._done(self._pending, key, f))
+        return future
+
+    def wait(self, key):
+        """
+        Block until every write submitted for `key` is applied, including the
+        tasks asubmit() queued on an event loop other than this thread's, and
+        raise the error of a write that failed since the last reader
+        """
+        future = self._pending.get(key)
+        if future is not None:
+            wait_futures([future])
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            loop = task.get_loop()
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                raise RuntimeError(f"wait({key!r}) would block the event loop running its writes; use await_key()")
+            asyncio.run_coroutine_threadsafe(asyncio.wait([task]), loop).result()
+        self._raise_error(key)
+
+    async def _arun(self, key, previous, fn, args, kwargs):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            self._failed(key, e)
+            raise
+
+    def asubmit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            task = asyncio.ensure_future(self._arun(key, self._tasks.get(key), fn, args, kwargs))
+            self._tasks[key] = task
+            self.submitted += 1
+        task.add_done_callback(lambda t: self._done(self._tasks, key, t))
+        return task
+
+    async def await_key(self, key):
+        # Threaded writes first, in case the key was written from sync code too
+        future = self._pending.get(key)
+        if future is not None:
+            await asyncio.wait([asyncio.wrap_future(future)])
+        task = self._tasks.get(key)
+        if task is not None:
+            await asyncio.wait([task])
+        self._raise_error(key)
+
+    def flush(self):
+        """
+        Wait for all threaded writes (e.g. before shutting down or in benchmarks)
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        wait_futures(futures)
+
+    async def aflush(self):
+        with self._lock:
+            tasks = list(self._tasks.values())
+        if tasks:
+            await asyncio.wait(tasks)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending) + len(self._tasks)
+        return {'submitted': self.submitted, 'failed': self.failed, 'pending_keys': pending}
+
+
+if __name__ == "__main__":
+    import time
+
+    writes = WriteBehind()
+    applied = []
+    for i in range(3):
+        writes.submit("patient", lambda i=i: (time.sleep(0.05 * (3 - i)), applied.append(i)))
+    writes.wait("patient")
+    print(applied, writes.stats())
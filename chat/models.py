@@ -1,11 +1,16 @@
 """
 Store messages in the database for persistence.
 Patient field is a foreign key. It allows each Conversation to be associated with one Patient.
+Messages are read a page at a time with keyset pagination on (timestamp, id),
+so opening a long conversation costs the same as opening a short one.
 """
 
-from django.db import models
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
 from patients.models import Patient
-from ai_bot.knowledge_graph import KnowledgeGraph
 
 class Conversation(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
@@ -13,25 +18,124 @@ class Conversation(models.Model):
 
     def __str__(self):
         return f"Conversation with {self.patient} on {self.started_at}"
+
+    @property
+    def session_id(self):
+        # Key of the agent state and chat history of this conversation (ai_bot.session_store)
+        return f"conversation-{self.pk}"
     
+    def save_turn(self, user_message, bot_reply, appointment_request=None):
+        """
+        Save the patient's message, the bot's reply and the turn's appointment
+        request (if any) together: one transaction, one INSERT for both messages.
+        Returns the bot's Message.
+        """
+        with transaction.atomic():
+            _, bot_message = Message.objects.bulk_create([
+                Message(conversation=self, sender='patient', content=user_message),
+                Message(conversation=self, sender='bot', content=bot_reply),
+            ])
+            if appointment_request is not None:
+                appointment_request.save()
+        return bot_message
+
+    def save_unanswered(self, user_message):
+        """
+        Save the patient's message of a turn the agent failed to answer, so
+        the conversation still shows what the patient sent
+        """
+        return Message.objects.create(conversation=self, sender='patient', content=user_message)
+
     def add_welcome_message(self):
         welcome_message = f"Hi {self.patient.first_name}, what can I help you with today?"
         Message.objects.create(conversation=self, sender='bot', content=welcome_message)
 
     def restart(self):
+        # The AI stack is imported here, not with the models (migrate, the admin)
+        from ai_bot.agent import graph_writes
+        from ai_bot.knowledge_graph import get_knowledge_graph
+        from ai_bot.session_store import clear_session
+
         # delete all messages
         self.messages.all().delete()
-        # clear the knowledge graph
-        kg = KnowledgeGraph()
-        kg.clear_graph()
+        # forget what the knowledge graph holds about this patient, once their
+        # pending background writes (threaded or async) are in
+        graph_name = self.patient.get_graph_name()
+        try:
+            graph_writes.wait(graph_name)
+        except Exception:
+            pass  # logged when it failed; the reset removes whatever it wrote
+        get_knowledge_graph().reset_patient(graph_name, batch_size=settings.AI_BOT_GRAPH_RESET_BATCH_SIZE)
+        # forget the agent state and chat history of the session
+        clear_session(self.session_id)
         # add welcome message again
         self.add_welcome_message()
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class MessagePage(list):
+    """
+    Messages in chronological order, with whether there are more beyond the page
+    """
+
+    def __init__(self, messages, has_older=False, has_newer=False):
+        super().__init__(messages)
+        self.has_older = has_older
+        self.has_newer = has_newer
+
+
+class MessageQuerySet(models.QuerySet):
+    def page(self, before=None, after=None, limit=50):
+        """
+        The latest `limit` messages, or the `limit` messages just before or
+        just after a cursor (Message.cursor). Walks the (conversation,
+        timestamp, id) index from the cursor instead of counting an OFFSET.
+        """
+        if before is not None:
+            timestamp, pk = Message.parse_cursor(before)
+            messages = self.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk), timestamp__lte=timestamp)
+        elif after is not None:
+            timestamp, pk = Message.parse_cursor(after)
+            messages = self.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk), timestamp__gte=timestamp)
+            # The page right after the cursor, oldest first
+            rows = list(messages.order_by('timestamp', 'id')[:limit + 1])
+            return MessagePage(rows[:limit], has_older=True, has_newer=len(rows) > limit)
+        else:
+            messages = self
+        rows = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+        return MessagePage(reversed(rows[:limit]), has_older=len(rows) > limit, has_newer=before is not None)
+
+
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.CharField(max_length=10)  # 'patient' or 'bot'
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a conversation's history (MessageQuerySet.page)
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_message_history_idx'),
+        ]
+
     def __str__(self):
         return f"{self.sender} at {self.timestamp}: {self.content}"
+
+    @property
+    def cursor(self):
+        # "<microseconds since the epoch>-<id>": opaque to clients and safe in a URL
+        return f"{(self.timestamp - EPOCH) // timedelta(microseconds=1)}-{self.pk}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """
+        (timestamp, id) of a cursor; ValueError when it is malformed
+        """
+        microseconds, _, pk = cursor.partition('-')
+        try:
+            return EPOCH + timedelta(microseconds=int(microseconds)), int(pk)
+        except OverflowError:
+            raise ValueError(f"Cursor out of range: {cursor}")
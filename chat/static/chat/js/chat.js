@@ -27,16 +27,116 @@ function updateAppointmentRequests(newRequest) {
     appointmentRequestsContainer.appendChild(newRequestElement);
 }
 
+function postMessage(url, messageContent) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
+        },
+        body: `message=${encodeURIComponent(messageContent)}`
+    });
+}
+
+// Read server-sent events from a fetch response and call onEvent(name, data) for each
+function readEvents(response, onEvent) {
+    var reader = response.body.getReader();
+    var decoder = new TextDecoder();
+    var buffer = '';
+
+    function read() {
+        return reader.read().then(function(result) {
+            if (result.done) return;
+            buffer += decoder.decode(result.value, { stream: true });
+            var events = buffer.split('\n\n');
+            buffer = events.pop();
+            events.forEach(function(raw) {
+                var name = 'message', data = '';
+                raw.split('\n').forEach(function(line) {
+                    if (line.startsWith('event: ')) name = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                onEvent(name, JSON.parse(data));
+            });
+            return read();
+        });
+    }
+    return read();
+}
+
+function streamBotMessage(url, messageContent, chatMessages) {
+    var botMessage = createMessageElement('bot', '', '');
+    var header = botMessage.querySelector('span');
+    var content = botMessage.querySelector('p');
+    chatMessages.appendChild(botMessage);
+
+    return postMessage(url, messageContent).then(response => readEvents(response, function(name, data) {
+        if (name === 'token') {
+            content.textContent += data.content;
+            scrollToLatestMessage();
+        } else if (name === 'done') {
+            header.textContent = `${data.bot_message.timestamp} - bot:`;
+
+            // Update appointment requests if a new request was made
+            if (data.new_appointment_request) {
+                updateAppointmentRequests(data.new_appointment_request);
+            }
+        } else if (name === 'error') {
+            header.textContent = 'bot:';
+            content.textContent = data.message;
+        }
+    }));
+}
+
+// Prepend the page of history before chatMessages.dataset.olderCursor, keeping the scroll position
+function loadOlderMessages(chatMessages) {
+    var cursor = chatMessages.dataset.olderCursor;
+    if (!cursor || chatMessages.dataset.loading) return Promise.resolve();
+    chatMessages.dataset.loading = 'true';
+
+    return fetch(`${chatMessages.dataset.historyUrl}?before=${encodeURIComponent(cursor)}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.status !== 'success') return;
+        var older = document.createDocumentFragment();
+        data.messages.forEach(function(message) {
+            older.appendChild(createMessageElement(message.sender, message.content, message.timestamp));
+        });
+        var fromBottom = chatMessages.scrollHeight - chatMessages.scrollTop;
+        chatMessages.insertBefore(older, chatMessages.firstChild);
+        chatMessages.scrollTop = chatMessages.scrollHeight - fromBottom;
+        chatMessages.dataset.olderCursor = data.has_older && data.messages.length ? data.messages[0].cursor : '';
+    })
+    .finally(() => delete chatMessages.dataset.loading)
+    .then(() => {
+        // Keep going until the history fills the window or runs out
+        if (chatMessages.scrollHeight <= chatMessages.clientHeight) return loadOlderMessages(chatMessages);
+    });
+}
+
 function onDOMLoaded() {
     scrollToLatestMessage();
 
     var chatMessages = document.getElementById('chat-messages');
     var observer = new MutationObserver(function(mutations) {
-        scrollToLatestMessage();
+        // New and streamed messages scroll down; older history prepended on scroll does not
+        if (mutations.some(mutation => mutation.target !== chatMessages || mutation.nextSibling === null)) {
+            scrollToLatestMessage();
+        }
     });
 
     observer.observe(chatMessages, { childList: true, subtree: true });
 
+    // Load older history when the patient scrolls to the top
+    if (chatMessages.scrollHeight <= chatMessages.clientHeight) {
+        loadOlderMessages(chatMessages).catch(error => console.error('Error:', error));
+    }
+    chatMessages.addEventListener('scroll', function() {
+        if (chatMessages.scrollTop < 50) {
+            loadOlderMessages(chatMessages).catch(error => console.error('Error:', error));
+        }
+    });
+
     var form = document.querySelector('.message-form');
     if (form) {
         form.addEventListener('submit', function(event) {
@@ -52,15 +152,16 @@ function onDOMLoaded() {
             var userMessage = createMessageElement('patient', messageContent, new Date().toLocaleString());
             chatMessages.appendChild(userMessage);
 
+            // Stream the reply when the server supports it
+            var streamUrl = form.dataset.streamUrl;
+            if (streamUrl && window.TextDecoder && window.ReadableStream) {
+                streamBotMessage(streamUrl, messageContent, chatMessages)
+                    .catch(error => console.error('Error:', error));
+                return;
+            }
+
             // Send message to server
-            fetch('', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                    'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
-                },
-                body: `message=${encodeURIComponent(messageContent)}`
-            })
+            postMessage(form.getAttribute('action') || '', messageContent)
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
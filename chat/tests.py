@@ -1,3 +1,246 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from ai_bot.management.commands.bench_conversations import make_patient
+from ai_bot.models import AppointmentRequest
+
+
+class ChatViewTests(TestCase):
+    """
+    chat_view end to end, with the fakes in place of OpenAI and Neo4j
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+        self.patient = make_patient()
+        self.client.force_login(self.patient.user)
+        self.client.get(reverse('chat'))
+
+    def post(self, message):
+        response = self.client.post(reverse('chat'), {'message': message})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_turn_saves_both_messages(self):
+        self.post("I twisted my ankle, what should I do?")
+        senders = list(self.patient.conversation_set.get().messages.values_list('sender', flat=True))
+        self.assertEqual(senders, ['bot', 'patient', 'bot'])
+
+    def test_appointment_change_is_recorded(self):
+        payload = self.post("I want to change the appointment to next Monday").json()
+        self.assertTrue(payload['bot_message']['content'].startswith("I will convey your request to Dr."))
+        self.assertEqual(payload['new_appointment_request']['requested_time'].lower(), "next monday")
+        self.assertEqual(AppointmentRequest.objects.filter(patient=self.patient).count(), 1)
+
+    def test_turn_query_budget(self):
+        # session, user, patient, conversation, then the turn: SAVEPOINT, one INSERT for both messages, RELEASE
+        with self.assertNumQueries(7):
+            self.post("I twisted my ankle, what should I do?")
+
+    def test_appointment_turn_query_budget(self):
+        # ... and the appointment request's INSERT, in the same transaction; no lookup afterwards
+        with self.assertNumQueries(8):
+            self.post("I want to change the appointment to next Monday")
+
+    def test_streamed_turn_saves_both_messages(self):
+        response = self.client.post(reverse('chat_stream'), {'message': "I want to change the appointment to next Monday"})
+        done = b"".join(response.streaming_content).decode().split("event: done\ndata: ")[1]
+        self.assertEqual(json.loads(done)['new_appointment_request']['requested_time'].lower(), "next monday")
+        senders = list(self.patient.conversation_set.get().messages.values_list('sender', flat=True))
+        self.assertEqual(senders, ['bot', 'patient', 'bot'])
+
+    def test_failed_turn_keeps_the_patient_message(self):
+        from unittest import mock
+
+        with mock.patch('ai_bot.bot.run_turn', side_effect=RuntimeError("OpenAI is down")):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('chat'), {'message': "Is it fine to go for a walk?"})
+        messages = self.patient.conversation_set.get().messages.values_list('sender', 'content')
+        self.assertEqual(list(messages)[1:], [('patient', "Is it fine to go for a walk?")])
+
+    def test_failed_stream_ends_with_an_error_event(self):
+        from unittest import mock
+
+        def failing_stream(*args, **kwargs):
+            yield "Rest "
+            raise RuntimeError("Neo4j is down")
+
+        with mock.patch('ai_bot.bot.stream_bot_response', failing_stream), self.assertLogs('chat.views', 'ERROR'):
+            response = self.client.post(reverse('chat_stream'), {'message': "Is it fine to go for a walk?"})
+            events = b"".join(response.streaming_content).decode()
+        self.assertIn("event: token", events)
+        self.assertIn("event: error", events)
+        self.assertNotIn("event: done", events)
+        senders = list(self.patient.conversation_set.get().messages.values_list('sender', flat=True))
+        self.assertEqual(senders, ['bot', 'patient'])
+
+    def test_restart_waits_for_pending_async_writes(self):
+        import asyncio
+        import threading
+        from ai_bot.agent import graph_writes
+        from ai_bot.entity_extraction import astore_entities_as_documents
+        from ai_bot.knowledge_graph import get_knowledge_graph
+        from ai_bot.management.commands.bench_graph_writes import ENTITY_FIELDS
+
+        name = self.patient.get_graph_name()
+
+        async def slow_write():
+            # A turn's write queued by the ASGI view, still running when the patient restarts
+            await asyncio.sleep(0.1)
+            await get_knowledge_graph().arun_query('merge_patient', name=name, store_medication=True, store_appointment=False)
+            await astore_entities_as_documents({**dict.fromkeys(ENTITY_FIELDS), 'medications': "ibuprofen"}, name)
+
+        async def submit():
+            graph_writes.asubmit(name, slow_write)
+
+        failed = graph_writes.stats()['failed']
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(submit(), loop).result()
+            self.assertEqual(self.client.post(reverse('restart_conversation')).status_code, 200)
+            asyncio.run_coroutine_threadsafe(graph_writes.aflush(), loop).result()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.assertEqual(graph_writes.stats()['failed'], failed)
+        self.assertIsNone(get_knowledge_graph().get_patient_profile(name))
+
+    def test_metrics_header(self):
+        response = self.post("I'm taking ibuprofen for my fever.")
+        self.assertIn("cypher_round_trips=", response['X-AI-Bot-Metrics'])
+
+
+class AsyncChatViewTests(TestCase):
+    """
+    chat_async_view (the ASGI endpoint) end to end, like ChatViewTests
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+        self.patient = make_patient()
+        self.async_client.force_login(self.patient.user)
+
+    async def post(self, message):
+        from ai_bot.agent import graph_writes
+
+        response = await self.async_client.post(reverse('chat_async'), {'message': message})
+        self.assertEqual(response.status_code, 200)
+        await graph_writes.aflush()  # the turn's background writes, before the test's loop ends
+        return response
+
+    async def test_turn_saves_both_messages(self):
+        await self.post("I twisted my ankle, what should I do?")
+        conversation = await self.patient.conversation_set.aget()
+        senders = [sender async for sender in conversation.messages.values_list('sender', flat=True)]
+        self.assertEqual(senders, ['bot', 'patient', 'bot'])
+
+    async def test_appointment_change_is_recorded(self):
+        payload = (await self.post("I want to change the appointment to next Monday")).json()
+        self.assertTrue(payload['bot_message']['content'].startswith("I will convey your request to Dr."))
+        self.assertEqual(payload['new_appointment_request']['requested_time'].lower(), "next monday")
+        self.assertEqual(await AppointmentRequest.objects.filter(patient=self.patient).acount(), 1)
+
+
+class PatientResolutionTests(TestCase):
+    """
+    Every signed-in user chats in their own patient's conversation and session
+    """
+
+    def setUp(self):
+        from ai_bot.backends import use_fakes
+        from ai_bot.session_store import MemorySessionStore, set_session_store
+
+        use_fakes(llm_latency_ms=0, ms_per_token=0, graph_latency_ms=0)
+        set_session_store(MemorySessionStore())
+        self.first, self.second = make_patient(), make_patient()
+
+    def post_as(self, patient, message):
+        self.client.force_login(patient.user)
+        return self.client.post(reverse('chat'), {'message': message}).json()
+
+    def test_follow_up_state_is_per_patient(self):
+        from ai_bot.prompts import QUESTIONS
+
+        self.assertEqual(self.post_as(self.first, "I'm taking ibuprofen for my fever.")['bot_message']['content'],
+                         QUESTIONS["dosages"]["question"])
+        # The second patient has no pending follow-up question
+        self.post_as(self.second, "I twisted my ankle, what should I do?")
+        self.assertEqual(self.first.conversation_set.get().messages.filter(sender='patient').count(), 1)
+        self.assertEqual(self.second.conversation_set.get().messages.filter(sender='patient').count(), 1)
+        self.assertEqual(self.post_as(self.first, "ibuprofen, 200mg")['bot_message']['content'],
+                         QUESTIONS["frequencies"]["question"])
+
+    def test_anonymous_users_are_refused(self):
+        self.assertEqual(self.client.post(reverse('chat'), {'message': "Hi"}).status_code, 403)
+        self.assertEqual(self.client.get(reverse('chat_messages')).status_code, 403)
+
+    @override_settings(CHAT_ANONYMOUS_PATIENT=True)
+    def test_demo_chats_as_the_first_patient(self):
+        self.client.post(reverse('chat'), {'message': "I twisted my ankle, what should I do?"})
+        self.assertEqual(self.first.conversation_set.get().messages.filter(sender='patient').count(), 1)
+
+    def test_user_without_patient(self):
+        self.client.force_login(get_user_model().objects.create_user("visitor"))
+        self.assertEqual(self.client.post(reverse('chat'), {'message': "Hi"}).status_code, 404)
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=10)
+class MessageHistoryTests(TestCase):
+    """
+    Keyset pagination of the chat history, on (timestamp, id)
+    """
+
+    def setUp(self):
+        from django.utils import timezone
+        from chat.models import Conversation, Message
+
+        self.patient = make_patient()
+        self.conversation = Conversation.objects.create(patient=self.patient)
+        Message.objects.bulk_create(Message(conversation=self.conversation, sender='patient', content=f"Message {i}")
+                                    for i in range(25))
+        # Messages saved in the same instant are still ordered, by id
+        Message.objects.filter(content__in=["Message 9", "Message 10", "Message 11"]).update(timestamp=timezone.now())
+        self.contents = list(self.conversation.messages.order_by('timestamp', 'id').values_list('content', flat=True))
+        self.client.force_login(self.patient.user)
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('chat_messages'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_chat_page_renders_the_latest_page(self):
+        response = self.client.get(reverse('chat'))
+        self.assertEqual([message.content for message in response.context['messages']], self.contents[-10:])
+        self.assertEqual(response.context['older_cursor'], response.context['messages'][0].cursor)
+
+    def test_walking_back_returns_every_message_once(self):
+        page = self.get_page()
+        contents = [message['content'] for message in page['messages']]
+        while page['has_older']:
+            page = self.get_page(before=page['messages'][0]['cursor'])
+            contents = [message['content'] for message in page['messages']] + contents
+        self.assertEqual(contents, self.contents)
+
+    def test_newer_than_a_cursor(self):
+        cursor = self.get_page()['messages'][0]['cursor']
+        with self.assertNumQueries(5):  # session, user, patient, conversation and one page: no COUNT, no OFFSET
+            page = self.get_page(after=cursor, limit=5)
+        self.assertEqual([message['content'] for message in page['messages']], self.contents[-9:-4])
+        self.assertTrue(page['has_newer'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('chat_messages'), {'before': "yesterday"}).status_code, 400)
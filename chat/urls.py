@@ -3,5 +3,8 @@ from . import views
 
 urlpatterns = [
     path('', views.chat_view, name='chat'),
+    path('messages/', views.chat_messages_view, name='chat_messages'),
+    path('async/', views.chat_async_view, name='chat_async'),
+    path('stream/', views.chat_stream_view, name='chat_stream'),
     path('restart/', views.restart_conversation, name='restart_conversation'),
 ]
@@ -1,59 +1,228 @@
+import json
+import logging
+
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.urls import reverse
+from asgiref.sync import sync_to_async
 from patients.models import Patient 
-from .models import Conversation, Message
-from ai_bot.bot import generate_bot_response
+from .models import Conversation
 from ai_bot.models import AppointmentRequest
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
+
+logger = logging.getLogger(__name__)
+
+STREAM_ERROR = {'status': 'error', 'message': "Sorry, something went wrong while generating the reply. Please try again."}
+
+def _appointment_request_json(appointment_request):
+    # The appointment request made by this turn, if any
+    if appointment_request is None:
+        return None
+    return {
+        'current_time': appointment_request.current_time.strftime("%Y-%m-%d %H:%M"),
+        'requested_time': appointment_request.requested_time
+    }
+
+def _bot_message_payload(bot_message, appointment_request):
+    return {
+        'status': 'success',
+        'bot_message': {
+            'content': bot_message.content,
+            'timestamp': bot_message.timestamp.strftime("%Y-%m-%d %H:%M")
+        },
+        'new_appointment_request': _appointment_request_json(appointment_request)
+    }
+
+def _bot_message_json(bot_message, appointment_request):
+    # Return JSON response with bot message and new appointment request
+    return JsonResponse(_bot_message_payload(bot_message, appointment_request))
+
+def _message_json(message):
+    return {
+        'sender': message.sender,
+        'content': message.content,
+        'timestamp': message.timestamp.strftime("%Y-%m-%d %H:%M"),
+        'cursor': message.cursor,
+    }
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _resolve_patient(user, patients):
+    # The signed-in user's patient; anonymous users get the first patient
+    # only in the single-patient demo (settings.CHAT_ANONYMOUS_PATIENT)
+    if user.is_authenticated:
+        return patients.filter(user=user)
+    if settings.CHAT_ANONYMOUS_PATIENT:
+        return patients.order_by('pk')
+    raise PermissionDenied
+
+def _patient(request):
+    patient = _resolve_patient(request.user, Patient.objects.all()).first()
+    if patient is None:
+        raise Http404("No patient for this user")
+    return patient
+
+async def _apatient(request):
+    patient = await _resolve_patient(await request.auser(), Patient.objects.all()).afirst()
+    if patient is None:
+        raise Http404("No patient for this user")
+    return patient
 
 def chat_view(request):
-    patient = Patient.objects.first()  # Retrieve the first (and only) patient
+    patient = _patient(request)
     conversation, created = Conversation.objects.get_or_create(patient=patient)
     
     if created:
         # If this is a new conversation, add the welcome message
         conversation.add_welcome_message()
     
-    messages = conversation.messages.all()
-    appointment_requests = AppointmentRequest.objects.filter(patient=patient)
-
     if request.method == 'POST':
+        # ai_bot.bot (LangChain, LangGraph, the Neo4j driver) is imported by the
+        # first chat turn, not with the URLconf (manage.py check, migrate, the admin)
+        from ai_bot.bot import run_turn
+
         user_message = request.POST.get('message')
-        Message.objects.create(conversation=conversation, sender='patient', content=user_message)
-        # Generate bot response using AI bot
-        bot_response = generate_bot_response(user_message, patient)
-        bot_message = Message.objects.create(conversation=conversation, sender='bot', content=bot_response)
-        
-        # Check if a new appointment request was made
-        new_appointment_request = None
-        latest_request = AppointmentRequest.objects.filter(patient=patient).last()
-        if latest_request and bot_response.startswith("I will convey your request to Dr."):
-            new_appointment_request = {
-                'current_time': latest_request.current_time.strftime("%Y-%m-%d %H:%M"),
-                'requested_time': latest_request.requested_time
-            }
-        
-        # Return JSON response with bot message and new appointment request
-        return JsonResponse({
-            'status': 'success',
-            'bot_message': {
-                'content': bot_message.content,
-                'timestamp': bot_message.timestamp.strftime("%Y-%m-%d %H:%M")
-            },
-            'new_appointment_request': new_appointment_request
-        })
+        # Generate bot response using AI bot, then save the whole turn at once
+        try:
+            turn = run_turn(user_message, patient, session_id=conversation.session_id)
+        except Exception:
+            conversation.save_unanswered(user_message)
+            raise
+        bot_message = conversation.save_turn(user_message, turn.reply, turn.appointment_request)
+        return _bot_message_json(bot_message, turn.appointment_request)
     
+    # Only the latest page; the page fetches older history from chat_messages on scroll
+    messages = conversation.messages.page(limit=settings.CHAT_HISTORY_PAGE_SIZE)
     context = {
         'messages': messages,
+        'older_cursor': messages[0].cursor if messages and messages.has_older else '',
         'patient': patient,
-        'appointment_requests': appointment_requests,
+        'appointment_requests': AppointmentRequest.objects.filter(patient=patient),
+        # Under ASGI the page posts to the async endpoint instead
+        'post_url': reverse('chat_async') if settings.CHAT_ASYNC_VIEW else '',
+        'stream_url': reverse('chat_stream') if settings.CHAT_STREAMING else '',
     }
     return render(request, 'chat/chat.html', context)
 
+@require_GET
+def chat_messages_view(request):
+    """
+    A page of the conversation's history, oldest first: the messages just
+    before the `before` cursor, just after the `after` cursor, or the latest.
+    Each message carries its cursor; `has_older`/`has_newer` tell whether to
+    ask for more.
+    """
+    patient = _patient(request)
+    conversation = Conversation.objects.filter(patient=patient).first()
+    if conversation is None:
+        return JsonResponse({'status': 'success', 'messages': [], 'has_older': False, 'has_newer': False})
+
+    try:
+        limit = min(int(request.GET.get('limit', settings.CHAT_HISTORY_PAGE_SIZE)), settings.CHAT_HISTORY_PAGE_SIZE)
+        messages = conversation.messages.page(before=request.GET.get('before'), after=request.GET.get('after'),
+                                              limit=max(limit, 1))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Invalid cursor or limit'}, status=400)
+    return JsonResponse({
+        'status': 'success',
+        'messages': [_message_json(message) for message in messages],
+        'has_older': messages.has_older,
+        'has_newer': messages.has_newer,
+    })
+
+@require_POST
+async def chat_async_view(request):
+    """
+    Async variant of the chat POST: the agent runs on the event loop, so under
+    ASGI a worker is not blocked while waiting on OpenAI and Neo4j.
+    """
+    from ai_bot.bot import arun_turn
+
+    patient = await _apatient(request)
+    conversation, created = await Conversation.objects.aget_or_create(patient=patient)
+
+    if created:
+        await sync_to_async(conversation.add_welcome_message)()
+
+    user_message = request.POST.get('message')
+    # Generate bot response using AI bot, then save the whole turn at once
+    try:
+        turn = await arun_turn(user_message, patient, session_id=conversation.session_id)
+    except Exception:
+        await sync_to_async(conversation.save_unanswered)(user_message)
+        raise
+    bot_message = await sync_to_async(conversation.save_turn)(user_message, turn.reply, turn.appointment_request)
+    return _bot_message_json(bot_message, turn.appointment_request)
+
+def _stream_events(conversation, patient, user_message):
+    from ai_bot.bot import BotTurn, stream_bot_response
+
+    turn = None
+    try:
+        for item in stream_bot_response(user_message, patient, session_id=conversation.session_id):
+            if isinstance(item, BotTurn):
+                turn = item
+            else:
+                yield _sse('token', {'content': item})
+    except Exception:
+        # The response has started: report the failure as an event instead of a 500
+        logger.exception("Streamed chat turn failed")
+    if turn is None:
+        conversation.save_unanswered(user_message)
+        yield _sse('error', STREAM_ERROR)
+        return
+
+    # Persist the turn once the stream has completed
+    bot_message = conversation.save_turn(user_message, turn.reply, turn.appointment_request)
+    yield _sse('done', _bot_message_payload(bot_message, turn.appointment_request))
+
+async def _astream_events(conversation, patient, user_message):
+    from ai_bot.bot import BotTurn, astream_bot_response
+
+    turn = None
+    try:
+        async for item in astream_bot_response(user_message, patient, session_id=conversation.session_id):
+            if isinstance(item, BotTurn):
+                turn = item
+            else:
+                yield _sse('token', {'content': item})
+    except Exception:
+        logger.exception("Streamed chat turn failed")
+    if turn is None:
+        await sync_to_async(conversation.save_unanswered)(user_message)
+        yield _sse('error', STREAM_ERROR)
+        return
+
+    bot_message = await sync_to_async(conversation.save_turn)(user_message, turn.reply, turn.appointment_request)
+    yield _sse('done', _bot_message_payload(bot_message, turn.appointment_request))
+
+@require_POST
+def chat_stream_view(request):
+    """
+    Stream the bot reply as server-sent events: one 'token' event per chunk,
+    then a 'done' event with the persisted message (same payload as chat_view),
+    or an 'error' event if the reply could not be generated.
+    """
+    patient = _patient(request)
+    conversation, created = Conversation.objects.get_or_create(patient=patient)
+
+    if created:
+        conversation.add_welcome_message()
+
+    user_message = request.POST.get('message')
+    events = _astream_events if settings.CHAT_ASYNC_VIEW else _stream_events
+    response = StreamingHttpResponse(events(conversation, patient, user_message), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # don't let a proxy buffer the stream
+    return response
+
 @require_POST
 def restart_conversation(request):
     print("Restart conversation view called")
-    patient = Patient.objects.first()  # Retrieve the first (and only) patient
+    patient = _patient(request)
     
     # restart the conversation and appointment request
     conversation = Conversation.objects.get(patient=patient)
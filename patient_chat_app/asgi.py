@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_chat_app.settings')
 
 application = get_asgi_application()
+
+# Build the AI stack before the first chat turn; /healthz/ready reports when it is done
+from ai_bot.warmup import warm_up  # noqa: E402
+
+warm_up.start()
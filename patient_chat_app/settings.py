@@ -39,6 +39,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ai_bot.instrumentation.InstrumentationMiddleware',  # first, so it times the whole request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +68,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'patient_chat_app.wsgi.application'
+ASGI_APPLICATION = 'patient_chat_app.asgi.application'
 
 
 # Database
@@ -126,3 +128,133 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# AI bot
+
+# How generate_response_step reads the patient profile from Neo4j:
+# 'aggregated' (one round trip, per-relationship subqueries) or 'cartesian'
+AI_BOT_PROFILE_FETCH_MODE = os.getenv('AI_BOT_PROFILE_FETCH_MODE', 'aggregated')
+
+# Post chat messages to the async view (enable when serving through ASGI,
+# e.g. `uvicorn patient_chat_app.asgi:application`)
+CHAT_ASYNC_VIEW = os.getenv('CHAT_ASYNC_VIEW', 'false').lower() == 'true'
+
+# Stream bot replies token by token to the chat page (server-sent events)
+CHAT_STREAMING = os.getenv('CHAT_STREAMING', 'true').lower() == 'true'
+
+# Signed-in users chat as their own Patient (Patient.user); anonymous requests
+# are refused (403). Set to true for the single-patient demo only: anonymous
+# requests then chat as the first patient
+CHAT_ANONYMOUS_PATIENT = os.getenv('CHAT_ANONYMOUS_PATIENT', 'false').lower() == 'true'
+
+# Messages rendered with the chat page and returned per request by the message
+# history endpoint; older history is loaded as the patient scrolls up
+CHAT_HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50))
+
+# Backends of the AI bot: 'openai' / 'neo4j', or 'stub' / 'memory' to run the app
+# offline against deterministic stand-ins (ai_bot/backends.py) with this latency
+AI_BOT_CHAT_MODEL = os.getenv('AI_BOT_CHAT_MODEL', 'openai')
+AI_BOT_GRAPH_BACKEND = os.getenv('AI_BOT_GRAPH_BACKEND', 'neo4j')
+AI_BOT_FAKE_LLM_LATENCY_MS = float(os.getenv('AI_BOT_FAKE_LLM_LATENCY_MS', 500))
+AI_BOT_FAKE_LLM_MS_PER_TOKEN = float(os.getenv('AI_BOT_FAKE_LLM_MS_PER_TOKEN', 10))
+AI_BOT_FAKE_GRAPH_LATENCY_MS = float(os.getenv('AI_BOT_FAKE_GRAPH_LATENCY_MS', 5))
+
+# Neo4j connection of the 'neo4j' graph backend (NEO4J_USER is the older name of NEO4J_USERNAME)
+NEO4J_URI = os.getenv('NEO4J_URI')
+NEO4J_USERNAME = os.getenv('NEO4J_USERNAME') or os.getenv('NEO4J_USER')
+NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD')
+NEO4J_DATABASE = os.getenv('NEO4J_DATABASE', 'neo4j')
+NEO4J_MAX_CONNECTION_POOL_SIZE = int(os.getenv('NEO4J_MAX_CONNECTION_POOL_SIZE', 50))  # per worker process
+
+# Where agent state and chat histories live between turns: 'memory' (per-process
+# LRU), 'db' (ChatSession table, shared by workers) or 'redis' (REDIS_URL)
+AI_BOT_SESSION_STORE = os.getenv('AI_BOT_SESSION_STORE', 'memory')
+AI_BOT_SESSION_TTL = int(os.getenv('AI_BOT_SESSION_TTL', 24 * 60 * 60))  # seconds, 0 = never expire
+AI_BOT_SESSION_MAX_ENTRIES = int(os.getenv('AI_BOT_SESSION_MAX_ENTRIES', 10000))  # memory backend only
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Materialized patient profiles read by the agent instead of querying the graph
+# every turn: 'memory' (per-process LRU), 'db' (ProfileEntry table, shared by
+# workers) or 'off'. Defaults to 'db' when sessions are shared between workers.
+AI_BOT_PROFILE_STORE = os.getenv('AI_BOT_PROFILE_STORE', 'memory' if AI_BOT_SESSION_STORE == 'memory' else 'db')
+AI_BOT_PROFILE_STORE_MAX_ENTRIES = int(os.getenv('AI_BOT_PROFILE_STORE_MAX_ENTRIES', 10000))  # memory backend only
+
+# Chat history sent with each prompt: the most recent turns within this many
+# tokens, plus (if enabled) an LLM-written summary of the older ones
+AI_BOT_HISTORY_MAX_TOKENS = int(os.getenv('AI_BOT_HISTORY_MAX_TOKENS', 2000))
+AI_BOT_HISTORY_SUMMARY = os.getenv('AI_BOT_HISTORY_SUMMARY', 'true').lower() == 'true'
+
+# Agent pipeline concurrency: start the general reply while entities are still
+# being extracted (used when the turn turns out to be a general question), and
+# write the turn to Neo4j in the background until the reply needs it
+AI_BOT_SPECULATIVE_RESPONSE = os.getenv('AI_BOT_SPECULATIVE_RESPONSE', 'true').lower() == 'true'
+AI_BOT_GRAPH_WRITE_BEHIND = os.getenv('AI_BOT_GRAPH_WRITE_BEHIND', 'true').lower() == 'true'
+
+# Restarting a conversation deletes that patient's knowledge graph nodes in
+# transactions of at most this many rows
+AI_BOT_GRAPH_RESET_BATCH_SIZE = int(os.getenv('AI_BOT_GRAPH_RESET_BATCH_SIZE', 1000))
+
+# Create the knowledge graph constraints and indexes (if missing) when a worker
+# first connects; `manage.py ensure_graph_schema` does the same on demand
+AI_BOT_GRAPH_ENSURE_SCHEMA = os.getenv('AI_BOT_GRAPH_ENSURE_SCHEMA', 'true').lower() == 'true'
+
+# Entity extraction cache: 'memory' (per-process LRU), 'db' (memory in front of
+# the ExtractionCacheEntry table, shared by workers) or 'off'. The semantic tier
+# embeds each message and reuses the extraction of a near-identical one.
+AI_BOT_EXTRACTION_CACHE = os.getenv('AI_BOT_EXTRACTION_CACHE', 'memory')
+AI_BOT_EXTRACTION_CACHE_TTL = int(os.getenv('AI_BOT_EXTRACTION_CACHE_TTL', 7 * 24 * 60 * 60))  # seconds, 0 = never expire
+AI_BOT_EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv('AI_BOT_EXTRACTION_CACHE_MAX_ENTRIES', 10000))
+AI_BOT_EXTRACTION_CACHE_SEMANTIC = os.getenv('AI_BOT_EXTRACTION_CACHE_SEMANTIC', 'false').lower() == 'true'
+AI_BOT_EXTRACTION_CACHE_SIMILARITY = float(os.getenv('AI_BOT_EXTRACTION_CACHE_SIMILARITY', 0.97))
+
+# Cache of replies to general questions, shared across patients of the same age
+# band and condition: 'db' (memory in front of the ResponseCacheEntry table) or
+# 'off'. Questions about the patient's own record or that refer back to the
+# conversation always go to the LLM.
+AI_BOT_RESPONSE_CACHE = os.getenv('AI_BOT_RESPONSE_CACHE', 'off')
+AI_BOT_RESPONSE_CACHE_TTL = int(os.getenv('AI_BOT_RESPONSE_CACHE_TTL', 24 * 60 * 60))  # seconds, 0 = never expire
+AI_BOT_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('AI_BOT_RESPONSE_CACHE_MAX_ENTRIES', 5000))
+
+# Rule-based fast path in front of LLM entity extraction (ai_bot/rule_extractor.py):
+# structured answers like "lisinopril, 10mg" skip the LLM when the rules are at
+# least this confident
+AI_BOT_RULE_EXTRACTOR = os.getenv('AI_BOT_RULE_EXTRACTOR', 'true').lower() == 'true'
+AI_BOT_RULE_EXTRACTOR_CONFIDENCE = float(os.getenv('AI_BOT_RULE_EXTRACTOR_CONFIDENCE', 0.8))
+
+# Answers to a follow-up question (QUESTIONS in ai_bot/prompts.py) are extracted
+# with a prompt for that question's fields only, not the whole HealthEntity schema
+AI_BOT_TARGETED_EXTRACTION = os.getenv('AI_BOT_TARGETED_EXTRACTION', 'true').lower() == 'true'
+
+# Single-shot agent mode: one LLM call returns both the extracted entities and
+# the reply; follow-up answers and appointment requests still use the pipeline.
+# 'off', 'on', or 'ab' to split turns between both modes (compare the
+# ai_bot_turn_* histograms at /metrics). Streamed replies always use the pipeline.
+AI_BOT_SINGLE_SHOT = os.getenv('AI_BOT_SINGLE_SHOT', 'off')
+
+# Per-request metrics (ai_bot/instrumentation.py): Server-Timing and
+# X-AI-Bot-Metrics headers, a JSON line on the 'ai_bot.metrics' logger and
+# histograms at /metrics
+AI_BOT_METRICS_ENABLED = os.getenv('AI_BOT_METRICS_ENABLED', 'true').lower() == 'true'
+
+# Worker warm-up (ai_bot/warmup.py): wsgi.py/asgi.py build the chat models, the
+# knowledge graph connection and QA chain and the agent apps in the background,
+# and /healthz/ready answers 503 until that is done. The dry run first sends a
+# couple of turns through the agent against stub models before serving.
+AI_BOT_WARMUP = os.getenv('AI_BOT_WARMUP', 'true').lower() == 'true'
+AI_BOT_WARMUP_DRY_RUN = os.getenv('AI_BOT_WARMUP_DRY_RUN', 'false').lower() == 'true'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'ai_bot.metrics': {
+            'handlers': ['console'],
+            'level': os.getenv('AI_BOT_METRICS_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -17,7 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from ai_bot.views import metrics_view, readiness_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
+    path('healthz/ready', readiness_view, name='readiness'),
     path('', include('chat.urls')),
 ]
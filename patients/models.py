@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 from datetime import datetime
@@ -13,6 +14,9 @@ class Patient(models.Model):
     last_appointment_datetime = models.DateTimeField(default=timezone.now)
     next_appointment_datetime = models.DateTimeField(default=timezone.now)
     doctor_name = models.CharField(max_length=100)
+    # The account the patient signs in with (chat.views resolves the patient from it)
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                related_name='patient')
 
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
@@ -20,6 +24,10 @@ class Patient(models.Model):
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
     
+    def get_graph_name(self):
+        # Name of the patient's node in the knowledge graph, unique per patient
+        return f"{self.get_full_name()} #{self.pk}" if self.pk else self.get_full_name()
+
     def get_age(self):
         today = timezone.now().date()
         return today.year - self.date_of_birth.year - ((today.month, today.day) < (self.date_of_birth.month, self.date_of_birth.day))